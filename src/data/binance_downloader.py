@@ -6,14 +6,21 @@
   It downloads the historical data from the publicly available Binance API
   Refer to notebooks/1.0-Downloading-Data.ipynb for an usage example
 """
-import os, sys
+import os, sys, time
+import hashlib
+import tempfile
 import pandas as pd
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import * 
 from pathlib import Path
-from binance.spot import Spot
 
-YEARS = ['2017', '2018', '2019', '2020', '2021', '2022']
+from .kline_store import (
+    ingest_daily_klines,
+    load_klines,
+)
+
+YEARS = [str(year) for year in range(2017, datetime.now().year + 1)]
 INTERVALS = ["1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d", "3d", "1w", "1mo"]
 DAILY_INTERVALS = ["1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d"]
 TRADING_TYPE = ["spot", "um", "cm"]
@@ -22,12 +29,42 @@ PERIOD_START_DATE = '2020-01-01'
 BASE_URL = 'https://data.binance.vision/'
 START_DATE = date(int(YEARS[0]), MONTHS[0], 1)
 END_DATE = datetime.date(datetime.now())
+# Concurrent download settings
+DOWNLOAD_MAX_WORKERS = 8
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF_FACTOR = 0.5
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+BINANCE_API_URL = "https://data.binance.com"
+
+# Built on first use so that importing this module never blocks on (or fails without) the network
+_binance_client = None
 
-BINANCE_CLIENT = Spot(base_url="https://data.binance.com")
-print(BINANCE_CLIENT.time())
+def get_binance_client():
+    global _binance_client
+    if _binance_client is None:
+        from binance.spot import Spot
+        _binance_client = Spot(base_url=BINANCE_API_URL)
+    return _binance_client
 
-def get_realtime_klines(start_time, ticker="BTCUSDT", interval="1m"):
-    client = BINANCE_CLIENT
+def set_binance_client(client):
+    """
+    Inject the client used for real-time klines, e.g. a pre-configured Spot or a local fake of Spot.klines
+    """
+    global _binance_client
+    _binance_client = client
+
+def __getattr__(name):
+    # BINANCE_CLIENT is still available to existing callers, but only constructed when accessed
+    if name == "BINANCE_CLIENT":
+        return get_binance_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_realtime_klines(start_time, ticker="BTCUSDT", interval="1m", client=None):
+    if client is None:
+        client = get_binance_client()
         
     # Get all klines today up to the latest recorded minute
     realtime_klines = []
@@ -58,7 +95,12 @@ def get_destination_dir(file_url, folder=None):
 def get_download_url(file_url):
   return "{}{}".format(BASE_URL, file_url)
 
-def download_file(base_path, file_name, date_range=None, folder=None):
+def get_save_path(base_path, file_name, folder=None):
+  if folder:
+    base_path = os.path.join(folder, base_path)
+  return get_destination_dir(os.path.join(base_path, file_name), folder)
+
+def download_file(base_path, file_name, date_range=None, folder=None, expected_sha256=None):
   download_path = "{}{}".format(base_path, file_name)
   if folder:
     base_path = os.path.join(folder, base_path)
@@ -85,9 +127,10 @@ def download_file(base_path, file_name, date_range=None, folder=None):
       length = int(length)
       blocksize = max(4096,length//100)
 
-    with open(save_path, 'wb') as out_file:
+    print("\nFile Download: {}".format(save_path))
+    # Write to a temp file first so an interrupted download never leaves a truncated zip behind
+    with _atomic_writer(save_path, hash_contents=expected_sha256 is not None) as out_file:
       dl_progress = 0
-      print("\nFile Download: {}".format(save_path))
       while True:
         buf = dl_file.read(blocksize)   
         if not buf:
@@ -97,11 +140,167 @@ def download_file(base_path, file_name, date_range=None, folder=None):
         done = int(50 * dl_progress / length)
         sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )    
         sys.stdout.flush()
+      if expected_sha256 is not None and out_file.hexdigest() != expected_sha256:
+        out_file.save_path = get_quarantine_path(save_path, folder)
+        print("\nChecksum mismatch, quarantined: {}".format(out_file.save_path))
 
   except urllib.error.HTTPError:
     print("\nFile not found: {}".format(download_url))
     pass
 
+class _atomic_writer:
+  """
+  Context manager that writes to a temp file next to save_path and renames it into place on success.
+  On any exception the temp file is removed, so save_path only ever exists once fully written.
+  With hash_contents, the SHA-256 of the written bytes is computed as they are written.
+  save_path may be changed before the block exits, e.g. to divert the file into quarantine.
+  """
+  def __init__(self, save_path, hash_contents=False):
+    self.save_path = save_path
+    self.sha256 = hashlib.sha256() if hash_contents else None
+
+  def __enter__(self):
+    fd, self.tmp_path = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(self.save_path)), suffix=".part", dir=os.path.dirname(self.save_path))
+    self.file = os.fdopen(fd, 'wb')
+    return self
+
+  def write(self, buf):
+    if self.sha256 is not None:
+      self.sha256.update(buf)
+    self.file.write(buf)
+
+  def hexdigest(self):
+    return self.sha256.hexdigest()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.file.close()
+    if exc_type is None:
+      Path(os.path.dirname(self.save_path)).mkdir(parents=True, exist_ok=True)
+      os.replace(self.tmp_path, self.save_path)
+    elif os.path.exists(self.tmp_path):
+      os.remove(self.tmp_path)
+    return False
+
+def get_quarantine_path(save_path, folder=None):
+  """
+  Where a file that failed checksum verification is moved to, so it is never mistaken for a good download
+  """
+  return os.path.join(get_destination_dir("quarantine", folder), os.path.basename(save_path))
+
+def parse_checksum(checksum_text):
+  """
+  Parse the SHA-256 hex digest from the contents of a Binance .CHECKSUM file ("<sha256>  <file name>")
+  """
+  return checksum_text.split()[0].strip().lower()
+
+def read_checksum_file(checksum_path):
+  with open(checksum_path, 'r') as f:
+    return parse_checksum(f.read())
+
+def get_download_session(pool_size=DOWNLOAD_MAX_WORKERS, max_retries=DOWNLOAD_MAX_RETRIES, backoff_factor=DOWNLOAD_BACKOFF_FACTOR):
+  """
+  Build a requests session with a keep-alive connection pool sized for pool_size workers,
+  retrying connection errors and transient HTTP statuses with exponential backoff
+  """
+  import requests
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+
+  retry = Retry(total=max_retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUS_CODES,
+                allowed_methods=["GET"],
+                raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+def download_file_pooled(session, base_path, file_name, folder=None, verify_checksum=False, max_retries=DOWNLOAD_MAX_RETRIES, backoff_factor=DOWNLOAD_BACKOFF_FACTOR):
+  """
+  Download a single file through a shared session, without per-block progress output.
+  With verify_checksum, the published .CHECKSUM is fetched first and the SHA-256 is computed while
+  streaming to disk; mismatching files are moved to quarantine instead of save_path.
+  Returns one of "exists", "downloaded", "not_found" or "quarantined".
+  """
+  import requests
+
+  download_path = "{}{}".format(base_path, file_name)
+  save_path = get_save_path(base_path, file_name, folder)
+
+  if os.path.exists(save_path):
+    return "exists"
+
+  Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+  download_url = get_download_url(download_path)
+
+  expected_sha256 = None
+  if verify_checksum:
+    checksum_response = session.get(download_url + ".CHECKSUM", timeout=DOWNLOAD_TIMEOUT)
+    if checksum_response.status_code == 200:
+      expected_sha256 = parse_checksum(checksum_response.text)
+    else:
+      print("\nNo checksum available, saving unverified: {}".format(download_url))
+
+  # The adapter retries connecting and retryable statuses, this loop covers connections dropped mid-body
+  attempt = 0
+  while True:
+    try:
+      with session.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 404:
+          print("\nFile not found: {}".format(download_url))
+          return "not_found"
+        response.raise_for_status()
+        with _atomic_writer(save_path, hash_contents=expected_sha256 is not None) as out_file:
+          for buf in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            out_file.write(buf)
+          if expected_sha256 is not None and out_file.hexdigest() != expected_sha256:
+            out_file.save_path = get_quarantine_path(save_path, folder)
+            print("\nChecksum mismatch, quarantined: {}".format(out_file.save_path))
+            return "quarantined"
+      return "downloaded"
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+      attempt += 1
+      if attempt > max_retries:
+        raise
+      time.sleep(backoff_factor * (2 ** (attempt - 1)))
+
+def download_files_concurrently(file_list, folder=None, max_workers=DOWNLOAD_MAX_WORKERS, session=None, verify_checksum=False):
+  """
+  Download (base_path, file_name) pairs with a bounded thread pool sharing one connection pool
+
+  Args:
+    file_list: List of (base_path, file_name) tuples as passed to download_file
+    folder: Root folder to save files into
+    max_workers: Maximum number of concurrent downloads
+    session: Optional session to reuse, e.g. one shared across several calls. Defaults to get_download_session(max_workers)
+    verify_checksum: Verify each file against its published .CHECKSUM while streaming, quarantining mismatches
+
+  Returns:
+    Dictionary of status ("exists", "downloaded", "not_found", "quarantined", "failed") to number of files
+  """
+  if session is None:
+    session = get_download_session(pool_size=max_workers)
+
+  counts = {"exists": 0, "downloaded": 0, "not_found": 0, "quarantined": 0, "failed": 0}
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {executor.submit(download_file_pooled, session, base_path, file_name, folder, verify_checksum): file_name for base_path, file_name in file_list}
+    for future in as_completed(futures):
+      try:
+        status = future.result()
+      except Exception as e:
+        print("\nFailed to download {}: {}".format(futures[future], e))
+        status = "failed"
+      counts[status] += 1
+      done = sum(counts.values())
+      if status == "downloaded":
+        sys.stdout.write("\r[{}/{}] downloaded {}".format(done, len(futures), futures[future]))
+        sys.stdout.flush()
+
+  print("\nDownloaded {downloaded}, skipped {exists} existing, {not_found} not found, {quarantined} quarantined, {failed} failed".format(**counts))
+  return counts
+
 def convert_to_date_object(d):
   year, month, day = [int(x) for x in d.split('-')]
   date_obj = date(year, month, day)
@@ -117,7 +316,7 @@ def get_path(trading_type, market_data_type, time_period, symbol, interval=None)
     path = f'{trading_type_path}/{time_period}/{market_data_type}/{symbol.upper()}/'
   return path
 
-def download_historical_daily_klines(trading_type, symbols, num_symbols, intervals, start_date, end_date, folder, checksum=0):
+def download_historical_daily_klines(trading_type, symbols, num_symbols, intervals, start_date, end_date, folder, checksum=0, max_workers=1):
   current = 0
   date_range = None
 
@@ -143,6 +342,9 @@ def download_historical_daily_klines(trading_type, symbols, num_symbols, interva
   dates = pd.date_range(end=datetime.today(), periods=period.days + 1).to_pydatetime().tolist()
   dates = [date.strftime("%Y-%m-%d") for date in dates]
 
+  # Files to download, only collected up front when downloading concurrently
+  file_list = []
+
   for symbol in symbols:
     print("[{}/{}] - start download daily {} klines ".format(current+1, num_symbols, symbol))
     for interval in intervals:
@@ -151,15 +353,75 @@ def download_historical_daily_klines(trading_type, symbols, num_symbols, interva
         if current_date >= start_date and current_date <= end_date:
           path = get_path(trading_type, "klines", "daily", symbol, interval)
           file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date)
-          download_file(path, file_name, date_range, folder)
+          if max_workers > 1:
+            # Checksums are fetched and verified by the pool while each zip streams to disk
+            file_list.append((path, file_name))
+            continue
 
+          expected_sha256 = None
           if checksum == 1:
             checksum_path = get_path(trading_type, "klines", "daily", symbol, interval)
             checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, date)
             download_file(checksum_path, checksum_file_name, date_range, folder)
+            saved_checksum_path = get_save_path(checksum_path, checksum_file_name, folder)
+            if os.path.exists(saved_checksum_path):
+              expected_sha256 = read_checksum_file(saved_checksum_path)
+
+          download_file(path, file_name, date_range, folder, expected_sha256=expected_sha256)
 
     current += 1
 
+  if file_list:
+    download_files_concurrently(file_list, folder, max_workers=max_workers, verify_checksum=checksum == 1)
+
+def download_historical_klines_bulk(trading_type, symbols, intervals, start_date, end_date, folder, max_workers=DOWNLOAD_MAX_WORKERS, checksum=1):
+  """
+  Backfill klines using monthly archives for every closed month in the date range and daily files
+  only for the current month, which takes about 30x fewer requests than daily files alone.
+  Monthly archives land under data/<trading_type>/monthly/klines/<SYMBOL>/<interval>/.
+
+  Args:
+    trading_type: Trading type, e.g. 'spot'
+    symbols: List of ticker symbols
+    intervals: List of kline intervals
+    start_date: First day to backfill (YYYY-MM-DD). Defaults to START_DATE
+    end_date: Last day to backfill (YYYY-MM-DD). Defaults to END_DATE
+    folder: Root folder to save files into
+    max_workers: Maximum number of concurrent downloads
+    checksum: 1 to verify every file against its published SHA-256 while it streams to disk
+
+  Returns:
+    Dictionary of status to number of files, see download_files_concurrently
+  """
+  start_date = convert_to_date_object(start_date) if start_date else START_DATE
+  end_date = convert_to_date_object(end_date) if end_date else END_DATE
+  current_month_start = datetime.date(datetime.now()).replace(day=1)
+
+  monthly_intervals = [interval for interval in intervals if interval in INTERVALS]
+  daily_intervals = [interval for interval in intervals if interval in DAILY_INTERVALS]
+
+  file_list = []
+  for symbol in symbols:
+    for interval in monthly_intervals:
+      path = get_path(trading_type, "klines", "monthly", symbol, interval)
+      for year in YEARS:
+        for month in MONTHS:
+          month_start = date(int(year), month, 1)
+          # Only closed months have a monthly archive
+          if month_start >= current_month_start:
+            continue
+          month_end = (pd.Timestamp(month_start) + pd.offsets.MonthEnd(0)).date()
+          if month_end >= start_date and month_start <= end_date:
+            file_list.append((path, "{}-{}-{}-{:02d}.zip".format(symbol.upper(), interval, year, month)))
+
+    for interval in daily_intervals:
+      path = get_path(trading_type, "klines", "daily", symbol, interval)
+      for ts in pd.date_range(start=max(start_date, current_month_start), end=end_date):
+        file_list.append((path, "{}-{}-{}.zip".format(symbol.upper(), interval, ts.strftime('%Y-%m-%d'))))
+
+  print("Bulk backfill of {} files for {} symbols".format(len(file_list), len(symbols)))
+  return download_files_concurrently(file_list, folder, max_workers=max_workers, verify_checksum=checksum == 1)
+
 def generate_latest_historical_df(trading_type, 
                                   ticker_symbol, 
                                   interval, 
@@ -170,6 +432,8 @@ def generate_latest_historical_df(trading_type,
                                   historical_df_path,
                                   raw_df_headers,
                                   write_csv=True,
+                                  max_workers=1,
+                                  kline_store_dir=None,
                                  ):
     
     download_historical_daily_klines(trading_type, 
@@ -178,20 +442,33 @@ def generate_latest_historical_df(trading_type,
                                      [interval], 
                                      start_date, 
                                      end_date, 
-                                     historical_data_dir)
+                                     historical_data_dir,
+                                     max_workers=max_workers)
+
+    # Read from the columnar store, ingesting any newly downloaded days into it first
+    if kline_store_dir is not None:
+      ingest_daily_klines(historical_files_dir, kline_store_dir, trading_type, ticker_symbol, interval, start_date, end_date)
+      historical_df = load_klines(kline_store_dir, trading_type, ticker_symbol, interval, start_date, end_date, columns=raw_df_headers)
+      if write_csv:
+        historical_df.to_csv(historical_df_path, index=False)
+      return historical_df
 
     # Read all files in BINANCE_HISTORICAL_FILES_DIR
     # files = sorted([str(path) for path in historical_files_dir.glob('**/*') if path.is_file()])
     files = [f"{historical_files_dir}/{ticker_symbol}-{interval}-{ts.strftime('%Y-%m-%d')}.zip" for ts in list(pd.date_range(start=start_date, end=end_date))]
     
     df_list = []
+    missing_files = []
     for path in files:
       try:
         _df = pd.read_csv(path, names=raw_df_headers)
         df_list.append(_df)
       except Exception as e:
-        print(f"Exception reading csv for {path}")
-        break
+        print(f"Exception reading csv for {path}: {e}")
+        missing_files.append(path)
+
+    if missing_files:
+      print(f"Missing {len(missing_files)} day(s) of {ticker_symbol} {interval} klines: {', '.join(os.path.basename(path) for path in missing_files)}")
       
     historical_df = pd.concat(df_list, axis=0, ignore_index=True)
 
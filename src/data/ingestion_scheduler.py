@@ -0,0 +1,127 @@
+"""
+  Scheduler for ingesting klines of many (trading_type, symbol, interval) jobs at once.
+  All jobs share one connection pool and download thread budget, and each job's days are parsed into
+  the columnar kline store in a process pool as soon as that job's downloads have finished.
+"""
+import os
+import time
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from .binance_downloader import (
+    DOWNLOAD_MAX_WORKERS,
+    download_file_pooled,
+    get_download_session,
+    get_path,
+    get_save_path,
+)
+from .kline_rollup import update_rollups
+from .kline_store import ingest_daily_klines
+
+IngestionJob = namedtuple('IngestionJob', ['trading_type', 'symbol', 'interval'])
+
+
+def get_job_files_dir(job: IngestionJob, folder) -> str:
+    """
+    Directory the daily zips of a job are downloaded to
+    """
+    path = get_path(job.trading_type, "klines", "daily", job.symbol, job.interval)
+    return os.path.dirname(get_save_path(path, "", folder))
+
+def _ingest_job(job: IngestionJob, folder, store_dir, start_date: str, end_date: str, build_rollups: bool = False):
+    start = time.time()
+    ingested = ingest_daily_klines(get_job_files_dir(job, folder), store_dir, job.trading_type, job.symbol, job.interval, start_date, end_date)
+    if build_rollups and job.interval == '1m':
+        update_rollups(store_dir, job.trading_type, job.symbol, start_date, end_date)
+    return len(ingested), time.time() - start
+
+def run_ingestion(jobs: list,
+                  start_date: str,
+                  end_date: str,
+                  folder,
+                  store_dir,
+                  max_workers: int = DOWNLOAD_MAX_WORKERS,
+                  max_processes: int = None,
+                  checksum: int = 0,
+                  build_rollups: bool = False,
+                 ) -> pd.DataFrame:
+    """
+    Download and ingest daily klines for a set of jobs
+
+    Args:
+        jobs: Iterable of IngestionJob (or (trading_type, symbol, interval) tuples)
+        start_date: First day to ingest (YYYY-MM-DD)
+        end_date: Last day to ingest (YYYY-MM-DD)
+        folder: Root folder the daily zips are downloaded to
+        store_dir: Root directory of the kline store
+        max_workers: Concurrent downloads shared by all jobs
+        max_processes: Processes used to parse zips into the store. Defaults to os.cpu_count()
+        checksum: 1 to verify every download against its published SHA-256
+        build_rollups: Update the rollup pyramid of 1m jobs after ingesting them, see kline_rollup.update_rollups
+
+    Returns:
+        Dataframe with one row of download and ingest throughput per job
+    """
+    jobs = [IngestionJob(*job) for job in jobs]
+    dates = [ts.strftime('%Y-%m-%d') for ts in pd.date_range(start=start_date, end=end_date)]
+    session = get_download_session(pool_size=max_workers)
+
+    stats = {job: {'files_downloaded': 0, 'files_skipped': 0, 'files_missing': 0, 'files_failed': 0, 'mb_downloaded': 0.0,
+                   'download_seconds': 0.0, 'days_ingested': 0, 'ingest_seconds': 0.0} for job in jobs}
+    remaining = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as download_executor, ProcessPoolExecutor(max_workers=max_processes) as ingest_executor:
+        download_futures = {}
+        for job in jobs:
+            path = get_path(job.trading_type, "klines", "daily", job.symbol, job.interval)
+            remaining[job] = len(dates)
+            for date in dates:
+                file_name = "{}-{}-{}.zip".format(job.symbol.upper(), job.interval, date)
+                future = download_executor.submit(download_file_pooled, session, path, file_name, folder, checksum == 1)
+                download_futures[future] = (job, get_save_path(path, file_name, folder))
+
+        ingest_futures = {}
+        for future in as_completed(download_futures):
+            job, save_path = download_futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f"Failed to download {save_path}: {e}")
+                status = "failed"
+
+            job_stats = stats[job]
+            if status == "downloaded":
+                job_stats['files_downloaded'] += 1
+                job_stats['mb_downloaded'] += os.path.getsize(save_path) / 1e6
+            elif status == "exists":
+                job_stats['files_skipped'] += 1
+            elif status == "not_found":
+                job_stats['files_missing'] += 1
+            else:
+                job_stats['files_failed'] += 1
+
+            remaining[job] -= 1
+            if remaining[job] == 0:
+                # All of this job's files are on disk, parse them while other jobs are still downloading
+                job_stats['download_seconds'] = time.time() - start
+                ingest_futures[ingest_executor.submit(_ingest_job, job, folder, store_dir, start_date, end_date, build_rollups)] = job
+
+        for future in as_completed(ingest_futures):
+            job = ingest_futures[future]
+            try:
+                days_ingested, ingest_seconds = future.result()
+            except Exception as e:
+                print(f"Failed to ingest {job}: {e}")
+                days_ingested, ingest_seconds = 0, 0.0
+            stats[job]['days_ingested'] = days_ingested
+            stats[job]['ingest_seconds'] = ingest_seconds
+
+    report_df = pd.DataFrame([{**job._asdict(), **job_stats} for job, job_stats in stats.items()])
+    report_df['download_mb_per_second'] = report_df['mb_downloaded'] / report_df['download_seconds'].where(report_df['download_seconds'] > 0)
+    report_df['ingested_days_per_second'] = report_df['days_ingested'] / report_df['ingest_seconds'].where(report_df['ingest_seconds'] > 0)
+    print(f"Ingested {len(jobs)} jobs in {time.time() - start:.1f} seconds")
+    print(report_df.to_string(index=False))
+
+    return report_df
@@ -0,0 +1,130 @@
+"""
+  Append-only, in-memory materialization of the historical kline window used for real-time inference.
+  Only days that have not been ingested yet are downloaded and parsed on each update, days that fall
+  out of the requested window are evicted, and missing days are reported instead of truncating the window.
+"""
+import threading
+import pandas as pd
+from pathlib import Path
+
+from .binance_downloader import (
+    download_historical_daily_klines,
+)
+from .kline_store import (
+    ingest_daily_klines,
+    load_klines,
+)
+
+
+def _date_to_unix_ms(date_str: str) -> int:
+    return int(pd.Timestamp(date_str).value // 10**6)
+
+class MaterializedKlineHistory:
+    """
+    Historical klines kept per (trading_type, symbol, interval), updated incrementally.
+
+    Attributes:
+        frames: Materialized dataframe per key, sorted by open_time
+        loaded_days: Set of ingested dates (YYYY-MM-DD) per key
+        last_close_times: Last ingested close_time per key
+        missing_days: Dates in the latest requested window that could not be read, per key
+    """
+    def __init__(self):
+        self.frames = {}
+        self.loaded_days = {}
+        self.last_close_times = {}
+        self.missing_days = {}
+        # The instance is shared between sessions, so updates run one at a time
+        self._lock = threading.Lock()
+
+    def _read_day(self, date_str, trading_type, symbol, interval, historical_files_dir, raw_df_headers, kline_store_dir):
+        if kline_store_dir is not None:
+            ingest_daily_klines(historical_files_dir, kline_store_dir, trading_type, symbol, interval, date_str, date_str)
+            # Missing days are reported together by update
+            df = load_klines(kline_store_dir, trading_type, symbol, interval, date_str, date_str, columns=raw_df_headers, warn_missing=False)
+            return df if len(df) > 0 else None
+
+        path = Path(historical_files_dir) / f"{symbol}-{interval}-{date_str}.zip"
+        try:
+            return pd.read_csv(path, names=raw_df_headers)
+        except Exception as e:
+            print(f"Exception reading csv for {path}: {e}")
+            return None
+
+    def update(self,
+               trading_type: str,
+               symbol: str,
+               interval: str,
+               start_date: str,
+               end_date: str,
+               historical_data_dir,
+               historical_files_dir,
+               raw_df_headers: list,
+               kline_store_dir=None,
+               max_workers: int = 1,
+              ) -> pd.DataFrame:
+        """
+        Bring the materialized history for a symbol/interval up to date with the [start_date, end_date] window
+        and return it. Only days not ingested yet are downloaded and read. Concurrent calls are serialized.
+
+        Args:
+            trading_type: Trading type, e.g. 'spot'
+            symbol: Ticker symbol, e.g. 'BTCUSDT'
+            interval: Kline interval, e.g. '1m'
+            start_date: First day of the window (YYYY-MM-DD)
+            end_date: Last day of the window (YYYY-MM-DD)
+            historical_data_dir: Folder the daily zips are downloaded to
+            historical_files_dir: Directory containing the daily zips for this symbol/interval
+            raw_df_headers: Column names of the raw klines
+            kline_store_dir: Optional columnar kline store to read days from
+            max_workers: Number of concurrent downloads for new days
+        """
+        with self._lock:
+            key = (trading_type, symbol, interval)
+            frame = self.frames.get(key)
+            loaded_days = self.loaded_days.setdefault(key, set())
+
+            # Evict days that fell out of the window
+            start_ms = _date_to_unix_ms(start_date)
+            if frame is not None and len(frame) > 0 and frame['open_time'].iloc[0] < start_ms:
+                frame = frame[frame['open_time'] >= start_ms].reset_index(drop=True)
+
+            window_days = [ts.strftime('%Y-%m-%d') for ts in pd.date_range(start=start_date, end=end_date)]
+            new_days = [day for day in window_days if day not in loaded_days]
+
+            if len(new_days) > 0:
+                download_historical_daily_klines(trading_type, [symbol], 1, [interval], new_days[0], new_days[-1], historical_data_dir, max_workers=max_workers)
+
+            new_dfs = []
+            read_days = []
+            missing_days = []
+            for day in new_days:
+                df = self._read_day(day, trading_type, symbol, interval, historical_files_dir, raw_df_headers, kline_store_dir)
+                if df is None:
+                    missing_days.append(day)
+                    continue
+                new_dfs.append(df)
+                read_days.append(day)
+
+            if len(missing_days) > 0:
+                print(f"Missing {len(missing_days)} day(s) of {symbol} {interval} klines: {', '.join(missing_days)}")
+            self.missing_days[key] = missing_days
+
+            if len(new_dfs) > 0:
+                last_close_time = self.last_close_times.get(key)
+                frame = pd.concat(([frame] if frame is not None else []) + new_dfs, axis=0, ignore_index=True)
+                # A previously missing day that has since appeared lands before the tail
+                if last_close_time is not None and any(df['close_time'].iloc[0] <= last_close_time for df in new_dfs):
+                    frame = frame.sort_values('open_time', kind='stable').reset_index(drop=True)
+
+            if frame is None:
+                frame = pd.DataFrame(columns=raw_df_headers)
+
+            # Days only count as loaded once their rows are in the frame
+            self.frames[key] = frame
+            loaded_days.difference_update({day for day in loaded_days if day < start_date})
+            loaded_days.update(read_days)
+            if len(frame) > 0:
+                self.last_close_times[key] = int(frame['close_time'].iloc[-1])
+
+            return frame
@@ -0,0 +1,114 @@
+"""
+  Access layer over klines indexed by open_time.
+  Range lookups are binary searches over the sorted int64 open_time column and return slices that share
+  memory with the underlying columns. Stored klines are located through their daily partitions first.
+"""
+import numpy as np
+import pandas as pd
+
+from .kline_store import load_klines
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class KlineRangeIndex:
+    """
+    Klines sorted by open_time, with O(log n) range lookups
+
+    Args:
+        df: Klines with an open_time column. Sorted by open_time if not sorted already.
+    """
+    def __init__(self, df: pd.DataFrame):
+        if not df['open_time'].is_monotonic_increasing:
+            df = df.sort_values('open_time', kind='stable').reset_index(drop=True)
+        # Lookups are positional, so a sorted frame is used as is instead of copied
+        self.df = df
+        self.open_times = self.df['open_time'].to_numpy(dtype=np.int64)
+        self._column_arrays = {}
+
+    def __len__(self):
+        return len(self.open_times)
+
+    def locate(self, start_time: int = None, end_time: int = None):
+        """
+        Positions [i, j) of the klines with start_time <= open_time < end_time. None leaves that side open.
+        """
+        i = 0 if start_time is None else int(np.searchsorted(self.open_times, start_time, side='left'))
+        j = len(self.open_times) if end_time is None else int(np.searchsorted(self.open_times, end_time, side='left'))
+        return i, max(i, j)
+
+    def column(self, name: str, start_time: int = None, end_time: int = None) -> np.ndarray:
+        """
+        Values of one column for start_time <= open_time < end_time, as a view on the stored column
+        """
+        i, j = self.locate(start_time, end_time)
+        if name not in self._column_arrays:
+            self._column_arrays[name] = self.df[name].to_numpy()
+        return self._column_arrays[name][i:j]
+
+    def slice(self, start_time: int = None, end_time: int = None, columns: list = None) -> pd.DataFrame:
+        """
+        Klines with start_time <= open_time < end_time, as a positional slice of the indexed dataframe
+        """
+        i, j = self.locate(start_time, end_time)
+        df = self.df if columns is None else self.df[columns]
+        return df.iloc[i:j]
+
+def load_kline_range(store_dir,
+                     trading_type: str,
+                     symbol: str,
+                     interval: str,
+                     start_time: int,
+                     end_time: int,
+                     columns: list = None,
+                    ) -> pd.DataFrame:
+    """
+    Load stored klines with start_time <= open_time < end_time. Only the daily partitions overlapping the
+    range are read, then the exact range is cut out of them with a binary search.
+
+    Args:
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval, e.g. '1m'
+        start_time: Unix time in ms, inclusive
+        end_time: Unix time in ms, exclusive
+        columns: Columns to read. open_time is always read.
+    """
+    start_date = pd.Timestamp(start_time - start_time % DAY_MS, unit='ms').strftime('%Y-%m-%d')
+    end_date = pd.Timestamp(end_time - 1 - (end_time - 1) % DAY_MS, unit='ms').strftime('%Y-%m-%d')
+    read_columns = None if columns is None else ['open_time'] + [column for column in columns if column != 'open_time']
+    df = load_klines(store_dir, trading_type, symbol, interval, start_date, end_date, columns=read_columns)
+    index = KlineRangeIndex(df)
+    return index.slice(start_time, end_time, columns=columns).reset_index(drop=True)
+
+def merge_klines(historical_df: pd.DataFrame, realtime_df: pd.DataFrame, key: str = 'open_time') -> pd.DataFrame:
+    """
+    Merge historical and live klines into one frame sorted by key, with one row per key.
+    Where both have a bar for the same key the live bar wins, as it is the more recent view of that bar.
+    Both inputs are expected to be sorted by key, as they are when read from the store or the API.
+
+    Args:
+        historical_df: Historical klines
+        realtime_df: Live klines
+        key: Column identifying a bar
+    """
+    if len(realtime_df) == 0:
+        return historical_df.reset_index(drop=True)
+    if len(historical_df) == 0:
+        return realtime_df.reset_index(drop=True)
+
+    historical_keys = historical_df[key].to_numpy()
+    realtime_keys = realtime_df[key].to_numpy()
+    # Historical bars from the first live bar on overlap with the live bars
+    cut = int(np.searchsorted(historical_keys, realtime_keys[0], side='left'))
+    if cut == len(historical_keys):
+        return pd.concat([historical_df, realtime_df], axis=0, ignore_index=True)
+
+    overlap_df = historical_df.iloc[cut:]
+    # Keep historical bars inside the overlap that the live data does not have
+    overlap_df = overlap_df[~np.isin(overlap_df[key].to_numpy(), realtime_keys)]
+    merged_df = pd.concat([historical_df.iloc[:cut], overlap_df, realtime_df], axis=0, ignore_index=True)
+    if len(overlap_df) > 0:
+        merged_df = merged_df.sort_values(key, kind='stable').reset_index(drop=True)
+    return merged_df
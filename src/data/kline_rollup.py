@@ -0,0 +1,271 @@
+"""
+  Rollup pyramid of coarser klines derived from stored 1m klines.
+  Every level is aggregated from the level below it (1m -> 5m -> 15m -> 1h -> 4h -> 1d), so each level costs
+  O(bars of the level below) to build and O(bars at its own resolution) to read. Rollups are written to
+  monthly partitions <store_dir>/rollups/<trading_type>/<SYMBOL>/<interval>/<YYYY-MM>.parquet, and a month is
+  only rebuilt when one of its 1m partitions is newer than its rollups. RollupPyramid keeps the levels up to
+  date in memory as live minutes arrive, recomputing only the bars of the current day.
+"""
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+from .kline_index import KlineRangeIndex, merge_klines
+from .kline_store import (
+    KLINE_COLUMNS,
+    get_partition_dir,
+    get_partition_path,
+    get_stored_dates,
+    load_klines,
+    write_partition,
+)
+
+MS_PER_MINUTE = 60 * 1000
+# Levels of the pyramid in minutes. Each one divides the next and a day, so a day's bars never straddle days.
+ROLLUP_INTERVALS = {'5m': 5, '15m': 15, '1h': 60, '4h': 240, '1d': 1440}
+ROLLUP_DIR_NAME = 'rollups'
+SUM_COLUMNS = ['volume', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume']
+
+
+def get_rollup_store_dir(store_dir) -> Path:
+    """
+    Root of the rollups of a kline store
+    """
+    return Path(store_dir) / ROLLUP_DIR_NAME
+
+def _check_intervals(intervals: dict) -> None:
+    minutes = [1] + list(intervals.values())
+    for lower, upper in zip(minutes[:-1], minutes[1:]):
+        if upper % lower != 0:
+            raise ValueError(f"Rollup intervals must each be a multiple of the previous one, got {intervals}")
+    if 1440 % minutes[-1] != 0:
+        raise ValueError(f"Rollup intervals must divide a day, got {intervals}")
+
+def rollup_klines(df: pd.DataFrame, interval_ms: int) -> pd.DataFrame:
+    """
+    Aggregate klines sorted by open_time into bars of interval_ms aligned to the Unix epoch. Intervals without any
+    kline have no bar. close_time is the end of the bar's interval, as Binance reports it.
+
+    Args:
+        df: Klines with the kline store's columns, sorted by open_time
+        interval_ms: Length of the bars to aggregate to, a multiple of the klines' interval
+    """
+    if len(df) == 0:
+        return df.iloc[:0][KLINE_COLUMNS].reset_index(drop=True)
+
+    open_times = df['open_time'].to_numpy()
+    bar_open_times = open_times - open_times % interval_ms
+    starts = np.flatnonzero(np.r_[True, bar_open_times[1:] != bar_open_times[:-1]])
+    ends = np.r_[starts[1:], len(df)] - 1
+
+    bars = {
+        'open_time': bar_open_times[starts],
+        'open': df['open'].to_numpy()[starts],
+        'high': np.maximum.reduceat(df['high'].to_numpy(), starts),
+        'low': np.minimum.reduceat(df['low'].to_numpy(), starts),
+        'close': df['close'].to_numpy()[ends],
+        'close_time': bar_open_times[starts] + interval_ms - 1,
+        'ignore': np.zeros(len(starts), dtype=df['ignore'].dtype),
+    }
+    for column in SUM_COLUMNS:
+        bars[column] = np.add.reduceat(df[column].to_numpy(), starts)
+    return pd.DataFrame({column: bars[column] for column in KLINE_COLUMNS})
+
+def build_rollup_pyramid(df: pd.DataFrame, intervals: dict = ROLLUP_INTERVALS) -> Dict[str, pd.DataFrame]:
+    """
+    Roll 1m klines up into every level of the pyramid, each level from the one below it
+
+    Args:
+        df: 1m klines sorted by open_time
+        intervals: Levels to build, interval name to minutes, in increasing order
+
+    Returns:
+        Dictionary of interval name to klines
+    """
+    _check_intervals(intervals)
+    levels = {}
+    for interval, minutes in intervals.items():
+        df = rollup_klines(df, minutes * MS_PER_MINUTE)
+        levels[interval] = df
+    return levels
+
+def get_rollup_partition_path(store_dir, trading_type: str, symbol: str, interval: str, month: str) -> Path:
+    """
+    Monthly partition of one level of the rollups. Rollups are partitioned by month instead of by day, as a day
+    of a coarse level is only a few rows and reading a file costs more than reading a few thousand rows.
+    """
+    return get_partition_dir(get_rollup_store_dir(store_dir), trading_type, symbol, interval) / f"{month}.parquet"
+
+def update_rollups(store_dir,
+                   trading_type: str,
+                   symbol: str,
+                   start_date: str = None,
+                   end_date: str = None,
+                   intervals: dict = ROLLUP_INTERVALS,
+                   source_interval: str = '1m',
+                   overwrite: bool = False,
+                  ) -> List[str]:
+    """
+    Bring the stored rollups up to date with the stored 1m klines. Months with a day whose 1m partition is newer
+    than the month's rollups are rebuilt, e.g. after ingest_daily_klines wrote or re-wrote a day.
+
+    Args:
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        start_date: First day to update (YYYY-MM-DD). Defaults to the first stored day.
+        end_date: Last day to update (YYYY-MM-DD). Defaults to the last stored day.
+        intervals: Levels to build, interval name to minutes, in increasing order
+        source_interval: Interval of the stored klines the pyramid is built from
+        overwrite: Rebuild every month in the range
+
+    Returns:
+        List of months (YYYY-MM) that were rebuilt by this call
+    """
+    _check_intervals(intervals)
+    stored_dates = get_stored_dates(store_dir, trading_type, symbol, source_interval)
+    months = sorted({date_str[:7] for date_str in stored_dates
+                     if (start_date is None or date_str >= start_date) and (end_date is None or date_str <= end_date)})
+
+    rebuilt = []
+    for month in months:
+        # A month is always rebuilt whole, including its days outside [start_date, end_date]
+        month_dates = [date_str for date_str in stored_dates if date_str[:7] == month]
+        source_mtime = max(get_partition_path(store_dir, trading_type, symbol, source_interval, date_str).stat().st_mtime for date_str in month_dates)
+        rollup_paths = {interval: get_rollup_partition_path(store_dir, trading_type, symbol, interval, month) for interval in intervals}
+        if not overwrite and all(path.exists() and path.stat().st_mtime >= source_mtime for path in rollup_paths.values()):
+            continue
+
+        try:
+            df = load_klines(store_dir, trading_type, symbol, source_interval, month_dates[0], month_dates[-1])
+        except Exception as e:
+            print(f"Exception rolling up {symbol} {source_interval} klines of {month}: {e}")
+            continue
+        for interval, level_df in build_rollup_pyramid(df, intervals).items():
+            write_partition(level_df, rollup_paths[interval])
+        rebuilt.append(month)
+
+    return rebuilt
+
+def load_rollup(store_dir,
+                trading_type: str,
+                symbol: str,
+                interval: str,
+                start_date: str,
+                end_date: str,
+                columns: list = None,
+               ) -> pd.DataFrame:
+    """
+    Load the bars of one level of the stored rollups that open between start_date and end_date (inclusive)
+
+    Args:
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Level to load, e.g. '1h'
+        start_date: First day to load (YYYY-MM-DD)
+        end_date: Last day to load (YYYY-MM-DD)
+        columns: Columns to read. Defaults to all kline columns.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    read_columns = None if columns is None else ['open_time'] + [column for column in columns if column != 'open_time']
+    tables = []
+    for month in pd.period_range(start=start_date[:7], end=end_date[:7], freq='M').strftime('%Y-%m'):
+        path = get_rollup_partition_path(store_dir, trading_type, symbol, interval, month)
+        if path.exists():
+            tables.append(pq.ParquetFile(path, memory_map=True).read(columns=read_columns))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns or KLINE_COLUMNS)
+
+    df = pa.concat_tables(tables).combine_chunks().to_pandas(split_blocks=True, self_destruct=True)
+    index = KlineRangeIndex(df)
+    end_time = int((pd.Timestamp(end_date) + pd.Timedelta(days=1)).value // 10**6)
+    return index.slice(int(pd.Timestamp(start_date).value // 10**6), end_time, columns=columns).reset_index(drop=True)
+
+class RollupPyramid:
+    """
+    Rollup levels of a 1m kline history, kept up to date as new minutes arrive. Bars of days before the current
+    day are final. The 1m klines of the current day are kept, and the current day's bars of every level are
+    recomputed from them on update, so a forming minute or bar can be replaced until its day is over.
+
+    Args:
+        intervals: Levels to keep, interval name to minutes, in increasing order
+
+    Attributes:
+        day_klines: 1m klines of the latest day seen
+    """
+    def __init__(self, intervals: dict = ROLLUP_INTERVALS):
+        _check_intervals(intervals)
+        self.intervals = intervals
+        self._top_ms = list(intervals.values())[-1] * MS_PER_MINUTE
+        self._final_levels = {interval: [] for interval in intervals}
+        # Last close_time covered by the final levels
+        self._final_end = None
+        self._day_levels = None
+        self.day_klines = None
+
+    @classmethod
+    def from_store(cls, store_dir, trading_type: str, symbol: str, start_date: str, end_date: str, intervals: dict = ROLLUP_INTERVALS) -> 'RollupPyramid':
+        """
+        Pyramid initialized with the stored rollups of [start_date, end_date], which are final. Run update_rollups first.
+        """
+        pyramid = cls(intervals)
+        for interval in intervals:
+            pyramid._final_levels[interval].append(load_rollup(store_dir, trading_type, symbol, interval, start_date, end_date))
+        top_df = pyramid._final_levels[list(intervals)[-1]][0]
+        if len(top_df) > 0:
+            pyramid._final_end = int(top_df['close_time'].iloc[-1])
+        return pyramid
+
+    def update(self, df: pd.DataFrame) -> None:
+        """
+        Add new 1m klines, e.g. from RealtimeKlineTail.to_frame(). Klines with the open_time of one already seen in
+        the current day replace it. Klines of days that are final already are ignored.
+
+        Args:
+            df: 1m klines sorted by open_time
+        """
+        if self._final_end is not None:
+            stale = df['open_time'].to_numpy() <= self._final_end
+            if stale.any():
+                df = df[~stale]
+        if len(df) == 0:
+            return
+        df = df.reset_index(drop=True) if self.day_klines is None else merge_klines(self.day_klines, df)
+
+        # Minutes of days before the last one are final
+        open_times = df['open_time'].to_numpy()
+        last_day_start = int(open_times[-1]) - int(open_times[-1]) % self._top_ms
+        cut = int(np.searchsorted(open_times, last_day_start, side='left'))
+        if cut > 0:
+            for interval, level_df in build_rollup_pyramid(df.iloc[:cut], self.intervals).items():
+                self._final_levels[interval].append(level_df)
+            self._final_end = last_day_start - 1
+        self.day_klines = df.iloc[cut:].reset_index(drop=True)
+        self._day_levels = build_rollup_pyramid(self.day_klines, self.intervals)
+
+    def to_frame(self, interval: str, include_partial: bool = True) -> pd.DataFrame:
+        """
+        Bars of one level, oldest first
+
+        Args:
+            interval: Level to return, e.g. '1h'
+            include_partial: Include the last bar if it does not cover its whole interval yet
+        """
+        # Completed days are concatenated once, so later calls only add the current day's bars
+        final_frames = [frame for frame in self._final_levels[interval] if len(frame) > 0]
+        if len(final_frames) > 1:
+            final_frames = [pd.concat(final_frames, axis=0, ignore_index=True)]
+        self._final_levels[interval] = final_frames
+
+        day_df = None if self._day_levels is None else self._day_levels[interval]
+        if day_df is not None and len(day_df) > 0 and not include_partial:
+            if int(day_df['close_time'].iloc[-1]) > int(self.day_klines['close_time'].iloc[-1]):
+                day_df = day_df.iloc[:-1]
+        frames = final_frames + ([day_df] if day_df is not None and len(day_df) > 0 else [])
+        if len(frames) == 0:
+            return pd.DataFrame(columns=KLINE_COLUMNS)
+        return pd.concat(frames, axis=0, ignore_index=True)
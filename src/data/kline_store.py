@@ -0,0 +1,245 @@
+"""
+  Columnar on-disk store for Binance klines.
+  Each downloaded daily zip is parsed once into a typed Parquet partition laid out as
+  <store_dir>/<trading_type>/<SYMBOL>/<interval>/<YYYY-MM-DD>.parquet
+  so that later loads are column reads instead of re-parsing zipped CSVs.
+"""
+import os
+import tempfile
+import pandas as pd
+from pathlib import Path
+from typing import List, TYPE_CHECKING
+
+# pyarrow is imported where it is used so that importing the downloader stays cheap
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+# Reference: https://github.com/binance/binance-public-data/tree/master
+KLINE_COLUMNS = ['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore']
+INT_COLUMNS = ['open_time', 'close_time', 'num_trades']
+
+
+def get_kline_dtypes(float_dtype: str = 'float64') -> dict:
+    """
+    Column dtypes used for stored klines. Times and trade counts are int64, everything else float_dtype.
+
+    Args:
+        float_dtype: dtype of price and volume columns ('float64' or 'float32')
+    """
+    return {column: ('int64' if column in INT_COLUMNS else float_dtype) for column in KLINE_COLUMNS}
+
+def get_partition_dir(store_dir, trading_type: str, symbol: str, interval: str) -> Path:
+    return Path(store_dir) / trading_type / symbol.upper() / interval
+
+def get_partition_path(store_dir, trading_type: str, symbol: str, interval: str, date_str: str) -> Path:
+    return get_partition_dir(store_dir, trading_type, symbol, interval) / f"{date_str}.parquet"
+
+def read_kline_zip(zip_path, float_dtype: str = 'float64') -> pd.DataFrame:
+    """
+    Parse a zipped Binance kline CSV into a typed dataframe
+
+    Args:
+        zip_path: Path to the downloaded zip
+        float_dtype: dtype of price and volume columns
+    """
+    return pd.read_csv(zip_path, names=KLINE_COLUMNS, dtype=get_kline_dtypes(float_dtype))
+
+def write_partition(df: pd.DataFrame, path) -> None:
+    """
+    Atomically write a kline dataframe to a Parquet partition, so readers never see a half-written file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".part", dir=str(path.parent))
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def ingest_daily_klines(historical_files_dir,
+                        store_dir,
+                        trading_type: str,
+                        symbol: str,
+                        interval: str,
+                        start_date: str,
+                        end_date: str,
+                        float_dtype: str = 'float64',
+                        overwrite: bool = False,
+                       ) -> List[str]:
+    """
+    Ingest downloaded daily zips into the store. Days that already have a partition are skipped.
+
+    Args:
+        historical_files_dir: Directory containing the <SYMBOL>-<interval>-<YYYY-MM-DD>.zip files
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval, e.g. '1m'
+        start_date: First day to ingest (YYYY-MM-DD)
+        end_date: Last day to ingest (YYYY-MM-DD)
+        float_dtype: dtype of price and volume columns
+        overwrite: Re-ingest days that already have a partition
+
+    Returns:
+        List of dates that were ingested by this call
+    """
+    ingested = []
+    for ts in pd.date_range(start=start_date, end=end_date):
+        date_str = ts.strftime('%Y-%m-%d')
+        partition_path = get_partition_path(store_dir, trading_type, symbol, interval, date_str)
+        if partition_path.exists() and not overwrite:
+            continue
+
+        zip_path = Path(historical_files_dir) / f"{symbol.upper()}-{interval}-{date_str}.zip"
+        if not zip_path.exists():
+            continue
+
+        try:
+            df = read_kline_zip(zip_path, float_dtype=float_dtype)
+        except Exception as e:
+            print(f"Exception ingesting {zip_path}: {e}")
+            continue
+
+        write_partition(df, partition_path)
+        ingested.append(date_str)
+
+    return ingested
+
+def ingest_monthly_klines(monthly_files_dir,
+                          store_dir,
+                          trading_type: str,
+                          symbol: str,
+                          interval: str,
+                          start_date: str,
+                          end_date: str,
+                          float_dtype: str = 'float64',
+                          overwrite: bool = False,
+                         ) -> List[str]:
+    """
+    Ingest downloaded monthly archives into the store, split into the same daily partitions as ingest_daily_klines.
+    Months whose days in [start_date, end_date] all have partitions already are not re-read.
+
+    Args:
+        monthly_files_dir: Directory containing the <SYMBOL>-<interval>-<YYYY-MM>.zip files
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval, e.g. '1m'
+        start_date: First day to ingest (YYYY-MM-DD)
+        end_date: Last day to ingest (YYYY-MM-DD)
+        float_dtype: dtype of price and volume columns
+        overwrite: Re-ingest days that already have a partition
+
+    Returns:
+        List of dates that were ingested by this call
+    """
+    ingested = []
+    days = pd.date_range(start=start_date, end=end_date)
+    for month, month_days in pd.Series(days, index=days).groupby(days.strftime('%Y-%m')):
+        date_strs = list(month_days.dt.strftime('%Y-%m-%d'))
+        todo = [date_str for date_str in date_strs if overwrite or not get_partition_path(store_dir, trading_type, symbol, interval, date_str).exists()]
+        if len(todo) == 0:
+            continue
+
+        zip_path = Path(monthly_files_dir) / f"{symbol.upper()}-{interval}-{month}.zip"
+        if not zip_path.exists():
+            continue
+
+        try:
+            df = read_kline_zip(zip_path, float_dtype=float_dtype)
+        except Exception as e:
+            print(f"Exception ingesting {zip_path}: {e}")
+            continue
+
+        day_keys = pd.to_datetime(df['open_time'], unit='ms').dt.strftime('%Y-%m-%d')
+        for date_str, day_df in df.groupby(day_keys.values, sort=True):
+            if date_str in todo:
+                write_partition(day_df.reset_index(drop=True), get_partition_path(store_dir, trading_type, symbol, interval, date_str))
+                ingested.append(date_str)
+
+    return ingested
+
+def get_stored_dates(store_dir, trading_type: str, symbol: str, interval: str) -> List[str]:
+    """
+    Sorted list of dates that have a partition in the store
+    """
+    partition_dir = get_partition_dir(store_dir, trading_type, symbol, interval)
+    if not partition_dir.exists():
+        return []
+    return sorted(path.stem for path in partition_dir.glob('*.parquet'))
+
+def get_missing_dates(store_dir, trading_type: str, symbol: str, interval: str, start_date: str, end_date: str) -> List[str]:
+    """
+    Dates between start_date and end_date (inclusive) that have no partition in the store
+    """
+    return [ts.strftime('%Y-%m-%d') for ts in pd.date_range(start=start_date, end=end_date)
+            if not get_partition_path(store_dir, trading_type, symbol, interval, ts.strftime('%Y-%m-%d')).exists()]
+
+def load_klines_table(store_dir,
+                      trading_type: str,
+                      symbol: str,
+                      interval: str,
+                      start_date: str,
+                      end_date: str,
+                      columns: list = None,
+                      warn_missing: bool = True,
+                     ) -> 'pa.Table':
+    """
+    Load stored klines between start_date and end_date (inclusive) as an Arrow table.
+    Partitions are memory-mapped and only the requested columns are read. Missing days are skipped and reported,
+    see get_missing_dates to handle them.
+
+    Args:
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval, e.g. '1m'
+        start_date: First day to load (YYYY-MM-DD)
+        end_date: Last day to load (YYYY-MM-DD)
+        columns: Columns to read. Defaults to all kline columns.
+        warn_missing: Whether to print the days without a partition
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    missing_dates = []
+    for ts in pd.date_range(start=start_date, end=end_date):
+        partition_path = get_partition_path(store_dir, trading_type, symbol, interval, ts.strftime('%Y-%m-%d'))
+        if partition_path.exists():
+            # ParquetFile.read skips the dataset discovery that read_table does for every file
+            tables.append(pq.ParquetFile(partition_path, memory_map=True).read(columns=columns))
+        else:
+            missing_dates.append(ts.strftime('%Y-%m-%d'))
+
+    if warn_missing and len(missing_dates) > 0:
+        print(f"Missing {len(missing_dates)} day(s) of {symbol} {interval} klines in {store_dir}: {', '.join(missing_dates)}")
+
+    if len(tables) == 0:
+        schema = pa.schema([(column, pa.from_numpy_dtype(get_kline_dtypes()[column])) for column in (columns or KLINE_COLUMNS)])
+        return schema.empty_table()
+
+    return pa.concat_tables(tables)
+
+def load_klines(store_dir,
+                trading_type: str,
+                symbol: str,
+                interval: str,
+                start_date: str,
+                end_date: str,
+                columns: list = None,
+                warn_missing: bool = True,
+               ) -> pd.DataFrame:
+    """
+    Load stored klines between start_date and end_date (inclusive) as a dataframe. See load_klines_table.
+    """
+    table = load_klines_table(store_dir, trading_type, symbol, interval, start_date, end_date, columns=columns, warn_missing=warn_missing)
+    # Combining chunks first lets each column be handed to pandas as a single block
+    return table.combine_chunks().to_pandas(split_blocks=True, self_destruct=True)
@@ -0,0 +1,176 @@
+"""
+  Long-lived tail of real-time klines from the Binance API.
+  Recent bars are kept in a fixed-size, array-backed ring buffer and each poll only requests bars newer
+  than the last seen close_time, instead of paging through the whole day again.
+"""
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from . import binance_downloader
+from .kline_store import KLINE_COLUMNS
+
+# Columns that the API returns as integers rather than decimal strings
+API_INT_COLUMNS = ['open_time', 'close_time', 'num_trades', 'ignore']
+# API limits max 1000 klines in response
+KLINES_LIMIT = 1000
+
+
+class RealtimeKlineTail:
+    """
+    Ring buffer of the most recent closed klines for one ticker/interval, plus the bar that is still forming.
+
+    Every row is written twice, at i and i + capacity, so the latest `size` rows are always one contiguous
+    slice of the backing array and can be handed out as a view without copying.
+
+    The tail can be shared between threads: sync, poll and to_frame run one at a time. Views returned by view
+    and column are not protected and are only safe while no other thread polls.
+
+    Args:
+        ticker: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval, e.g. '1m'
+        capacity: Number of closed klines to keep
+        client: Object with a binance.spot.Spot compatible klines method. Defaults to binance_downloader.get_binance_client()
+        clock: Function returning the current Unix time in ms, used to tell closed bars from the forming one
+    """
+    def __init__(self, ticker="BTCUSDT", interval="1m", capacity=2880, client=None, clock=None):
+        self.ticker = ticker
+        self.interval = interval
+        self.capacity = capacity
+        self.client = client
+        self.clock = clock or (lambda: int(time.time() * 1000))
+        self._buffer = np.empty((2 * capacity, len(KLINE_COLUMNS)), dtype=np.float64)
+        self._next = 0
+        self.size = 0
+        self.partial = None
+        self.last_close_time = None
+        self.gaps = []
+        self._close_time_idx = KLINE_COLUMNS.index('close_time')
+        self._open_time_idx = KLINE_COLUMNS.index('open_time')
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        return self.client if self.client is not None else binance_downloader.get_binance_client()
+
+    def _append(self, row):
+        self._buffer[self._next] = row
+        self._buffer[self._next + self.capacity] = row
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.last_close_time = int(row[self._close_time_idx])
+
+    def _fetch(self, start_time, end_time=None):
+        klines = []
+        while True:
+            kwargs = {'startTime': start_time, 'limit': KLINES_LIMIT}
+            if end_time is not None:
+                kwargs['endTime'] = end_time
+            new_klines = self._get_client().klines(self.ticker, self.interval, **kwargs)
+            if len(new_klines) == 0:
+                break
+            klines.extend(new_klines)
+            start_time = new_klines[-1][6] + 1
+            if len(new_klines) < KLINES_LIMIT:
+                break
+        return klines
+
+    def sync(self, last_close_time: int):
+        """
+        Align the tail with the end of the historical data. Polling continues after last_close_time,
+        bars at or before it are left to the historical data.
+        """
+        with self._lock:
+            if self.last_close_time is None or self.last_close_time < last_close_time:
+                self.last_close_time = int(last_close_time)
+
+    def poll(self) -> int:
+        """
+        Fetch bars newer than the last seen close_time. Closed bars are appended to the ring buffer,
+        the still-forming bar replaces `partial`. Gaps between consecutive bars are backfilled once and
+        recorded in `gaps` as (first missing open_time, last missing close_time) if still missing.
+
+        Returns:
+            Number of closed bars appended
+        """
+        with self._lock:
+            if self.last_close_time is None:
+                raise ValueError("sync must be called with the historical end time before polling")
+
+            try:
+                klines = self._fetch(self.last_close_time + 1)
+            except Exception as e:
+                print(f"Exception getting realtime klines from Binance API: {e}")
+                return 0
+
+            now = self.clock()
+            appended = 0
+            self.partial = None
+            for kline in klines:
+                row = np.asarray(kline[:len(KLINE_COLUMNS)], dtype=np.float64)
+                open_time = int(row[self._open_time_idx])
+                close_time = int(row[self._close_time_idx])
+                # De-duplicate the overlap with what has been seen already
+                if close_time <= self.last_close_time:
+                    continue
+                if close_time > now:
+                    self.partial = row
+                    break
+                if open_time > self.last_close_time + 1:
+                    appended += self._backfill(self.last_close_time + 1, open_time - 1)
+                self._append(row)
+                appended += 1
+
+            return appended
+
+    def _backfill(self, start_time, end_time):
+        try:
+            klines = self._fetch(start_time, end_time)
+        except Exception as e:
+            print(f"Exception backfilling realtime klines from Binance API: {e}")
+            klines = []
+
+        appended = 0
+        for kline in klines:
+            row = np.asarray(kline[:len(KLINE_COLUMNS)], dtype=np.float64)
+            if int(row[self._close_time_idx]) > self.last_close_time:
+                self._append(row)
+                appended += 1
+
+        if self.last_close_time < end_time:
+            self.gaps.append((self.last_close_time + 1, end_time))
+            print(f"Gap in {self.ticker} {self.interval} klines from {self.last_close_time + 1} to {end_time}")
+        return appended
+
+    def view(self) -> np.ndarray:
+        """
+        Closed klines in the buffer, oldest first, as a (size, len(KLINE_COLUMNS)) view into the ring buffer.
+        The view is only valid until the next poll.
+        """
+        end = self._next + self.capacity
+        return self._buffer[end - self.size:end]
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        View of a single column of the closed klines, see view
+        """
+        return self.view()[:, KLINE_COLUMNS.index(name)]
+
+    def to_frame(self, after_close_time: int = None, include_partial: bool = True) -> pd.DataFrame:
+        """
+        Klines as a dataframe with the same dtypes as the raw API response after pd.to_numeric.
+
+        Args:
+            after_close_time: Only return bars with close_time after this, e.g. the historical end time
+            include_partial: Whether to include the bar that is still forming
+        """
+        with self._lock:
+            rows = self.view()
+            if after_close_time is not None:
+                close_times = rows[:, self._close_time_idx]
+                rows = rows[np.searchsorted(close_times, after_close_time, side='right'):]
+            if include_partial and self.partial is not None:
+                rows = np.vstack([rows, self.partial])
+            # Copied while the lock is held, as the buffer changes on the next poll
+            df = pd.DataFrame(rows, columns=KLINE_COLUMNS, copy=True)
+        return df.astype({column: 'int64' for column in API_INT_COLUMNS})
@@ -0,0 +1,281 @@
+"""
+  Chunked, multi-process execution of feature_pipeline_v1 for histories that do not fit in memory.
+  The time axis is split into blocks of rows. Each block is read together with the rows before it that its
+  features look back on (the halo), run through feature_pipeline_v1 in a worker process with a memory
+  ceiling, and written to its own Parquet part. Concatenating the parts gives the in-memory pipeline's output.
+"""
+import io
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import List, Tuple, TYPE_CHECKING
+
+from ..data.kline_index import load_kline_range
+from ..data.kline_store import load_klines, write_partition
+from .feature_generator import (
+    feature_pipeline_v1,
+    fit_ohe_encoder,
+    get_halo_size,
+)
+
+if TYPE_CHECKING:
+    from sklearn.preprocessing import OneHotEncoder
+
+# Klines of one symbol/interval in the kline store, as an input of feature_pipeline_v1_chunked
+KlineStoreRange = namedtuple('KlineStoreRange', ['store_dir', 'trading_type', 'symbol', 'interval', 'start_date', 'end_date'])
+
+DEFAULT_WORKER_MEMORY_MB = 2048
+# Address space feature_pipeline_v1 needs at its peak, in float64 copies of a row of features. Measured on 1m klines,
+# where chunks sized with it peak at about 80% of the worker's memory limit.
+PIPELINE_PEAK_COPIES = 4
+PART_FILE_PATTERN = re.compile(r'^part-(\d+)\.parquet$')
+# Bytes of the CSV scanned at a time for line breaks
+CSV_SCAN_BLOCK_BYTES = 64 * 1024**2
+
+
+def get_chunk_rows(memory_limit_mb: float, n_columns: int, halo: int) -> int:
+    """
+    Rows per chunk such that a chunk plus its halo fits in memory_limit_mb at the pipeline's peak
+
+    Args:
+        memory_limit_mb: Memory available to one worker
+        n_columns: Columns of the widest frame the pipeline builds, roughly raw columns + features
+        halo: Halo rows read with every chunk
+    """
+    rows = int(memory_limit_mb * 1e6 // (PIPELINE_PEAK_COPIES * 8 * n_columns)) - halo
+    if rows < 1:
+        raise ValueError(f"A memory limit of {memory_limit_mb} MB does not fit the {halo} halo rows of a chunk, raise it to at least "
+                         f"{int(np.ceil((halo + 1) * PIPELINE_PEAK_COPIES * 8 * n_columns / 1e6))} MB")
+    return rows
+
+def _read_close_times(source) -> np.ndarray:
+    if isinstance(source, KlineStoreRange):
+        return load_klines(source.store_dir, source.trading_type, source.symbol, source.interval, source.start_date, source.end_date, columns=['close_time'])['close_time'].to_numpy()
+    return pd.read_csv(source, usecols=['close_time'])['close_time'].to_numpy()
+
+def _read_open_times(source) -> np.ndarray:
+    return load_klines(source.store_dir, source.trading_type, source.symbol, source.interval, source.start_date, source.end_date, columns=['open_time'], warn_missing=False)['open_time'].to_numpy()
+
+def _read_row_offsets(path) -> np.ndarray:
+    # Byte offset of every row of the CSV after the header, followed by the end of the last row, found in one
+    # pass over the file. Rows [start, stop) are the bytes [offsets[start], offsets[stop]).
+    offsets = []
+    position = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(CSV_SCAN_BLOCK_BYTES)
+            if len(block) == 0:
+                break
+            offsets.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + position + 1)
+            position += len(block)
+            last_byte = block[-1:]
+    offsets = np.concatenate(offsets) if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+    if position > 0 and last_byte != b'\n':
+        # The last row has no line break
+        offsets = np.append(offsets, position)
+    return offsets
+
+def _read_rows(source, start: int, stop: int, time_range: tuple = None, byte_range: tuple = None) -> pd.DataFrame:
+    # Rows [start, stop) of the source, as the whole source would be read in memory. Rows of the kline store
+    # are found by time_range, the open_times of the first and last row, and rows of a CSV by byte_range, the
+    # offsets of the first row and of the end of the last one, so every chunk only reads its own bytes.
+    if isinstance(source, KlineStoreRange):
+        return load_kline_range(source.store_dir, source.trading_type, source.symbol, source.interval, time_range[0], time_range[1] + 1)
+    with open(source, 'rb') as f:
+        header = f.readline()
+        f.seek(byte_range[0])
+        rows = f.read(byte_range[1] - byte_range[0])
+    return pd.read_csv(io.BytesIO(header + rows))
+
+def _limit_worker_memory(memory_limit_mb: float) -> None:
+    # Caps the address space (not the RSS) this worker can add from now on, so a chunk that outgrows its estimate
+    # fails in the worker instead of pushing the machine into swap or the OOM killer. Allocations through Python
+    # and NumPy raise a MemoryError, but one in native code that does not check for failure can kill the worker,
+    # which breaks the whole pool. feature_pipeline_v1_chunked retries the chunks in halves in both cases.
+    try:
+        import resource
+        with open('/proc/self/status') as f:
+            vm_size_kb = next(int(line.split()[1]) for line in f if line.startswith('VmSize:'))
+        limit = vm_size_kb * 1024 + int(memory_limit_mb * 1e6)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    except Exception as e:
+        print(f"Could not set a memory limit for feature worker {os.getpid()}: {e}")
+
+def _process_chunk(source, start: int, stop: int, halo: int, time_range: tuple, byte_range: tuple, output_dir, pipeline_kwargs: dict):
+    # Features of rows [start, stop), written to a part named after start
+    chunk_start = time.time()
+    raw_df = _read_rows(source, max(start - halo, 0), stop, time_range=time_range, byte_range=byte_range)
+    df, _ = feature_pipeline_v1(raw_df, **pipeline_kwargs)
+    del raw_df
+    # Parquet would only keep the categories seen in this chunk, so ordinal columns are written as plain values
+    # and get the encoder's categories back in load_feature_parts
+    for column in df.columns[df.dtypes == 'category']:
+        df[column] = np.asarray(df[column])
+    path = Path(output_dir) / f"part-{start:012d}.parquet"
+    write_partition(df, path)
+
+    import resource
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return path, len(df), peak_rss_mb, time.time() - chunk_start
+
+def get_feature_part_paths(output_dir) -> List[Path]:
+    """
+    Parts written by feature_pipeline_v1_chunked, in row order
+    """
+    output_dir = Path(output_dir)
+    if not output_dir.exists():
+        return []
+    return sorted(path for path in output_dir.iterdir() if PART_FILE_PATTERN.match(path.name))
+
+def load_feature_parts(output_dir, columns: list = None, ohe_encoder=None, ohe_columns: list = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour']) -> pd.DataFrame:
+    """
+    Concatenate the parts written by feature_pipeline_v1_chunked into one dataframe
+
+    Args:
+        output_dir: Directory the parts were written to
+        columns: Columns to read. Defaults to all.
+        ohe_encoder: Encoder the parts were generated with. Needed to restore the categories of 'ordinal' parts.
+        ohe_columns: Columns the encoder was fitted on
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = [pq.ParquetFile(path, memory_map=True).read(columns=columns) for path in get_feature_part_paths(output_dir)]
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pa.concat_tables(tables).combine_chunks().to_pandas(split_blocks=True, self_destruct=True)
+
+    if ohe_encoder is not None:
+        for column, categories in zip(ohe_columns, ohe_encoder.categories_):
+            if column in df.columns:
+                df[column] = pd.Categorical(df[column], categories=categories)
+    return df
+
+def feature_pipeline_v1_chunked(source,
+                                output_dir,
+                                ma_window_sizes_dict: dict,
+                                lag_max_offset_period: int = 120,
+                                cols_to_remove: list = ['open_time', 'open', 'high', 'low', 'volume', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'],
+                                ohe_encoder=None,
+                                ohe_columns: list = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour'],
+                                lag_dtype=None,
+                                encoding: str = 'dense',
+                                memory_limit_mb: float = DEFAULT_WORKER_MEMORY_MB,
+                                chunk_rows: int = None,
+                                max_workers: int = None,
+                               ) -> Tuple[List[Path], 'OneHotEncoder']:
+    """
+    Run feature_pipeline_v1 over a history chunk by chunk in a process pool, streaming the result to Parquet parts.
+    Concatenated in order (see load_feature_parts), the parts are bit-identical to feature_pipeline_v1 on the whole
+    history, as every chunk is read with the halo of rows its features look back on. Moving averages are only
+    bit-identical for values with at most 8 decimals, as Binance klines have, see moving_averages.
+
+    Args:
+        source: Path to a historical klines CSV as written by generate_latest_historical_df, or a KlineStoreRange
+        output_dir: Directory to write part-<first row>.parquet files to. Parts of a previous run are removed.
+        ma_window_sizes_dict, lag_max_offset_period, cols_to_remove, ohe_columns, lag_dtype: See feature_pipeline_v1
+        ohe_encoder: Fitted one-hot encoder. If None, one is fitted on the calendar features of the whole history first,
+            as feature_pipeline_v1 would, so that every chunk is encoded with the same categories.
+        encoding: 'dense' or 'ordinal', see encode_categorical_features. Sparse columns cannot be written to Parquet.
+            Pass the returned encoder to load_feature_parts to get the categoricals of 'ordinal' parts back.
+        memory_limit_mb: Memory ceiling of each worker. Chunks are sized to fit it, and the address space a worker
+            can allocate after it starts is capped at it (on Linux). A chunk that fails with a MemoryError is retried
+            in two halves. If a worker is killed instead, the pool is recreated and every chunk that was running is
+            retried in two halves, as any of them may have outgrown the limit.
+        chunk_rows: Rows per chunk, excluding the halo. Defaults to the most that fit memory_limit_mb.
+        max_workers: Worker processes. Defaults to os.cpu_count().
+
+    Returns:
+        Paths of the parts in row order, and the one-hot encoder used
+    """
+    if encoding not in ['dense', 'ordinal']:
+        raise ValueError(f"Chunked feature generation supports the 'dense' and 'ordinal' encodings, not {encoding}")
+
+    start = time.time()
+    halo = get_halo_size(ma_window_sizes_dict, lag_max_offset_period)
+    close_times = _read_close_times(source)
+    n_rows = len(close_times)
+    open_times = _read_open_times(source) if isinstance(source, KlineStoreRange) else None
+    row_offsets = None if isinstance(source, KlineStoreRange) else _read_row_offsets(source)
+
+    if ohe_encoder is None:
+        # Rows the in-memory pipeline keeps after dropping the ones without a full history
+        ohe_encoder = fit_ohe_encoder(close_times[halo:], ohe_columns)
+    del close_times
+
+    if chunk_rows is None:
+        n_columns = 12 + len(ma_window_sizes_dict) + 2 * lag_max_offset_period + len(ohe_encoder.get_feature_names_out())
+        chunk_rows = get_chunk_rows(memory_limit_mb, n_columns, halo)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for path in get_feature_part_paths(output_dir):
+        path.unlink()
+
+    pipeline_kwargs = {
+        'ma_window_sizes_dict': ma_window_sizes_dict,
+        'lag_max_offset_period': lag_max_offset_period,
+        'cols_to_remove': cols_to_remove,
+        'ohe_encoder': ohe_encoder,
+        'ohe_columns': ohe_columns,
+        'lag_dtype': lag_dtype,
+        'encoding': encoding,
+    }
+    # The first chunk starts at row halo, the earlier rows are only ever read as its halo
+    chunks = [(chunk_start, min(chunk_start + chunk_rows, n_rows)) for chunk_start in range(halo, n_rows, chunk_rows)]
+    print(f"Generating features for {n_rows} rows in {len(chunks)} chunks of up to {chunk_rows} rows (+{halo} halo rows)")
+
+    paths = []
+    peak_rss_mb = 0.0
+    n_workers = max_workers or os.cpu_count() or 1
+
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=n_workers, initializer=_limit_worker_memory, initargs=(memory_limit_mb,))
+
+    def submit(executor, chunk):
+        first_row = max(chunk[0] - halo, 0)
+        time_range = None if open_times is None else (int(open_times[first_row]), int(open_times[chunk[1] - 1]))
+        byte_range = None if row_offsets is None else (int(row_offsets[first_row]), int(row_offsets[chunk[1]]))
+        return executor.submit(_process_chunk, source, chunk[0], chunk[1], halo, time_range, byte_range, output_dir, pipeline_kwargs)
+
+    pending = deque(chunks)
+    futures = {}
+    executor = new_executor()
+    try:
+        while len(pending) > 0 or len(futures) > 0:
+            # One chunk per worker in flight, so the chunks failed by a killed worker are the ones that were running
+            while len(pending) > 0 and len(futures) < n_workers:
+                chunk = pending.popleft()
+                futures[submit(executor, chunk)] = chunk
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # Every chunk in flight fails with the pool, and any of them may be the one that outgrew the limit
+                done, _ = wait(futures)
+                executor.shutdown(wait=True)
+                executor = new_executor()
+
+            for future in done:
+                chunk_start, chunk_stop = futures.pop(future)
+                error = future.exception()
+                if error is None:
+                    path, _, chunk_peak_rss_mb, _ = future.result()
+                    paths.append(path)
+                    peak_rss_mb = max(peak_rss_mb, chunk_peak_rss_mb)
+                    continue
+                if not isinstance(error, (MemoryError, BrokenProcessPool)) or chunk_stop - chunk_start < 2:
+                    raise error
+                middle = (chunk_start + chunk_stop) // 2
+                reason = f"exceeded {memory_limit_mb} MB" if isinstance(error, MemoryError) else "was running when a worker died"
+                print(f"Chunk [{chunk_start}, {chunk_stop}) {reason}, retrying it in two halves")
+                pending.extendleft([(middle, chunk_stop), (chunk_start, middle)])
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    print(f"Wrote {len(paths)} feature parts to {output_dir} in {time.time() - start:.1f} seconds, peak worker RSS {peak_rss_mb:.0f} MB")
+    return sorted(paths), ohe_encoder
@@ -0,0 +1,299 @@
+"""
+  Content-addressed cache of feature_pipeline_v1 outputs.
+  Entries are keyed on a fingerprint of the pipeline parameters (including the encoder's categories) and of
+  the input klines, and stored as uncompressed Arrow IPC (Feather) segments listed in a JSON file of metadata.
+  Feature columns are mostly incompressible doubles, which Arrow IPC writes about 50x faster than Parquet and
+  reads back from a memory map. When the input only has new rows appended to the klines of a cached entry,
+  the entry's features are reused and the pipeline only runs over the new rows plus the halo of rows their
+  features look back on, and only those are written as a new segment. The cache is bounded in bytes and evicts
+  the least recently used entries, with the modification times of their metadata files as the recency.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Tuple, TYPE_CHECKING
+
+from .feature_generator import feature_pipeline_v1, fit_ohe_encoder, get_halo_size
+
+if TYPE_CHECKING:
+    from sklearn.preprocessing import OneHotEncoder
+
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024**3
+# Bump when feature_pipeline_v1 changes its output, so entries written by an older version are never read
+FEATURE_CACHE_VERSION = 1
+# Prefix hits append the features of the new rows to an entry as a segment, chains longer than this are compacted
+MAX_ENTRY_SEGMENTS = 16
+
+
+def get_encoder_fingerprint(ohe_encoder) -> dict:
+    """
+    JSON-serializable description of a fitted one-hot encoder that determines the columns it produces
+    """
+    return {
+        'categories': [categories.tolist() for categories in ohe_encoder.categories_],
+        'feature_names': ohe_encoder.get_feature_names_out().tolist(),
+        'handle_unknown': ohe_encoder.handle_unknown,
+        'drop': repr(getattr(ohe_encoder, 'drop', None)),
+    }
+
+def get_row_hashes(raw_df: pd.DataFrame) -> np.ndarray:
+    """
+    One uint64 hash per row of the klines, from which the fingerprint of any prefix of rows is cheap to compute
+    """
+    return pd.util.hash_pandas_object(raw_df, index=False).to_numpy()
+
+def _hash_rows(row_hashes: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(row_hashes).tobytes()).hexdigest()
+
+class FeatureCache:
+    """
+    Size-bounded cache of processed feature frames on disk
+
+    Args:
+        cache_dir: Directory holding the entries
+        max_bytes: Total size of the entries' segments above which the least recently used ones are evicted
+    """
+    def __init__(self, cache_dir, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # Full hits read the features from the cache, prefix hits reuse an entry and run the pipeline over the new
+        # rows only, misses run the pipeline over the whole input
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        Hit and miss counters of this instance, and the size of the cache on disk
+        """
+        entries = self._entries()
+        lookups = self.hits + self.prefix_hits + self.misses
+        return {
+            'hits': self.hits,
+            'prefix_hits': self.prefix_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.prefix_hits) / lookups if lookups > 0 else float('nan'),
+            'entries': len(entries),
+            'bytes': sum(entry['bytes'] for entry in entries),
+        }
+
+    def clear(self) -> None:
+        """
+        Remove every entry
+        """
+        for entry in self._entries():
+            self._remove(entry)
+
+    def get_params_key(self, raw_df: pd.DataFrame, pipeline_kwargs: dict) -> str:
+        """
+        Fingerprint of the pipeline parameters and of the schema of the input klines
+        """
+        params = {
+            'version': FEATURE_CACHE_VERSION,
+            'schema': [[str(column), str(dtype)] for column, dtype in raw_df.dtypes.items()],
+            # Window order determines column order
+            'ma_window_sizes': [[str(name), int(size)] for name, size in pipeline_kwargs['ma_window_sizes_dict'].items()],
+            'lag_max_offset_period': int(pipeline_kwargs['lag_max_offset_period']),
+            'cols_to_remove': list(pipeline_kwargs['cols_to_remove']),
+            'ohe_columns': list(pipeline_kwargs['ohe_columns']),
+            'lag_dtype': None if pipeline_kwargs['lag_dtype'] is None else str(np.dtype(pipeline_kwargs['lag_dtype'])),
+            'encoding': pipeline_kwargs['encoding'],
+            'ohe_encoder': get_encoder_fingerprint(pipeline_kwargs['ohe_encoder']),
+        }
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _entries(self) -> list:
+        entries = []
+        for meta_path in self.cache_dir.glob('*.json'):
+            try:
+                with open(meta_path) as f:
+                    entry = json.load(f)
+                last_used = meta_path.stat().st_mtime
+                n_bytes = sum((self.cache_dir / segment).stat().st_size for segment in entry['segments'])
+            except (OSError, ValueError, KeyError):
+                continue
+            entry.update({'meta_path': meta_path, 'bytes': n_bytes, 'last_used': last_used})
+            entries.append(entry)
+        return entries
+
+    def _remove(self, entry: dict, keep_segments: list = []) -> None:
+        for path in [entry['meta_path']] + [self.cache_dir / segment for segment in entry['segments'] if segment not in keep_segments]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _to_table(self, df: pd.DataFrame):
+        import pyarrow as pa
+
+        # Parquet-style categoricals would only keep the categories present, so ordinal columns are stored as plain
+        # values and get the encoder's categories back in _to_frame
+        for column in df.columns[df.dtypes == 'category']:
+            df = df.assign(**{column: np.asarray(df[column])})
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    def _to_frame(self, table, encoding: str, ohe_encoder, ohe_columns: list) -> pd.DataFrame:
+        df = table.combine_chunks().to_pandas(split_blocks=True)
+        if encoding == 'ordinal':
+            for column, categories in zip(ohe_columns, ohe_encoder.categories_):
+                df[column] = pd.Categorical(df[column], categories=categories)
+        return df
+
+    def _read_segments(self, entry: dict) -> list:
+        # Segments of the entry, or None if one has been removed since the entry was listed, e.g. by another
+        # session that extended or evicted it
+        import pyarrow.feather as feather
+
+        try:
+            tables = [feather.read_table(self.cache_dir / segment, memory_map=True) for segment in entry['segments']]
+            # Reading marks the entry as recently used
+            os.utime(entry['meta_path'])
+        except FileNotFoundError:
+            # Its other segments may be shared with the entry that replaced it, so only the metadata is removed
+            try:
+                os.remove(entry['meta_path'])
+            except FileNotFoundError:
+                pass
+            return None
+        return tables
+
+    def _write_segment(self, table, name: str) -> str:
+        import pyarrow.feather as feather
+
+        segment = f"{name}.arrow"
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{segment}.", suffix=".part", dir=str(self.cache_dir))
+        os.close(fd)
+        try:
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+            os.replace(tmp_path, self.cache_dir / segment)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return segment
+
+    def _write_entry(self, name: str, segments: list, params_key: str, input_hash: str, n_rows: int, n_feature_rows: int, encoding: str) -> None:
+        meta = {'params_key': params_key, 'input_hash': input_hash, 'n_rows': n_rows, 'n_feature_rows': n_feature_rows,
+                'encoding': encoding, 'segments': segments, 'created': time.time()}
+        # The metadata is written after its segments, so an entry is only visible once its data is complete
+        tmp_path = self.cache_dir / f".{name}.json.part"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.cache_dir / f"{name}.json")
+
+    def _evict(self, keep: str = None) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry['last_used'])
+        total_bytes = sum(entry['bytes'] for entry in entries)
+        for entry in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if entry['meta_path'].stem == keep:
+                continue
+            self._remove(entry)
+            total_bytes -= entry['bytes']
+
+    def get_features(self,
+                     raw_df: pd.DataFrame,
+                     ma_window_sizes_dict: dict,
+                     lag_max_offset_period: int = 120,
+                     cols_to_remove: list = ['open_time', 'open', 'high', 'low', 'volume', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'],
+                     ohe_encoder=None,
+                     ohe_columns: list = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour'],
+                     lag_dtype=None,
+                     encoding: str = 'dense',
+                     cacheable_rows: int = None,
+                    ) -> Tuple[pd.DataFrame, 'OneHotEncoder']:
+        """
+        feature_pipeline_v1 through the cache. The result equals feature_pipeline_v1 on raw_df, bit for bit when the
+        klines have at most 8 decimals (see moving_averages), as a reused entry's rows do not depend on the rows after them.
+
+        Args:
+            raw_df: Klines sorted by close_time
+            ma_window_sizes_dict, lag_max_offset_period, cols_to_remove, ohe_columns, lag_dtype: See feature_pipeline_v1
+            ohe_encoder: Fitted one-hot encoder. If None, one is fitted on the rows the pipeline keeps, as
+                feature_pipeline_v1 would, and becomes part of the key.
+            encoding: 'dense' or 'ordinal', see encode_categorical_features. Sparse frames are not cached.
+            cacheable_rows: Only the features of the first this many rows are written to the cache. Leaves out bars
+                that may still change, e.g. the bar that is still forming. Defaults to all rows.
+
+        Returns:
+            The processed dataframe and the one-hot encoder used
+        """
+        import pyarrow as pa
+
+        if encoding not in ['dense', 'ordinal']:
+            raise ValueError(f"The feature cache supports the 'dense' and 'ordinal' encodings, not {encoding}")
+
+        halo = get_halo_size(ma_window_sizes_dict, lag_max_offset_period)
+        if ohe_encoder is None:
+            ohe_encoder = fit_ohe_encoder(raw_df['close_time'].to_numpy()[halo:], ohe_columns)
+        pipeline_kwargs = {
+            'ma_window_sizes_dict': ma_window_sizes_dict,
+            'lag_max_offset_period': lag_max_offset_period,
+            'cols_to_remove': cols_to_remove,
+            'ohe_encoder': ohe_encoder,
+            'ohe_columns': ohe_columns,
+            'lag_dtype': lag_dtype,
+            'encoding': encoding,
+        }
+        n_rows = len(raw_df)
+        cacheable_rows = n_rows if cacheable_rows is None else min(cacheable_rows, n_rows)
+        params_key = self.get_params_key(raw_df, pipeline_kwargs)
+        row_hashes = get_row_hashes(raw_df)
+
+        # Longest cached prefix of the input. Entries of these parameters are few, and every candidate costs one
+        # hash over its prefix of row hashes.
+        match = None
+        candidates = [entry for entry in self._entries() if entry['params_key'] == params_key and entry['n_rows'] <= n_rows]
+        for entry in sorted(candidates, key=lambda entry: entry['n_rows'], reverse=True):
+            if _hash_rows(row_hashes[:entry['n_rows']]) == entry['input_hash']:
+                match = entry
+                break
+
+        cached_tables = [] if match is None else self._read_segments(match)
+        if cached_tables is None:
+            # Removed while it was being read, so the input is processed as a miss
+            match, cached_tables = None, []
+
+        if match is not None and match['n_rows'] == n_rows:
+            self.hits += 1
+            return self._to_frame(pa.concat_tables(cached_tables), encoding, ohe_encoder, ohe_columns), ohe_encoder
+
+        if match is None:
+            self.misses += 1
+            df, _ = feature_pipeline_v1(raw_df, **pipeline_kwargs)
+            new_table = self._to_table(df)
+        else:
+            self.prefix_hits += 1
+            # Rows from match['n_rows'] on, computed with the halo of rows before them
+            tail_df, _ = feature_pipeline_v1(raw_df.iloc[max(match['n_rows'] - halo, 0):].reset_index(drop=True), **pipeline_kwargs)
+            new_table = self._to_table(tail_df)
+            del tail_df
+            df = self._to_frame(pa.concat_tables(cached_tables + [new_table]), encoding, ohe_encoder, ohe_columns)
+
+        matched_rows = 0 if match is None else match['n_rows']
+        if cacheable_rows > matched_rows:
+            if cacheable_rows < n_rows:
+                # Leave out the features of the rows that may still change
+                last_close_time = raw_df['close_time'].iloc[cacheable_rows - 1]
+                new_table = new_table.slice(0, int(np.searchsorted(new_table.column('close_time').to_numpy(), last_close_time, side='right')))
+            input_hash = _hash_rows(row_hashes[:cacheable_rows])
+            name = f"{params_key[:16]}-{input_hash[:16]}"
+            segments = [] if match is None else list(match['segments'])
+            if len(segments) + 1 > MAX_ENTRY_SEGMENTS:
+                # Compact a long chain of appended segments into one
+                new_table = pa.concat_tables(cached_tables + [new_table])
+                segments = []
+            segments.append(self._write_segment(new_table, name))
+            n_feature_rows = sum(len(table) for table in cached_tables) + len(new_table) if len(segments) > 1 else len(new_table)
+            self._write_entry(name, segments, params_key, input_hash, cacheable_rows, n_feature_rows, encoding)
+            # The new entry extends the matched one, which will not be looked up again
+            if match is not None:
+                self._remove(match, keep_segments=segments)
+            self._evict(keep=name)
+        return df, ohe_encoder
@@ -1,60 +1,104 @@
+import time
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from sklearn.preprocessing import OneHotEncoder
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
 
+# sklearn takes about a second to import, so it is only imported when an encoder has to be fitted
+if TYPE_CHECKING:
+    from sklearn.preprocessing import OneHotEncoder
+
+from .moving_averages import moving_averages
 from .utilities import (
-    convert_unix_time_to_day_of_week,
-    convert_unix_time_to_hour,
-    convert_unix_time_to_hour_quarter,
-    convert_unix_time_to_human_time_string,
-    convert_unix_time_to_month,
+    convert_unix_time_array_to_day_of_week,
+    convert_unix_time_array_to_hour,
+    convert_unix_time_array_to_hour_quarter,
+    convert_unix_time_array_to_human_time_string,
+    convert_unix_time_array_to_month,
 )
 
 from ..data.binance_downloader import (
     get_realtime_klines,
     generate_latest_historical_df,
 )
+from ..data.kline_index import merge_klines
+
+# Most columns the feature generators insert one at a time into a new frame, beyond this they concatenate to keep it from fragmenting
+MAX_INSERTED_COLUMNS = 32
+
+def _new_feature_block(raw_df: pd.DataFrame, n_new_columns: int, dtype) -> Tuple[np.ndarray, list]:
+    # Column-major block for n_new_columns new features, so every row of it is one contiguous column of the
+    # dataframe. raw_df's columns of the same dtype are copied into its first rows, so that the result does not
+    # have to be concatenated and consolidated afterwards.
+    block_columns = [column for column, column_dtype in raw_df.dtypes.items() if column_dtype == dtype]
+    if len(raw_df.columns) - len(block_columns) > MAX_INSERTED_COLUMNS:
+        block_columns = []
+    block = np.empty((len(block_columns) + n_new_columns, len(raw_df)), dtype=dtype)
+    for i, column in enumerate(block_columns):
+        block[i] = raw_df[column].to_numpy()
+    return block, block_columns
+
+def _frame_from_feature_block(raw_df: pd.DataFrame, block: np.ndarray, block_columns: list, new_columns: list) -> pd.DataFrame:
+    # raw_df's columns followed by new_columns, from a block built by _new_feature_block
+    df = pd.DataFrame(block.T, columns=block_columns + new_columns, index=raw_df.index, copy=False)
+    if len(block_columns) == 0 and len(raw_df.columns) > MAX_INSERTED_COLUMNS:
+        # Inserting many columns one at a time would fragment the frame
+        return pd.concat([raw_df, df], axis=1)
+    # Put the remaining columns back in their original positions
+    block_column_set = set(block_columns)
+    for loc, column in enumerate(raw_df.columns):
+        if column not in block_column_set:
+            df.insert(loc, column, raw_df[column])
+    return df
 
-def generate_moving_average_features(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, feature: str = 'close') -> pd.DataFrame:
+def generate_moving_average_features(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, feature: str = 'close', kind: str = 'simple', weight_feature: str = 'volume') -> pd.DataFrame:
     """
     Generate moving average features
 
+    All windows are computed from one prefix-sum pass over the feature, see moving_averages.
+
     Args:
         raw_df: Original dataframe
         ma_windows_sizes_dict: Dictionary containing moving-average feature name as key, moving average window size as value
         feature: Name of feature column to compute moving average over
+        kind: 'simple', 'exponential' (span=window) or 'volume_weighted'
+        weight_feature: Column with the weights of volume-weighted averages
     """
-    df = raw_df.copy()
-    shifted_feature_series = df[feature].shift(1)
-    for new_feature_name, window_size in ma_window_sizes_dict.items():
-        # Shift 1 as we are calculating moving averages from previous values
-        df[new_feature_name] = shifted_feature_series.rolling(window_size).mean()
-    return df
+    weights = raw_df[weight_feature].to_numpy() if kind == 'volume_weighted' else None
+    block, block_columns = _new_feature_block(raw_df, len(ma_window_sizes_dict), np.dtype(np.float64))
+    # Shift 1 as we are calculating moving averages from previous values
+    moving_averages(raw_df[feature].to_numpy(), list(ma_window_sizes_dict.values()), kind=kind, weights=weights, shift=1, out=block[len(block_columns):])
+    return _frame_from_feature_block(raw_df, block, block_columns, list(ma_window_sizes_dict.keys()))
 
-def generate_lag_features(raw_df: pd.DataFrame, feature: str = 'close', max_offset_period: int = 120) -> pd.DataFrame:
+def generate_lag_features(raw_df: pd.DataFrame, feature: str = 'close', max_offset_period: int = 120, dtype=None) -> pd.DataFrame:
     """
     Generate lagged features
 
+    The lags are read off a sliding-window view of the feature column and written straight into one preallocated
+    block, which also holds raw_df's columns of the same dtype. No shifted Series are built per lag, and the result
+    is not concatenated and consolidated afterwards.
+
     Args:
         raw_df: Original dataframe
         feature: Name of feature column to compute moving average over
         max_offset_period: Number of periods to generate lagged features (e.g. 120 => features are generated for period t-1 to t-120)
+        dtype: dtype of the lagged features, e.g. 'float32'. Defaults to the dtype shift() would give.
     """
-    df = raw_df.copy()
-    columns = []
-    series = []
-    # To avoid PerformanceWarning, we use pd.concat to combine all the series
-    for offset_period in range(1, max_offset_period+1):
-        columns.append(f"{feature}_t_minus_{offset_period}")
-        series.append(df[feature].shift(offset_period))
-        # df[f"{feature}_t_minus_{offset_period}"] = df[feature].shift(offset_period)
-
-    lag_df = pd.DataFrame(pd.concat(series, axis=1))
-    lag_df.columns = columns
-    df = pd.concat([df, lag_df], axis=1)
-    
-    return df
+    values = raw_df[feature].to_numpy()
+    if dtype is None:
+        dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+    dtype = np.dtype(dtype)
+    lag_columns = [f"{feature}_t_minus_{offset_period}" for offset_period in range(1, max_offset_period+1)]
+    block, block_columns = _new_feature_block(raw_df, max_offset_period, dtype)
+
+    # Window i of the NaN-padded column holds values i-max_offset_period..i-1, so its elements in reverse order
+    # are the lags t-1..t-max_offset_period of row i. Read column-wise, each lag is a contiguous stretch of padded.
+    padded = np.full(len(values) + max_offset_period, np.nan, dtype=dtype)
+    padded[max_offset_period:] = values
+    windows = np.lib.stride_tricks.sliding_window_view(padded, max_offset_period)[:len(values)]
+    block[len(block_columns):] = windows.T[::-1]
+
+    return _frame_from_feature_block(raw_df, block, block_columns, lag_columns)
     
 def generate_time_features(raw_df: pd.DataFrame, time_column: str = 'close_time', generate_human_time: bool = False) -> pd.DataFrame:
     """
@@ -66,15 +110,111 @@ def generate_time_features(raw_df: pd.DataFrame, time_column: str = 'close_time'
         generate_human_time: Whether to generate human readable time column. Defaults to False.
     """
     df = raw_df.copy()
-    df['day_of_week'] = df[time_column].apply(convert_unix_time_to_day_of_week)
-    df['month_of_year'] = df[time_column].apply(convert_unix_time_to_month)
-    df['hr_of_day'] = df[time_column].apply(convert_unix_time_to_hour)
-    df['quarter_of_hour'] = df[time_column].apply(convert_unix_time_to_hour_quarter)
+    unix_time = df[time_column].to_numpy()
+    df['day_of_week'] = convert_unix_time_array_to_day_of_week(unix_time)
+    df['month_of_year'] = convert_unix_time_array_to_month(unix_time)
+    df['hr_of_day'] = convert_unix_time_array_to_hour(unix_time)
+    df['quarter_of_hour'] = convert_unix_time_array_to_hour_quarter(unix_time)
     if generate_human_time:
-        df['human_time'] = df[time_column].apply(convert_unix_time_to_human_time_string)
+        df['human_time'] = convert_unix_time_array_to_human_time_string(unix_time).astype(object)
     return df
 
-def feature_pipeline_v1(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, lag_max_offset_period: int = 120, cols_to_remove: list = ['open_time', 'open', 'high', 'low', 'volume', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'], ohe_encoder=None, ohe_columns=['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour']) -> Tuple[pd.DataFrame, OneHotEncoder]:
+def encode_categorical_features(raw_df: pd.DataFrame, ohe_encoder: 'OneHotEncoder', ohe_columns: list, encoding: str = 'dense') -> pd.DataFrame:
+    """
+    Encode categorical columns with a fitted one-hot encoder, whose categories are also used for the other encodings
+
+    A model has to be trained and served with the same encoding. XGBoost treats entries missing from a sparse
+    matrix as missing values rather than zeros, so a model trained on dense one-hot columns cannot take sparse ones.
+
+    Args:
+        raw_df: Original dataframe
+        ohe_encoder: Fitted one-hot encoder of ohe_columns
+        ohe_columns: Columns to encode
+        encoding: 'dense' for float64 one-hot columns, 'sparse' for one-hot columns that only store the ones (pandas
+            SparseDtype), 'ordinal' to keep ohe_columns as pandas categoricals for XGBoost's enable_categorical
+    """
+    if encoding == 'dense':
+        ohe_features = ohe_encoder.transform(raw_df[ohe_columns]).toarray()
+        ohe_df = pd.DataFrame(ohe_features, columns=ohe_encoder.get_feature_names_out())
+    elif encoding == 'sparse':
+        ohe_df = pd.DataFrame.sparse.from_spmatrix(ohe_encoder.transform(raw_df[ohe_columns]), columns=ohe_encoder.get_feature_names_out())
+    elif encoding == 'ordinal':
+        df = raw_df.copy(deep=False)
+        for column, categories in zip(ohe_columns, ohe_encoder.categories_):
+            df[column] = pd.Categorical(df[column], categories=categories)
+            unknown = df[column].isna() & raw_df[column].notna()
+            if unknown.any() and ohe_encoder.handle_unknown == 'error':
+                raise ValueError(f"Found unknown categories {sorted(raw_df.loc[unknown, column].unique())} in column {column} during transform")
+        return df
+    else:
+        raise ValueError(f"Unknown encoding {encoding}, expected 'dense', 'sparse' or 'ordinal'")
+
+    ohe_df.index = raw_df.index
+    return pd.concat([raw_df.drop(columns=ohe_columns), ohe_df], axis=1)
+
+def get_model_inputs(processed_df: pd.DataFrame) -> Tuple[object, np.ndarray]:
+    """
+    Split a feature_pipeline_v1 dataframe into model inputs X and targets y, in the form matching its encoding:
+    a dense array for 'dense', a CSR matrix for 'sparse', a dataframe with categorical columns for 'ordinal'
+
+    Args:
+        processed_df: Dataframe returned by feature_pipeline_v1, with close_time first and close last
+    """
+    y = processed_df['close'].to_numpy()
+    feature_df = processed_df.iloc[:, 1:-1]
+    dtypes = feature_df.dtypes
+    if any(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+        return feature_df, y
+    if not any(isinstance(dtype, pd.SparseDtype) for dtype in dtypes):
+        return feature_df.to_numpy(), y
+
+    import scipy.sparse
+
+    is_sparse = np.array([isinstance(dtype, pd.SparseDtype) for dtype in dtypes])
+    if not is_sparse[np.argmax(is_sparse):].all():
+        raise ValueError("Sparse columns are expected after all dense columns, as feature_pipeline_v1 orders them")
+    sparse_csr = feature_df.loc[:, is_sparse].sparse.to_coo().tocsr()
+    sparse_csr.sort_indices()
+    n_rows, n_dense = len(feature_df), int((~is_sparse).sum())
+    row_nnz = np.diff(sparse_csr.indptr)
+    if n_rows > 0 and (row_nnz == row_nnz[0]).all():
+        # One-hot rows all hold one value per encoded column, so every row of X is the same length and
+        # its arrays can be filled as 2D blocks. Dense features are stored explicitly, zeros included,
+        # so that XGBoost does not read them as missing.
+        row_length = n_dense + int(row_nnz[0])
+        data = np.empty((n_rows, row_length), dtype=np.float64)
+        data[:, :n_dense] = feature_df.loc[:, ~is_sparse].to_numpy(dtype=np.float64)
+        data[:, n_dense:] = sparse_csr.data.reshape(n_rows, -1)
+        indices = np.empty((n_rows, row_length), dtype=np.int32)
+        indices[:, :n_dense] = np.arange(n_dense, dtype=np.int32)
+        indices[:, n_dense:] = sparse_csr.indices.reshape(n_rows, -1) + n_dense
+        indptr = np.arange(n_rows + 1, dtype=np.int64) * row_length
+        X = scipy.sparse.csr_matrix((data.ravel(), indices.ravel(), indptr), shape=(n_rows, len(is_sparse)))
+    else:
+        dense_values = feature_df.loc[:, ~is_sparse].to_numpy(dtype=np.float64)
+        dense_csr = scipy.sparse.csr_matrix((dense_values.ravel(), np.tile(np.arange(n_dense, dtype=np.int32), n_rows), np.arange(n_rows + 1, dtype=np.int64) * n_dense), shape=(n_rows, n_dense))
+        X = scipy.sparse.hstack([dense_csr, sparse_csr], format='csr')
+    return X, y
+
+def get_halo_size(ma_window_sizes_dict: dict, lag_max_offset_period: int) -> int:
+    """
+    Rows before a row that its features look back on. feature_pipeline_v1 drops the first this many rows, and
+    running it on rows [start - halo, stop) gives exactly the rows [start, stop) of a run over the whole history.
+    """
+    return max(list(ma_window_sizes_dict.values()) + [lag_max_offset_period])
+
+def fit_ohe_encoder(close_times: np.ndarray, ohe_columns: list = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour']) -> 'OneHotEncoder':
+    """
+    Fit a one-hot encoder on the time features of close_times, e.g. of the rows feature_pipeline_v1 keeps, as it does
+    when no encoder is given
+    """
+    from sklearn.preprocessing import OneHotEncoder
+    time_df = generate_time_features(pd.DataFrame({'close_time': close_times}), time_column='close_time')
+    ohe_encoder = OneHotEncoder()
+    ohe_encoder.fit(time_df[ohe_columns])
+    return ohe_encoder
+
+def feature_pipeline_v1(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, lag_max_offset_period: int = 120, cols_to_remove: list = ['open_time', 'open', 'high', 'low', 'volume', 'quote_asset_volume', 'num_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'], ohe_encoder=None, ohe_columns=['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour'], lag_dtype=None, encoding: str = 'dense') -> Tuple[pd.DataFrame, 'OneHotEncoder']:
     """
     V1 feature pipeline that generates all the relevant features for training
 
@@ -85,12 +225,14 @@ def feature_pipeline_v1(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, lag_ma
         cols_to_remove: Remove these columns that are not used
         ohe_encoder: One-hot encoder can be optionally provided for transformation of feature columns to one-hot encoding. If None, a new one will be instantiated.
         ohe_columns: Columns to transform via one-hot encoding
+        lag_dtype: dtype of the lagged features, e.g. 'float32' to halve their memory. Defaults to float64.
+        encoding: How ohe_columns are encoded, see encode_categorical_features. Defaults to 'dense' one-hot columns.
 
     """
     df = raw_df.copy()
     df = generate_moving_average_features(df, ma_window_sizes_dict, feature='close')
-    df = generate_lag_features(df, feature='close', max_offset_period=lag_max_offset_period)
-    df = generate_lag_features(df, feature='volume', max_offset_period=lag_max_offset_period)
+    df = generate_lag_features(df, feature='close', max_offset_period=lag_max_offset_period, dtype=lag_dtype)
+    df = generate_lag_features(df, feature='volume', max_offset_period=lag_max_offset_period, dtype=lag_dtype)
     df = generate_time_features(df, time_column='close_time', generate_human_time=False)
     
     if len(cols_to_remove) > 0:
@@ -103,12 +245,11 @@ def feature_pipeline_v1(raw_df: pd.DataFrame, ma_window_sizes_dict: dict, lag_ma
     
     # Generate one-hot encodings for ohe_columns
     if ohe_encoder is None:
+        from sklearn.preprocessing import OneHotEncoder
         ohe_encoder = OneHotEncoder()
         ohe_encoder.fit(df[ohe_columns])
         
-    ohe_features = ohe_encoder.transform(df[ohe_columns]).toarray()
-    ohe_df = pd.DataFrame(ohe_features, columns=ohe_encoder.get_feature_names_out())
-    df = pd.concat([df.drop(columns=ohe_columns), ohe_df], axis=1)
+    df = encode_categorical_features(df, ohe_encoder, ohe_columns, encoding=encoding)
     
     # Fix order
     feature_cols = list(df.columns)
@@ -132,23 +273,54 @@ def generate_inference_df(trading_type,
                           small_historical_df_path,
                           raw_df_headers,
                           ohe_encoder,
-                          ma_window_sizes_dict
+                          ma_window_sizes_dict,
+                          kline_store_dir=None,
+                          kline_history=None,
+                          realtime_tail=None,
+                          feature_cache=None,
                          ):
-    historical_df = generate_latest_historical_df(trading_type, 
-                                                  ticker_symbol,
-                                                  interval, 
-                                                  start_date, 
-                                                  end_date, 
-                                                  historical_data_dir, 
-                                                  historical_files_dir, 
-                                                  small_historical_df_path, 
-                                                  raw_df_headers,
-                                                  write_csv=True
-                                                 )
+    if kline_history is not None:
+        # Only reads days that were not ingested on a previous call
+        historical_df = kline_history.update(trading_type,
+                                             ticker_symbol,
+                                             interval,
+                                             start_date,
+                                             end_date,
+                                             historical_data_dir,
+                                             historical_files_dir,
+                                             raw_df_headers,
+                                             kline_store_dir=kline_store_dir,
+                                            )
+    else:
+        historical_df = generate_latest_historical_df(trading_type, 
+                                                      ticker_symbol,
+                                                      interval, 
+                                                      start_date, 
+                                                      end_date, 
+                                                      historical_data_dir, 
+                                                      historical_files_dir, 
+                                                      small_historical_df_path, 
+                                                      raw_df_headers,
+                                                      write_csv=kline_store_dir is None,
+                                                      kline_store_dir=kline_store_dir,
+                                                     )
     historical_end_time = int(historical_df.iloc[-1]['close_time'])
-    realtime_klines = get_realtime_klines(start_time=historical_end_time + 1, ticker=ticker_symbol, interval=interval)
-    realtime_df = pd.DataFrame(realtime_klines, columns=raw_df_headers).apply(pd.to_numeric)
-    combined_df = pd.concat([historical_df, realtime_df], axis=0)
-    processed_df, ohe_encoder = feature_pipeline_v1(combined_df, ma_window_sizes_dict, lag_max_offset_period=120, ohe_encoder=ohe_encoder)
+    if realtime_tail is not None:
+        # Only polls for bars after the last one seen on a previous call
+        realtime_tail.sync(historical_end_time)
+        realtime_tail.poll()
+        realtime_df = realtime_tail.to_frame(after_close_time=historical_end_time)
+    else:
+        realtime_klines = get_realtime_klines(start_time=historical_end_time + 1, ticker=ticker_symbol, interval=interval)
+        realtime_df = pd.DataFrame(realtime_klines, columns=raw_df_headers).apply(pd.to_numeric)
+    # Align on open_time so that bars present in both are only counted once
+    combined_df = merge_klines(historical_df, realtime_df)
+    if feature_cache is not None:
+        # Reuses the features of the bars seen on a previous call. The bar that is still forming is not cached.
+        now = int(time.time() * 1000)
+        cacheable_rows = int(np.searchsorted(combined_df['close_time'].to_numpy(), now, side='left'))
+        processed_df, ohe_encoder = feature_cache.get_features(combined_df, ma_window_sizes_dict, lag_max_offset_period=120, ohe_encoder=ohe_encoder, cacheable_rows=cacheable_rows)
+    else:
+        processed_df, ohe_encoder = feature_pipeline_v1(combined_df, ma_window_sizes_dict, lag_max_offset_period=120, ohe_encoder=ohe_encoder)
     
     return processed_df
\ No newline at end of file
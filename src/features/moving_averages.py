@@ -0,0 +1,196 @@
+"""
+  Moving-average kernel that computes every requested window from one prefix-sum pass over a series.
+  Prefix sums are exact integers when the values are decimals with at most 8 places, as Binance prices and
+  volumes are, and compensated (double-double) sums otherwise, so that differences of long prefixes do not
+  lose precision. Results follow pandas' rolling(window).mean() on the shifted series: NaN until a full
+  window is available and for every window that contains a NaN.
+"""
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+MOVING_AVERAGE_KINDS = ['simple', 'exponential', 'volume_weighted']
+# Values that are multiples of 1e-8 are summed exactly as int64 at this scale
+FIXED_POINT_SCALE = 10**8
+
+
+def _two_sum(a, b):
+    # Knuth's branch-free TwoSum: s + err == a + b exactly
+    s = a + b
+    b_virtual = s - a
+    err = (a - (s - b_virtual)) + (b - b_virtual)
+    return s, err
+
+def compensated_cumsum(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Prefix sums of values as a double-double (hi, lo) pair, with hi[i] + lo[i] == sum(values[:i]) to about 2**-100
+    relative. Both arrays have len(values) + 1 entries and start at 0.
+
+    The series is cut into about sqrt(n) blocks that are summed side by side, so the Python loop runs
+    sqrt(n) times over vectors of sqrt(n) elements instead of once per element.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    hi = np.zeros(n + 1, dtype=np.float64)
+    lo = np.zeros(n + 1, dtype=np.float64)
+    if n == 0:
+        return hi, lo
+
+    block_size = int(np.ceil(np.sqrt(n)))
+    n_blocks = -(-n // block_size)
+    blocks = np.zeros(n_blocks * block_size, dtype=np.float64)
+    blocks[:n] = values
+    blocks = blocks.reshape(n_blocks, block_size)
+
+    # Running compensated sums within every block at once
+    block_hi = np.empty_like(blocks)
+    block_lo = np.empty_like(blocks)
+    s = np.zeros(n_blocks)
+    c = np.zeros(n_blocks)
+    for j in range(block_size):
+        s, err = _two_sum(s, blocks[:, j])
+        c += err
+        block_hi[:, j] = s
+        block_lo[:, j] = c
+
+    # Compensated offsets of the blocks
+    offset_hi = np.zeros(n_blocks)
+    offset_lo = np.zeros(n_blocks)
+    total_hi, total_lo = 0.0, 0.0
+    for r in range(n_blocks):
+        offset_hi[r], offset_lo[r] = total_hi, total_lo
+        total_hi, err = _two_sum(total_hi, s[r])
+        total_lo += err + c[r]
+
+    full_hi, err = _two_sum(offset_hi[:, None], block_hi)
+    full_lo = err + offset_lo[:, None] + block_lo
+    hi[1:] = full_hi.ravel()[:n]
+    lo[1:] = full_lo.ravel()[:n]
+    return hi, lo
+
+def _to_fixed_point(values: np.ndarray, max_window_size: int) -> np.ndarray:
+    # int64 multiples of 1e-8 if every non-NaN value is one exactly and the window sums cannot overflow, else None
+    filled = np.where(np.isnan(values), 0.0, values)
+    if not np.isfinite(filled).all():
+        return None
+    scaled = np.rint(filled * FIXED_POINT_SCALE)
+    if np.abs(scaled).max(initial=0) * max(max_window_size, 1) >= 2**62 or not np.array_equal(scaled / FIXED_POINT_SCALE, filled):
+        return None
+    return scaled.astype(np.int64)
+
+class _PrefixSums:
+    """
+    Prefix sums of one series, from which the sum over any window is two lookups
+    """
+    def __init__(self, values: np.ndarray, max_window_size: int, exact: bool = True):
+        values = np.asarray(values, dtype=np.float64)
+        self.n = len(values)
+        nan_counts = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.isnan(values), out=nan_counts[1:])
+        self.nan_counts = nan_counts
+
+        self.fixed_point = _to_fixed_point(values, max_window_size) if exact else None
+        if self.fixed_point is not None:
+            # int64 wraps on overflow, which differences of the prefix sums undo as long as the window sums fit
+            prefix = np.zeros(self.n + 1, dtype=np.int64)
+            np.cumsum(self.fixed_point, out=prefix[1:])
+            self.prefix = prefix
+        else:
+            self.hi, self.lo = compensated_cumsum(np.where(np.isnan(values), 0.0, values))
+
+    def window_sums(self, window_size: int, shift: int, divisor: float = 1.0, out: np.ndarray = None) -> np.ndarray:
+        """
+        Sum of values[t-shift-window_size+1..t-shift] for every t, divided by divisor, NaN where the window is
+        incomplete or contains a NaN
+        """
+        out = np.empty(self.n) if out is None else out
+        first = min(window_size + shift - 1, self.n)
+        out[:first] = np.nan
+        count = self.n - first
+        if count <= 0:
+            return out
+        end = slice(window_size, window_size + count)
+        start = slice(0, count)
+        if self.fixed_point is not None:
+            np.divide(self.prefix[end] - self.prefix[start], divisor * FIXED_POINT_SCALE, out=out[first:])
+        else:
+            np.divide((self.hi[end] - self.hi[start]) + (self.lo[end] - self.lo[start]), divisor, out=out[first:])
+        if self.nan_counts[-1] > 0:
+            out[first:][(self.nan_counts[end] - self.nan_counts[start]) > 0] = np.nan
+        return out
+
+def rolling_means(values: np.ndarray, window_sizes: list, shift: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """
+    Simple moving averages of values for several windows, equal to values.shift(shift).rolling(window).mean()
+    up to the last bits. With values that are exact multiples of 1e-8 the window sums are exact, so the
+    result of a row does not depend on where the series starts.
+
+    Returns:
+        Array of shape (len(window_sizes), len(values)), written to out if given
+    """
+    prefix_sums = _PrefixSums(values, max(window_sizes, default=0))
+    out = np.empty((len(window_sizes), len(values))) if out is None else out
+    for i, window_size in enumerate(window_sizes):
+        prefix_sums.window_sums(window_size, shift, divisor=window_size, out=out[i])
+    return out
+
+def rolling_weighted_means(values: np.ndarray, weights: np.ndarray, window_sizes: list, shift: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """
+    Weighted moving averages, e.g. volume-weighted prices, equal to (values * weights) and weights each
+    summed over the shifted rolling window and divided. Windows whose weights sum to 0 are NaN.
+
+    Returns:
+        Array of shape (len(window_sizes), len(values)), written to out if given
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    max_window_size = max(window_sizes, default=0)
+    # Products are not multiples of 1e-8 in general, so the numerator always uses compensated sums
+    numerator_sums = _PrefixSums(values * weights, max_window_size, exact=False)
+    weight_sums = _PrefixSums(weights, max_window_size)
+    out = np.empty((len(window_sizes), len(values))) if out is None else out
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, window_size in enumerate(window_sizes):
+            np.divide(numerator_sums.window_sums(window_size, shift), weight_sums.window_sums(window_size, shift), out=out[i])
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+def ewm_means(values: np.ndarray, window_sizes: list, shift: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """
+    Exponentially weighted moving averages with span=window and min_periods=window over the shifted series.
+    These have no prefix-sum form that stays accurate over long series, so each span is one pass of
+    pandas' compiled ewm.
+
+    Returns:
+        Array of shape (len(window_sizes), len(values)), written to out if given
+    """
+    shifted_series = pd.Series(np.asarray(values, dtype=np.float64)).shift(shift)
+    out = np.empty((len(window_sizes), len(values))) if out is None else out
+    for i, window_size in enumerate(window_sizes):
+        out[i] = shifted_series.ewm(span=window_size, min_periods=window_size).mean().to_numpy()
+    return out
+
+def moving_averages(values: np.ndarray, window_sizes: list, kind: str = 'simple', weights: np.ndarray = None, shift: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """
+    Moving averages of values for several windows at once
+
+    Args:
+        values: Series to average, e.g. close prices
+        window_sizes: Window sizes in periods
+        kind: 'simple', 'exponential' (span=window) or 'volume_weighted'
+        weights: Weights of the volume-weighted average, e.g. volumes
+        shift: Periods the series is shifted by before averaging, 1 to only average previous values
+        out: Optional float64 array of shape (len(window_sizes), len(values)) to write the averages to
+
+    Returns:
+        Array of shape (len(window_sizes), len(values))
+    """
+    if kind == 'simple':
+        return rolling_means(values, window_sizes, shift=shift, out=out)
+    if kind == 'exponential':
+        return ewm_means(values, window_sizes, shift=shift, out=out)
+    if kind == 'volume_weighted':
+        if weights is None:
+            raise ValueError("Volume-weighted moving averages need weights")
+        return rolling_weighted_means(values, weights, window_sizes, shift=shift, out=out)
+    raise ValueError(f"Unknown moving average kind {kind}, expected one of {MOVING_AVERAGE_KINDS}")
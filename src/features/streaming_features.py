@@ -0,0 +1,288 @@
+"""
+  Online feature engine for live inference.
+  Keeps just enough state to produce feature_pipeline_v1 rows one bar at a time: running window sums for every
+  moving average, ring buffers for the close and volume lags, and a precomputed one-hot table of calendar values.
+  Each new bar is O(number of moving averages + lag columns), independent of the longest window.
+"""
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+from itertools import product
+from typing import TYPE_CHECKING
+
+from .utilities import (
+    MS_PER_DAY,
+    MS_PER_HOUR,
+    MS_PER_MINUTE,
+    UNIX_EPOCH_WEEKDAY,
+    convert_unix_time_array_to_month,
+)
+
+if TYPE_CHECKING:
+    from sklearn.preprocessing import OneHotEncoder
+
+OHE_COLUMNS = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour']
+# Binance quotes prices to 8 decimals, so closes are summed exactly as integers at this scale and the
+# running sums do not drift however many bars are added and removed. Closes that are not multiples of 1e-8
+# would be rounded onto this grid and their averages would differ from feature_pipeline_v1's, so they are rejected.
+PRICE_SCALE = 10**8
+CHECKPOINT_VERSION = 1
+
+
+def get_calendar_values(close_time: int) -> tuple:
+    """
+    (day_of_week, month_of_year, hr_of_day, quarter_of_hour) of a Unix time in ms, as generate_time_features computes them
+    """
+    close_time = int(close_time)
+    month = int(convert_unix_time_array_to_month([close_time])[0])
+    return ((close_time // MS_PER_DAY + UNIX_EPOCH_WEEKDAY) % 7,
+            month,
+            close_time // MS_PER_HOUR % 24,
+            close_time // MS_PER_MINUTE % 60 // 15 + 1)
+
+def _scale_closes(closes: np.ndarray) -> np.ndarray:
+    # Closes as int64 multiples of 1e-8, raising if any is not exactly one
+    scaled_closes = np.rint(closes * PRICE_SCALE)
+    off_grid = ~(scaled_closes / PRICE_SCALE == closes)
+    if off_grid.any():
+        raise ValueError(f"Close {closes[off_grid][0]!r} is not a multiple of 1e-8, so its moving averages cannot be kept exact")
+    return scaled_closes.astype(np.int64)
+
+class StreamingFeatureEngine:
+    """
+    Stateful equivalent of feature_pipeline_v1 for a stream of closed bars.
+
+    update appends a closed bar and returns its feature row, emit returns the row of a bar without appending it,
+    e.g. for the bar that is still forming. Rows are float64 arrays in the column order of feature_pipeline_v1
+    (close_time, moving averages, close lags, volume lags, one-hot calendar columns, close), see feature_names.
+    No row is returned until as many bars have been seen as feature_pipeline_v1 drops as NaN.
+
+    Args:
+        ma_window_sizes_dict: Dictionary containing moving-average feature name as key, moving average window size as value
+        ohe_encoder: Fitted one-hot encoder of ohe_columns, as returned by feature_pipeline_v1
+        lag_max_offset_period: Number of periods to generate lagged features
+        ohe_columns: Columns the encoder was fitted on
+    """
+    def __init__(self, ma_window_sizes_dict: dict, ohe_encoder: 'OneHotEncoder', lag_max_offset_period: int = 120, ohe_columns: list = OHE_COLUMNS):
+        self.ma_window_sizes_dict = dict(ma_window_sizes_dict)
+        self.lag_max_offset_period = lag_max_offset_period
+        self.ohe_columns = list(ohe_columns)
+        self.ohe_encoder = ohe_encoder
+        self.window_sizes = list(self.ma_window_sizes_dict.values())
+        # Bars feature_pipeline_v1 needs before the first row without NaNs
+        self.warmup_size = max(self.window_sizes + [lag_max_offset_period])
+        self.capacity = self.warmup_size
+
+        self._build_ohe_table()
+        self.feature_names = (['close_time']
+                              + list(self.ma_window_sizes_dict.keys())
+                              + [f"close_t_minus_{offset}" for offset in range(1, lag_max_offset_period + 1)]
+                              + [f"volume_t_minus_{offset}" for offset in range(1, lag_max_offset_period + 1)]
+                              + self.ohe_feature_names
+                              + ['close'])
+        self.reset()
+
+    def _build_ohe_table(self):
+        # Every combination of known categories is encoded once, so a bar's encoding is a table lookup
+        categories = [list(column_categories) for column_categories in self.ohe_encoder.categories_]
+        self._category_positions = [{value: i for i, value in enumerate(column_categories)} for column_categories in categories]
+        self._category_shape = tuple(len(column_categories) for column_categories in categories)
+        combinations = pd.DataFrame(list(product(*categories)), columns=self.ohe_columns)
+        self._ohe_table = self.ohe_encoder.transform(combinations).toarray()
+        self.ohe_feature_names = list(self.ohe_encoder.get_feature_names_out())
+
+    def reset(self):
+        """
+        Drop all bars seen so far
+        """
+        # Rows are written twice, at i and i + capacity, so the latest bars are always one contiguous slice
+        self._closes = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._volumes = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._scaled_closes = np.zeros(2 * self.capacity, dtype=np.int64)
+        self._window_sums = [0] * len(self.window_sizes)
+        self._next = 0
+        self.size = 0
+        self.last_close_time = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def ready(self) -> bool:
+        return self.size >= self.warmup_size
+
+    def _encode_calendar(self, close_time: int) -> np.ndarray:
+        values = get_calendar_values(close_time)
+        try:
+            positions = tuple(column_positions[value] for column_positions, value in zip(self._category_positions, values))
+        except KeyError:
+            if getattr(self.ohe_encoder, 'handle_unknown', 'error') == 'error':
+                raise ValueError(f"Calendar values {dict(zip(self.ohe_columns, values))} of close_time {close_time} were not seen when fitting the encoder")
+            return self.ohe_encoder.transform(pd.DataFrame([values], columns=self.ohe_columns)).toarray()[0]
+        return self._ohe_table[np.ravel_multi_index(positions, self._category_shape)]
+
+    def emit(self, close_time: int, close: float) -> np.ndarray:
+        """
+        Feature row of the bar closing at close_time, built from the bars seen so far. Does not change the state.
+
+        Returns:
+            Row in feature_names order, or None if fewer than warmup_size bars have been seen
+        """
+        if not self.ready:
+            return None
+        end = self._next + self.capacity
+        lag = self.lag_max_offset_period
+        row = np.empty(len(self.feature_names), dtype=np.float64)
+        row[0] = close_time
+        i = 1
+        for window_size, window_sum in zip(self.window_sizes, self._window_sums):
+            # Exact rational mean, rounded once
+            row[i] = window_sum / (window_size * PRICE_SCALE)
+            i += 1
+        row[i:i + lag] = self._closes[end - 1:end - lag - 1:-1] if end - lag - 1 >= 0 else self._closes[end - 1::-1][:lag]
+        i += lag
+        row[i:i + lag] = self._volumes[end - 1:end - lag - 1:-1] if end - lag - 1 >= 0 else self._volumes[end - 1::-1][:lag]
+        i += lag
+        row[i:-1] = self._encode_calendar(close_time)
+        row[-1] = close
+        return row
+
+    def update(self, close_time: int, close: float, volume: float) -> np.ndarray:
+        """
+        Append a closed bar and return its feature row, see emit. Bars at or before the last close_time are ignored.
+        Raises ValueError if the close is not a multiple of 1e-8, see PRICE_SCALE.
+        """
+        if self.last_close_time is not None and close_time <= self.last_close_time:
+            return None
+        row = self.emit(close_time, close)
+        self._push(close_time, close, volume)
+        return row
+
+    def _push(self, close_time, close, volume):
+        scaled_close = round(close * PRICE_SCALE) if np.isfinite(close) else None
+        if scaled_close is None or scaled_close / PRICE_SCALE != close:
+            raise ValueError(f"Close {close!r} is not a multiple of 1e-8, so its moving averages cannot be kept exact")
+        end = self._next + self.capacity
+        for k, window_size in enumerate(self.window_sizes):
+            self._window_sums[k] += scaled_close
+            if self.size >= window_size:
+                self._window_sums[k] -= int(self._scaled_closes[end - window_size])
+        for offset in (self._next, self._next + self.capacity):
+            self._closes[offset] = close
+            self._volumes[offset] = volume
+            self._scaled_closes[offset] = scaled_close
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.last_close_time = int(close_time)
+
+    def warm_up(self, df: pd.DataFrame) -> None:
+        """
+        Replace the state with the most recent closed bars of a kline dataframe, e.g. the historical window
+        that generate_inference_df reads. Only the last `capacity` bars are used.
+
+        Args:
+            df: Klines sorted by close_time with close_time, close and volume columns
+        """
+        self.reset()
+        tail_df = df.iloc[-self.capacity:]
+        close_times = tail_df['close_time'].to_numpy(dtype=np.int64)
+        closes = tail_df['close'].to_numpy(dtype=np.float64)
+        volumes = tail_df['volume'].to_numpy(dtype=np.float64)
+        scaled_closes = _scale_closes(closes)
+        n = len(tail_df)
+        if n == 0:
+            return
+
+        for offset in (0, self.capacity):
+            self._closes[offset:offset + n] = closes
+            self._volumes[offset:offset + n] = volumes
+            self._scaled_closes[offset:offset + n] = scaled_closes
+        self._next = n % self.capacity
+        self.size = n
+        # Python ints, so sums of long windows cannot overflow
+        self._window_sums = [sum(scaled_closes[-window_size:].tolist()) for window_size in self.window_sizes]
+        self.last_close_time = int(close_times[-1])
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Append every bar of df after the last close_time and return their feature rows as a dataframe,
+        see rows_to_frame. Bars before the engine is ready are appended without a row.
+        """
+        rows = []
+        for close_time, close, volume in zip(df['close_time'].to_numpy(dtype=np.int64), df['close'].to_numpy(dtype=np.float64), df['volume'].to_numpy(dtype=np.float64)):
+            row = self.update(int(close_time), float(close), float(volume))
+            if row is not None:
+                rows.append(row)
+        return self.rows_to_frame(rows)
+
+    def rows_to_frame(self, rows: list) -> pd.DataFrame:
+        """
+        Dataframe of feature rows with the columns and dtypes of feature_pipeline_v1
+        """
+        values = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.feature_names))
+        df = pd.DataFrame(values, columns=self.feature_names)
+        df['close_time'] = df['close_time'].astype('int64')
+        return df
+
+    def get_state(self) -> dict:
+        """
+        Everything needed to resume the stream, in order, without re-reading history
+        """
+        end = self._next + self.capacity
+        return {
+            'version': CHECKPOINT_VERSION,
+            'ma_window_sizes_dict': self.ma_window_sizes_dict,
+            'lag_max_offset_period': self.lag_max_offset_period,
+            'ohe_columns': self.ohe_columns,
+            'closes': self._closes[end - self.size:end].copy(),
+            'volumes': self._volumes[end - self.size:end].copy(),
+            'window_sums': list(self._window_sums),
+            'last_close_time': self.last_close_time,
+        }
+
+    def set_state(self, state: dict) -> None:
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {state.get('version')}")
+        if (state['ma_window_sizes_dict'] != self.ma_window_sizes_dict or state['lag_max_offset_period'] != self.lag_max_offset_period
+                or state['ohe_columns'] != self.ohe_columns):
+            raise ValueError("Checkpoint was written by an engine with different feature settings")
+
+        scaled_closes = _scale_closes(state['closes'])
+        self.reset()
+        n = len(state['closes'])
+        for offset in (0, self.capacity):
+            self._closes[offset:offset + n] = state['closes']
+            self._volumes[offset:offset + n] = state['volumes']
+            self._scaled_closes[offset:offset + n] = scaled_closes
+        self._next = n % self.capacity
+        self.size = n
+        self._window_sums = list(state['window_sums'])
+        self.last_close_time = state['last_close_time']
+
+    def save_checkpoint(self, path) -> None:
+        """
+        Atomically write the state to path, so a crash mid-write leaves the previous checkpoint intact
+        """
+        path = os.fspath(path)
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".part", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self.get_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load_checkpoint(cls, path, ma_window_sizes_dict: dict, ohe_encoder: 'OneHotEncoder', lag_max_offset_period: int = 120, ohe_columns: list = OHE_COLUMNS) -> 'StreamingFeatureEngine':
+        """
+        Engine restored from a checkpoint written by save_checkpoint with the same feature settings
+        """
+        engine = cls(ma_window_sizes_dict, ohe_encoder, lag_max_offset_period=lag_max_offset_period, ohe_columns=ohe_columns)
+        with open(path, 'rb') as f:
+            engine.set_state(pickle.load(f))
+        return engine
@@ -1,5 +1,12 @@
+import numpy as np
 from datetime import datetime
 
+MS_PER_MINUTE = 60 * 1000
+MS_PER_HOUR = 60 * MS_PER_MINUTE
+MS_PER_DAY = 24 * MS_PER_HOUR
+# 1970-01-01 was a Thursday, which datetime.weekday() numbers 3
+UNIX_EPOCH_WEEKDAY = 3
+
 def convert_unix_time_to_human_time_string(unix_time: int) -> str:
     unix_time_secs = int(unix_time) / 1000
     human_time_str = datetime.utcfromtimestamp(unix_time_secs).strftime('%Y-%m-%d-%H-%M')
@@ -27,4 +34,34 @@ def convert_unix_time_to_hour_quarter(unix_time: int) -> str:
     elif minute_frac < 0.75:
         return 3
     else: 
-        return 4
\ No newline at end of file
+        return 4
+
+# Vectorized versions of the converters above. They take an array of Unix times in ms and give identical results
+# using integer arithmetic, instead of building a datetime object per value.
+def _to_unix_time_ms_array(unix_time: np.ndarray) -> np.ndarray:
+    # Truncates like int(unix_time) in the scalar converters
+    return np.asarray(unix_time).astype(np.int64)
+
+def convert_unix_time_array_to_human_time_string(unix_time: np.ndarray) -> np.ndarray:
+    minutes = _to_unix_time_ms_array(unix_time).astype('datetime64[ms]').astype('datetime64[m]')
+    human_time_str = np.datetime_as_string(minutes, unit='m')
+    if len(minutes) == 0 or minutes.min() < np.datetime64('0000-01-01T00:00') or minutes.max() > np.datetime64('9999-12-31T23:59'):
+        return np.char.replace(np.char.replace(human_time_str, 'T', '-'), ':', '-')
+    # With 4-digit years every string is 'YYYY-MM-DDTHH:MM', so 'T' and ':' are patched to '-' in place
+    human_time_str = human_time_str.astype('<U16')
+    code_points = human_time_str.view(np.uint32).reshape(-1, 16)
+    code_points[:, [10, 13]] = ord('-')
+    return human_time_str
+
+def convert_unix_time_array_to_day_of_week(unix_time: np.ndarray) -> np.ndarray:
+    return (_to_unix_time_ms_array(unix_time) // MS_PER_DAY + UNIX_EPOCH_WEEKDAY) % 7
+
+def convert_unix_time_array_to_month(unix_time: np.ndarray) -> np.ndarray:
+    months_since_epoch = _to_unix_time_ms_array(unix_time).astype('datetime64[ms]').astype('datetime64[M]').astype(np.int64)
+    return months_since_epoch % 12 + 1
+
+def convert_unix_time_array_to_hour(unix_time: np.ndarray) -> np.ndarray:
+    return _to_unix_time_ms_array(unix_time) // MS_PER_HOUR % 24
+
+def convert_unix_time_array_to_hour_quarter(unix_time: np.ndarray) -> np.ndarray:
+    return _to_unix_time_ms_array(unix_time) // MS_PER_MINUTE % 60 // 15 + 1
@@ -0,0 +1,399 @@
+"""
+  Standalone model-serving process.
+  Models are loaded once at startup and served over HTTP on localhost. Concurrent predict requests for the same
+  model are queued and micro-batched into one predict call by a worker thread per model, and request, queue and
+  predict latencies are kept for the /stats endpoint.
+
+  Run with:
+    python -m src.models.inference_server --model "XGBoost Baseline=models/xgb_baseline.pkl"
+
+  Endpoints:
+    POST /predict?model=<name>  Body: feature rows as a .npy array (Content-Type: application/x-npy), or JSON
+                                {"model": <name>, "rows": [[...], ...]}. Returns predictions in the same format.
+    GET  /stats                 Request counts, batch sizes and latency percentiles per model
+    GET  /models                Feature counts, versions and one-hot encoder categories of the loaded models, so
+                                thin clients can build features without loading the models themselves
+    GET  /health
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MODEL_REGISTRY = {
+    "XGBoost Baseline": 'models/xgb_baseline.pkl',
+}
+DEFAULT_OHE_COLUMNS = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour']
+# Rows of one predict call. Requests queued beyond it wait for the next batch.
+DEFAULT_MAX_BATCH_ROWS = 8192
+# How long a batch waits for more requests after the queue runs dry. Requests that arrive while a batch is being
+# predicted are batched anyway, so this only matters for requests that arrive at nearly the same time.
+DEFAULT_MAX_WAIT_MS = 1.0
+# Latency samples kept per series for the percentiles
+LATENCY_WINDOW = 10000
+NPY_CONTENT_TYPE = 'application/x-npy'
+_STOP = object()
+
+
+def load_model_package(model_path) -> dict:
+    """
+    Load a pickled model package with 'model' and 'ohe_encoder' entries, as saved by the training notebooks
+    """
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+def _load_pickle_source(model_path) -> tuple:
+    # Model, encoder and version of a pickled package. The version changes whenever the pickle is replaced.
+    model_package = load_model_package(model_path)
+    return model_package['model'], model_package.get('ohe_encoder'), os.stat(model_path).st_mtime_ns
+
+def _load_registry_source(registry, name: str) -> tuple:
+    # Model, encoder and version of the latest version of a registered model
+    model_package = registry.load(name)
+    return model_package['model'], model_package['ohe_encoder'], model_package['manifest']['version']
+
+def array_to_npy_bytes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def npy_bytes_to_array(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+class LatencyStats:
+    """
+    Thread-safe window of the most recent latency samples, in ms
+    """
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, ms: float) -> None:
+        with self._lock:
+            self._samples.append(ms)
+            self.count += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64)
+            count = self.count
+        if len(samples) == 0:
+            return {'count': count}
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+        return {'count': count, 'mean_ms': float(samples.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90),
+                'p99_ms': float(p99), 'max_ms': float(samples.max())}
+
+class MicroBatcher:
+    """
+    Queue of predict requests for one model, served by a worker thread that stacks the queued requests into one
+    predict call and splits the predictions back to the requests
+
+    Args:
+        predict_fn: Function from a 2D feature array to a 1D array of predictions
+        max_batch_rows: Rows of one predict call. A single larger request is predicted on its own.
+        max_wait_ms: How long to wait for more requests once the queue is empty
+    """
+    def __init__(self, predict_fn, max_batch_rows: int = DEFAULT_MAX_BATCH_ROWS, max_wait_ms: float = DEFAULT_MAX_WAIT_MS):
+        self.predict_fn = predict_fn
+        self.max_batch_rows = max_batch_rows
+        self.max_wait_ms = max_wait_ms
+        self.queue_latency = LatencyStats()
+        self.predict_latency = LatencyStats()
+        self.batch_rows = deque(maxlen=LATENCY_WINDOW)
+        self.batch_requests = deque(maxlen=LATENCY_WINDOW)
+        self._queue = queue.Queue()
+        self._pending = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, X: np.ndarray) -> Future:
+        """
+        Queue rows for prediction. The returned future resolves to their predictions.
+        """
+        future = Future()
+        self._queue.put((X, future, time.perf_counter()))
+        return future
+
+    def close(self) -> None:
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _next_batch(self) -> list:
+        item = self._pending if self._pending is not None else self._queue.get()
+        self._pending = None
+        if item is _STOP:
+            return None
+        batch = [item]
+        rows = len(item[0])
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while rows < self.max_batch_rows:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.perf_counter(), 0)) if self.max_wait_ms > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP or rows + len(item[0]) > self.max_batch_rows:
+                # Served first in the next batch
+                self._pending = item
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            for _, _, queued_at in batch:
+                self.queue_latency.record((start - queued_at) * 1000)
+            try:
+                X = batch[0][0] if len(batch) == 1 else np.concatenate([X for X, _, _ in batch], axis=0)
+                predictions = np.asarray(self.predict_fn(X))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.predict_latency.record((time.perf_counter() - start) * 1000)
+            self.batch_rows.append(len(X))
+            self.batch_requests.append(len(batch))
+
+            offset = 0
+            for X, future, _ in batch:
+                future.set_result(predictions[offset:offset + len(X)])
+                offset += len(X)
+
+    def stats(self) -> dict:
+        batch_rows = np.array(self.batch_rows)
+        batch_requests = np.array(self.batch_requests)
+        return {
+            'batches': self.predict_latency.count,
+            'mean_batch_rows': float(batch_rows.mean()) if len(batch_rows) > 0 else None,
+            'mean_batch_requests': float(batch_requests.mean()) if len(batch_requests) > 0 else None,
+            'queue_latency': self.queue_latency.summary(),
+            'predict_latency': self.predict_latency.summary(),
+        }
+
+class InferenceService:
+    """
+    Models loaded once, each behind its own MicroBatcher
+
+    Args:
+        model_registry: Dictionary of model name to pickled model package path
+        max_batch_rows, max_wait_ms: See MicroBatcher
+        registry: ModelRegistry whose models are served too, at their latest versions
+    """
+    def __init__(self, model_registry: dict = None, max_batch_rows: int = DEFAULT_MAX_BATCH_ROWS, max_wait_ms: float = DEFAULT_MAX_WAIT_MS, registry=None):
+        self.models = {}
+        self.encoders = {}
+        self.versions = {}
+        self.batchers = {}
+        self.request_latency = {}
+        sources = [(name, path, lambda path=path: _load_pickle_source(path)) for name, path in (model_registry or {}).items()]
+        if registry is not None:
+            sources += [(name, registry.get_version_dir(name), lambda name=name: _load_registry_source(registry, name)) for name in registry.list_models()]
+        for name, path, load in sources:
+            start = time.time()
+            self.models[name], self.encoders[name], self.versions[name] = load()
+            self.batchers[name] = MicroBatcher(self.models[name].predict, max_batch_rows=max_batch_rows, max_wait_ms=max_wait_ms)
+            self.request_latency[name] = LatencyStats()
+            print(f"Loaded model {name} from {path} in {time.time() - start:.2f} seconds")
+
+    def get_n_features(self, model_name: str) -> int:
+        return getattr(self.models[model_name], 'n_features_in_', None)
+
+    def get_model_info(self, model_name: str) -> dict:
+        """
+        Feature count, version and one-hot encoder categories of a served model, as listed by /models.
+        build_ohe_encoder rebuilds the encoder from them.
+        """
+        encoder = self.encoders[model_name]
+        return {
+            'n_features': self.get_n_features(model_name),
+            'version': self.versions[model_name],
+            'ohe_columns': None if encoder is None else [str(column) for column in getattr(encoder, 'feature_names_in_', DEFAULT_OHE_COLUMNS)],
+            'ohe_categories': None if encoder is None else [categories.tolist() for categories in encoder.categories_],
+            'ohe_handle_unknown': None if encoder is None else encoder.handle_unknown,
+        }
+
+    def predict(self, model_name: str, X: np.ndarray) -> np.ndarray:
+        """
+        Predictions of one model for the rows of X, batched with concurrent requests
+        """
+        if model_name not in self.models:
+            raise KeyError(f"Unknown model {model_name}, expected one of {list(self.models)}")
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        n_features = self.get_n_features(model_name)
+        # Checked per request, so a malformed request does not fail the batch it would be stacked into
+        if X.ndim != 2 or (n_features is not None and X.shape[1] != n_features):
+            raise ValueError(f"Model {model_name} expects rows of {n_features} features, got an array of shape {X.shape}")
+        if len(X) == 0:
+            return np.empty(0)
+        return self.batchers[model_name].submit(X).result()
+
+    def stats(self) -> dict:
+        return {name: {'requests': self.request_latency[name].summary(), **self.batchers[name].stats()} for name in self.models}
+
+    def close(self) -> None:
+        for batcher in self.batchers.values():
+            batcher.close()
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so thin clients reuse one connection
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, which Nagle's algorithm would hold back until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    @property
+    def service(self) -> InferenceService:
+        return self.server.service
+
+    def log_message(self, format, *args):
+        # Per-request access logs would dominate the cost of small requests, see /stats instead
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload) -> None:
+        self._send(status, json.dumps(payload).encode(), 'application/json')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/models':
+            self._send_json(200, {name: self.service.get_model_info(name) for name in self.service.models})
+        elif path == '/stats':
+            self._send_json(200, self.service.stats())
+        else:
+            self._send_json(404, {'error': f"Unknown path {path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._send_json(404, {'error': f"Unknown path {url.path}"})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        is_npy = self.headers.get('Content-Type') == NPY_CONTENT_TYPE
+        model_name = parse_qs(url.query).get('model', [None])[0]
+        try:
+            if is_npy:
+                X = npy_bytes_to_array(body)
+            else:
+                payload = json.loads(body)
+                model_name = payload.get('model', model_name)
+                X = np.array(payload['rows'], dtype=np.float64)
+            if model_name is None:
+                model_name = next(iter(self.service.models))
+            predictions = self.service.predict(model_name, X)
+        except KeyError as e:
+            self._send_json(404, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        if is_npy:
+            self._send(200, array_to_npy_bytes(predictions), NPY_CONTENT_TYPE)
+        else:
+            self._send_json(200, {'model': model_name, 'predictions': predictions.tolist()})
+        self.service.request_latency[model_name].record((time.perf_counter() - start) * 1000)
+
+def create_server(service: InferenceService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    """
+    HTTP server for a service, one thread per connection. Call serve_forever() on it, e.g. in a thread.
+    """
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+class InferenceClient:
+    """
+    Thin client of the inference server. Feature rows are sent as .npy, which is about two orders of magnitude
+    cheaper to encode and parse than JSON for a day of rows.
+
+    Args:
+        url: Base URL of the server, e.g. http://127.0.0.1:8765
+        timeout: Seconds to wait for a response
+    """
+    def __init__(self, url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout: float = 30):
+        import requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        # One keep-alive connection per client instead of a TCP handshake per request
+        self.session = requests.Session()
+
+    def predict(self, X: np.ndarray, model: str = None) -> np.ndarray:
+        """
+        Predictions of a served model for the rows of X
+        """
+        url = f"{self.url}/predict" + ("" if model is None else f"?model={quote(model)}")
+        response = self.session.post(url, data=array_to_npy_bytes(np.ascontiguousarray(X, dtype=np.float64)),
+                                     headers={'Content-Type': NPY_CONTENT_TYPE}, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Inference server returned {response.status_code}: {response.text}")
+        return npy_bytes_to_array(response.content)
+
+    def stats(self) -> dict:
+        return self.session.get(f"{self.url}/stats", timeout=self.timeout).json()
+
+    def models(self) -> dict:
+        """
+        Served models by name, see InferenceService.get_model_info
+        """
+        return self.session.get(f"{self.url}/models", timeout=self.timeout).json()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve models over HTTP with micro-batched predictions")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--model', action='append', default=[], metavar='NAME=PATH',
+                        help="Model package to serve, can be repeated. Defaults to the models of DEFAULT_MODEL_REGISTRY.")
+    parser.add_argument('--registry-dir', default=None, help="Also serve the latest version of every model in this ModelRegistry")
+    parser.add_argument('--max-batch-rows', type=int, default=DEFAULT_MAX_BATCH_ROWS)
+    parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    registry = None
+    if args.registry_dir is not None:
+        from .model_registry import ModelRegistry
+        registry = ModelRegistry(args.registry_dir)
+    if len(args.model) > 0:
+        model_registry = dict(model.split('=', 1) for model in args.model)
+    else:
+        model_registry = {} if registry is not None else DEFAULT_MODEL_REGISTRY
+    service = InferenceService(model_registry, max_batch_rows=args.max_batch_rows, max_wait_ms=args.max_wait_ms, registry=registry)
+    server = create_server(service, args.host, args.port)
+    print(f"Serving {list(service.models)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
-from sklearn.metrics import (
-    mean_squared_error,
-    mean_absolute_error,
-    mean_absolute_percentage_error,
-)
-
 def get_metrics(y_true, y_pred, print_metrics=True):
+    # Imported here as sklearn is slow to import and most importers of this package never compute metrics
+    from sklearn.metrics import (
+        mean_squared_error,
+        mean_absolute_error,
+        mean_absolute_percentage_error,
+    )
+
     mse = mean_squared_error(y_true, y_pred)
     mae = mean_absolute_error(y_true, y_pred)
     mape = mean_absolute_percentage_error(y_true, y_pred)
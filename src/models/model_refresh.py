@@ -0,0 +1,192 @@
+"""
+  Incremental refresh of a registered model from the kline store.
+  A refresh reads only the klines closed after the latest version's training window (plus the halo of rows
+  their features look back on), builds their features, and either continues boosting the latest version on
+  them ('warm_start') or refits on a sliding window of recent days ('sliding_window'). The last holdout_days are
+  held out, and the candidate is published as a new version only if its holdout metric does not regress
+  against the latest version's. Refresh time scales with the new days (or the window), not the whole history.
+  Run it after each daily ingestion, e.g. `make refresh_model`.
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from ..data.kline_index import load_kline_range
+from ..data.kline_store import get_stored_dates
+from ..features.feature_generator import feature_pipeline_v1, get_halo_size, get_model_inputs
+from .model_registry import ModelRegistry
+from .walk_forward import DEFAULT_MODEL_PARAMS
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+DEFAULT_MA_WINDOW_SIZES = {
+    'close_5m_ma': 5,
+    'close_30m_ma': 30,
+    'close_1h_ma': 60,
+    'close_4h_ma': 240,
+    'close_12h_ma': 720,
+    'close_1d_ma': 1440,
+    'close_15d_ma': 21600,
+    'close_30d_ma': 43200,
+}
+DEFAULT_LAG_MAX_OFFSET_PERIOD = 120
+
+
+def _to_unix_ms(bound) -> int:
+    # Training window bounds are close_times in ms, or dates whose whole day was trained on
+    bound = str(bound)
+    if bound.lstrip('-').isdigit():
+        return int(bound)
+    timestamp = pd.Timestamp(bound)
+    if len(bound) == 10:
+        timestamp += pd.Timedelta(days=1) - pd.Timedelta(milliseconds=1)
+    return int(timestamp.value // 10**6)
+
+def _load_features(store_dir, trading_type: str, symbol: str, interval: str, start_time: int, end_time: int,
+                   ma_window_sizes_dict: dict, lag_max_offset_period: int, ohe_encoder) -> pd.DataFrame:
+    # Features of the rows with start_time <= close_time < end_time, read with their halo
+    halo_ms = get_halo_size(ma_window_sizes_dict, lag_max_offset_period) * int(pd.Timedelta(interval).value // 10**6)
+    raw_df = load_kline_range(store_dir, trading_type, symbol, interval, start_time - halo_ms, end_time)
+    df, _ = feature_pipeline_v1(raw_df, ma_window_sizes_dict, lag_max_offset_period, ohe_encoder=ohe_encoder)
+    close_times = df['close_time'].to_numpy()
+    return df[(close_times >= start_time) & (close_times < end_time)].reset_index(drop=True)
+
+def refresh_model(registry: ModelRegistry,
+                  name: str,
+                  store_dir,
+                  trading_type: str = 'spot',
+                  symbol: str = 'BTCUSDT',
+                  interval: str = '1m',
+                  mode: str = 'warm_start',
+                  new_rounds: int = 100,
+                  window_days: float = 30,
+                  holdout_days: float = 1,
+                  metric: str = 'mean_absolute_error',
+                  tolerance: float = 0.0,
+                  train_end_time: int = None,
+                 ) -> dict:
+    """
+    Train a candidate on the klines stored since the latest version of a model and publish it if it does not regress
+
+    Args:
+        registry: Registry of the model
+        name: Model name, e.g. 'XGBoost Baseline'
+        store_dir: Root directory of the kline store
+        trading_type: Trading type, e.g. 'spot'
+        symbol: Ticker symbol, e.g. 'BTCUSDT'
+        interval: Kline interval the model was trained on, e.g. '1m'
+        mode: 'warm_start' to add new_rounds trees to the latest version, trained on the new rows only, or
+            'sliding_window' to train a new model on the last window_days
+        new_rounds: Trees added per refresh in 'warm_start' mode
+        window_days: Days trained on in 'sliding_window' mode, holdout excluded
+        holdout_days: Last days of the stored klines held out to compare the candidate with the latest version.
+            They are not trained on, so the next refresh trains on them.
+        metric: get_metrics metric compared on the holdout, lower is better
+        tolerance: Relative regression of the metric still accepted, e.g. 0.01 for 1%
+        train_end_time: Last close_time the latest version was trained on. Defaults to the end of its manifest's
+            training_window.
+
+    Returns:
+        Dictionary with whether a version was 'published', its 'version', the holdout metrics of the 'current'
+        and 'candidate' models, the rows trained on and held out, and the refresh time in 'seconds'
+    """
+    from xgboost import XGBRegressor
+    from .metrics import get_metrics
+
+    if mode not in ['warm_start', 'sliding_window']:
+        raise ValueError(f"Unknown mode {mode}, expected 'warm_start' or 'sliding_window'")
+
+    start = time.time()
+    current = registry.load(name)
+    manifest = current['manifest']
+    extra = manifest.get('extra') or {}
+    ma_window_sizes_dict = extra.get('ma_window_sizes_dict', DEFAULT_MA_WINDOW_SIZES)
+    lag_max_offset_period = extra.get('lag_max_offset_period', DEFAULT_LAG_MAX_OFFSET_PERIOD)
+    model_params = extra.get('model_params', DEFAULT_MODEL_PARAMS)
+    if current['ohe_encoder'] is None:
+        raise ValueError(f"{name} version {manifest['version']} was registered without its one-hot encoder, so new features cannot be encoded like its training data")
+    if train_end_time is None:
+        if manifest.get('training_window') is None:
+            raise ValueError(f"{name} version {manifest['version']} has no training_window, pass train_end_time")
+        train_end_time = _to_unix_ms(manifest['training_window'][1])
+
+    stored_dates = get_stored_dates(store_dir, trading_type, symbol, interval)
+    if len(stored_dates) == 0:
+        raise ValueError(f"No {symbol} {interval} klines are stored in {store_dir}")
+    end_time = _to_unix_ms(stored_dates[-1]) + 1
+    holdout_start = end_time - int(holdout_days * MS_PER_DAY)
+    result = {'published': False, 'version': manifest['version'], 'current': None, 'candidate': None, 'train_rows': 0, 'holdout_rows': 0}
+    if holdout_start <= train_end_time + 1:
+        print(f"No new {symbol} {interval} klines to refresh {name} with beyond the {holdout_days} holdout days")
+        result['seconds'] = time.time() - start
+        return result
+
+    train_start = train_end_time + 1 if mode == 'warm_start' else holdout_start - int(window_days * MS_PER_DAY)
+    df = _load_features(store_dir, trading_type, symbol, interval, train_start, end_time, ma_window_sizes_dict, lag_max_offset_period, current['ohe_encoder'])
+    feature_columns = [str(column) for column in df.columns[1:-1]]
+    if manifest.get('feature_columns') is not None and manifest['feature_columns'] != feature_columns:
+        raise ValueError(f"Features generated for the refresh do not match the feature columns of {name} version {manifest['version']}")
+    split = int(np.searchsorted(df['close_time'].to_numpy(), holdout_start, side='left'))
+    X_train, y_train = get_model_inputs(df.iloc[:split])
+    X_holdout, y_holdout = get_model_inputs(df.iloc[split:])
+    result.update({'train_rows': len(y_train), 'holdout_rows': len(y_holdout)})
+    if len(y_train) == 0 or len(y_holdout) == 0:
+        print(f"Not enough rows to refresh {name}: {len(y_train)} to train on, {len(y_holdout)} to hold out")
+        result['seconds'] = time.time() - start
+        return result
+
+    if mode == 'warm_start':
+        candidate = XGBRegressor(**{**model_params, 'n_estimators': new_rounds})
+        candidate.fit(X_train, y_train, xgb_model=current['model'].get_booster())
+    else:
+        candidate = XGBRegressor(**model_params)
+        candidate.fit(X_train, y_train)
+
+    result['current'] = get_metrics(y_holdout, current['model'].predict(X_holdout), print_metrics=False)
+    result['candidate'] = get_metrics(y_holdout, candidate.predict(X_holdout), print_metrics=False)
+    print(f"Holdout {metric} of {name}: version {manifest['version']} {result['current'][metric]:.4f}, candidate {result['candidate'][metric]:.4f}")
+    if result['candidate'][metric] <= result['current'][metric] * (1 + tolerance):
+        # A warm-started model has also been trained on everything its base version was trained on
+        first_trained = int(df['close_time'].iloc[0])
+        if mode == 'warm_start' and manifest.get('training_window') is not None:
+            first_trained = _to_unix_ms(manifest['training_window'][0])
+        training_window = (first_trained, int(df['close_time'].iloc[split - 1]))
+        result['version'] = registry.register_model(
+            candidate, name,
+            ohe_encoder=current['ohe_encoder'],
+            ohe_columns=manifest['ohe_columns'],
+            feature_columns=feature_columns,
+            training_window=training_window,
+            metrics=result['candidate'],
+            extra={**extra, 'ma_window_sizes_dict': ma_window_sizes_dict, 'lag_max_offset_period': lag_max_offset_period,
+                   'model_params': model_params, 'refresh_mode': mode, 'refreshed_from': manifest['version']},
+        )
+        result['published'] = True
+    else:
+        print(f"Candidate regressed on {metric}, keeping version {manifest['version']} of {name}")
+
+    result['seconds'] = time.time() - start
+    print(f"Refreshed {name} on {len(y_train)} rows in {result['seconds']:.1f} seconds")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh a registered model with the klines stored since its latest version")
+    parser.add_argument('--registry-dir', required=True)
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--store-dir', required=True)
+    parser.add_argument('--trading-type', default='spot')
+    parser.add_argument('--symbol', default='BTCUSDT')
+    parser.add_argument('--interval', default='1m')
+    parser.add_argument('--mode', default='warm_start', choices=['warm_start', 'sliding_window'])
+    parser.add_argument('--new-rounds', type=int, default=100)
+    parser.add_argument('--window-days', type=float, default=30)
+    parser.add_argument('--holdout-days', type=float, default=1)
+    parser.add_argument('--tolerance', type=float, default=0.0)
+    args = parser.parse_args()
+
+    refresh_model(ModelRegistry(args.registry_dir), args.name, args.store_dir, trading_type=args.trading_type, symbol=args.symbol,
+                  interval=args.interval, mode=args.mode, new_rounds=args.new_rounds, window_days=args.window_days,
+                  holdout_days=args.holdout_days, tolerance=args.tolerance)
+
+if __name__ == '__main__':
+    main()
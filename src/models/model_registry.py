@@ -0,0 +1,218 @@
+"""
+  Versioned on-disk model registry.
+  Each version of a model is a directory <registry_dir>/<name>/<version>/ holding the booster in XGBoost's native
+  UBJSON format (model.ubj) and a manifest.json with the feature columns, one-hot encoder categories, training
+  window, metrics and library versions. Nothing is pickled, so a version loads with any XGBoost that reads UBJSON,
+  and the encoder is rebuilt from its categories. Versions are published atomically by renaming a fully written
+  directory into place. Loaded models are kept in memory, and the least recently used ones are evicted once more
+  than max_loaded_models are loaded.
+"""
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+MODEL_FILE_NAME = 'model.ubj'
+MANIFEST_FILE_NAME = 'manifest.json'
+DEFAULT_MAX_LOADED_MODELS = 4
+VERSION_PATTERN = re.compile(r'^v(\d+)$')
+
+
+def _version_name(version: int) -> str:
+    return f"v{version:04d}"
+
+def build_ohe_encoder(ohe_columns: list, categories: list, handle_unknown: str = 'error') -> 'OneHotEncoder':
+    """
+    Fitted one-hot encoder with the given categories, equivalent to the encoder they were taken from
+    """
+    import numpy as np
+    import pandas as pd
+    from sklearn.preprocessing import OneHotEncoder
+
+    categories = [np.array(column_categories) for column_categories in categories]
+    ohe_encoder = OneHotEncoder(categories=categories, handle_unknown=handle_unknown)
+    # With explicit categories, fitting only records the column names and validates one row of known values
+    ohe_encoder.fit(pd.DataFrame({column: column_categories[:1] for column, column_categories in zip(ohe_columns, categories)}))
+    return ohe_encoder
+
+class ModelRegistry:
+    """
+    Registry of versioned models on disk, with an in-memory LRU cache of loaded models
+
+    Args:
+        registry_dir: Root directory of the registry
+        max_loaded_models: Models kept loaded in memory. The least recently used one is evicted beyond it.
+    """
+    def __init__(self, registry_dir, max_loaded_models: int = DEFAULT_MAX_LOADED_MODELS):
+        self.registry_dir = Path(registry_dir)
+        self.max_loaded_models = max_loaded_models
+        self._loaded = OrderedDict()
+        # Serving threads may load models concurrently
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def list_models(self) -> List[str]:
+        """
+        Names of the registered models that have at least one version
+        """
+        if not self.registry_dir.exists():
+            return []
+        return sorted(path.name for path in self.registry_dir.iterdir() if path.is_dir() and len(self.list_versions(path.name)) > 0)
+
+    def list_versions(self, name: str) -> List[int]:
+        """
+        Published versions of a model, oldest first
+        """
+        model_dir = self.registry_dir / name
+        if not model_dir.exists():
+            return []
+        versions = [VERSION_PATTERN.match(path.name) for path in model_dir.iterdir()]
+        return sorted(int(match.group(1)) for match in versions if match is not None)
+
+    def get_latest_version(self, name: str) -> int:
+        versions = self.list_versions(name)
+        if len(versions) == 0:
+            raise KeyError(f"Model {name} is not registered in {self.registry_dir}")
+        return versions[-1]
+
+    def get_version_dir(self, name: str, version: int = None) -> Path:
+        version = self.get_latest_version(name) if version is None else version
+        return self.registry_dir / name / _version_name(version)
+
+    def get_manifest(self, name: str, version: int = None) -> dict:
+        """
+        Manifest of a version of a model. Defaults to the latest version.
+        """
+        with open(self.get_version_dir(name, version) / MANIFEST_FILE_NAME) as f:
+            return json.load(f)
+
+    def register_model(self,
+                       model,
+                       name: str,
+                       ohe_encoder=None,
+                       ohe_columns: list = ['day_of_week', 'month_of_year', 'hr_of_day', 'quarter_of_hour'],
+                       feature_columns: list = None,
+                       training_window: tuple = None,
+                       metrics: dict = None,
+                       extra: dict = None,
+                      ) -> int:
+        """
+        Publish a new version of a model
+
+        Args:
+            model: Fitted xgboost.XGBRegressor
+            name: Model name, e.g. 'XGBoost Baseline'
+            ohe_encoder: Fitted one-hot encoder of the model's features. Its categories are stored in the manifest.
+            ohe_columns: Columns the encoder was fitted on
+            feature_columns: Names of the model's input columns, in order
+            training_window: (first, last) close_time or date of the training data
+            metrics: Evaluation metrics, e.g. from get_metrics
+            extra: Any other JSON-serializable metadata
+
+        Returns:
+            The published version
+        """
+        import xgboost
+
+        model_dir = self.registry_dir / name
+        model_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            'name': name,
+            'model_class': type(model).__name__,
+            'model_file': MODEL_FILE_NAME,
+            'created': time.time(),
+            'xgboost_version': xgboost.__version__,
+            'n_features': getattr(model, 'n_features_in_', None),
+            'feature_columns': None if feature_columns is None else [str(column) for column in feature_columns],
+            'ohe_columns': None if ohe_encoder is None else list(ohe_columns),
+            'ohe_categories': None if ohe_encoder is None else [categories.tolist() for categories in ohe_encoder.categories_],
+            'ohe_handle_unknown': None if ohe_encoder is None else ohe_encoder.handle_unknown,
+            'training_window': None if training_window is None else [str(bound) for bound in training_window],
+            'metrics': None if metrics is None else {key: float(value) for key, value in metrics.items()},
+            'extra': extra,
+        }
+
+        tmp_dir = Path(tempfile.mkdtemp(prefix='.publish-', dir=str(model_dir)))
+        try:
+            model.save_model(str(tmp_dir / MODEL_FILE_NAME))
+            while True:
+                versions = self.list_versions(name)
+                version = versions[-1] + 1 if len(versions) > 0 else 1
+                manifest['version'] = version
+                with open(tmp_dir / MANIFEST_FILE_NAME, 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                try:
+                    # Readers only ever see complete versions. A concurrent publisher that took the same version
+                    # makes the rename fail, and this one retries with the next.
+                    os.rename(tmp_dir, model_dir / _version_name(version))
+                    break
+                except OSError:
+                    if not (model_dir / _version_name(version)).exists():
+                        raise
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+        print(f"Registered {name} version {version} in {model_dir}")
+        return version
+
+    def import_pickle(self, pickle_path, name: str, **kwargs) -> int:
+        """
+        Publish a pickled {'model': ..., 'ohe_encoder': ...} package, as saved by the training notebooks, as a new version.
+        kwargs are passed to register_model.
+        """
+        with open(pickle_path, 'rb') as f:
+            model_package = pickle.load(f)
+        return self.register_model(model_package['model'], name, ohe_encoder=model_package.get('ohe_encoder'), **kwargs)
+
+    def _load(self, name: str, version: int) -> dict:
+        import xgboost
+
+        version_dir = self.get_version_dir(name, version)
+        with open(version_dir / MANIFEST_FILE_NAME) as f:
+            manifest = json.load(f)
+        model = getattr(xgboost, manifest['model_class'])()
+        model.load_model(str(version_dir / manifest['model_file']))
+        ohe_encoder = None
+        if manifest['ohe_categories'] is not None:
+            ohe_encoder = build_ohe_encoder(manifest['ohe_columns'], manifest['ohe_categories'], handle_unknown=manifest['ohe_handle_unknown'])
+        return {'model': model, 'ohe_encoder': ohe_encoder, 'manifest': manifest}
+
+    def load(self, name: str, version: int = None) -> dict:
+        """
+        Load a version of a model, from memory if it was loaded before. Defaults to the latest version.
+
+        Returns:
+            Dictionary with the 'model', its 'ohe_encoder' (None if it was registered without one) and its 'manifest',
+            a superset of the pickled packages
+        """
+        version = self.get_latest_version(name) if version is None else version
+        key = (name, version)
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key]
+
+        # Loaded outside the lock so that hits on other models are not held up. Two threads loading the same
+        # version at once both load it, and the second one's copy is kept.
+        model_package = self._load(name, version)
+        with self._lock:
+            self.loads += 1
+            self._loaded[key] = model_package
+            while len(self._loaded) > self.max_loaded_models:
+                self._loaded.popitem(last=False)
+                self.evictions += 1
+            return model_package
+
+    def load_model(self, name: str, version: int = None):
+        """
+        Model of a version, see load
+        """
+        return self.load(name, version)['model']
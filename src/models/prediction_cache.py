@@ -0,0 +1,158 @@
+"""
+  In-memory store of model predictions keyed by (model id, model version, symbol, interval, close_time).
+  On each refresh only the rows whose bars have not been scored yet are predicted, and predictions of bars
+  scored before are read back. Keys of a model version are dropped as soon as a newer version of the same
+  model is used, so a retrained model never serves its predecessor's predictions.
+"""
+import threading
+import numpy as np
+from collections import namedtuple
+
+DEFAULT_MAX_ROWS_PER_KEY = 100000
+
+PredictionKey = namedtuple('PredictionKey', ['model_id', 'model_version', 'symbol', 'interval'])
+
+
+def _take_rows(X, rows: np.ndarray):
+    # Dense arrays and CSR matrices index rows directly, dataframes (the 'ordinal' encoding) positionally
+    return X.iloc[rows] if hasattr(X, 'iloc') else X[rows]
+
+class PredictionCache:
+    """
+    Cached predictions per model version, symbol and interval, stored as close_time-sorted arrays
+
+    Args:
+        max_rows_per_key: Predictions kept per key. The ones with the oldest close_times are dropped beyond it.
+
+    Attributes:
+        hits: Rows served from the cache
+        misses: Rows predicted
+    """
+    def __init__(self, max_rows_per_key: int = DEFAULT_MAX_ROWS_PER_KEY):
+        self.max_rows_per_key = max_rows_per_key
+        self._close_times = {}
+        self._predictions = {}
+        # Keyed by model_id, the version whose predictions are kept
+        self._versions = {}
+        # Shared by the sessions of the dashboard
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, model_id: str = None) -> None:
+        """
+        Drop the predictions of a model, or of every model if model_id is None
+        """
+        with self._lock:
+            for key in [key for key in self._close_times if model_id is None or key.model_id == model_id]:
+                del self._close_times[key]
+                del self._predictions[key]
+            if model_id is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(model_id, None)
+
+    def _use_version(self, key: PredictionKey) -> None:
+        # Called with the lock held
+        if self._versions.get(key.model_id, key.model_version) != key.model_version:
+            for stale_key in [stale_key for stale_key in self._close_times if stale_key.model_id == key.model_id]:
+                del self._close_times[stale_key]
+                del self._predictions[stale_key]
+        self._versions[key.model_id] = key.model_version
+
+    def get(self, key: PredictionKey, close_times: np.ndarray):
+        """
+        Cached predictions for close_times. Found and missing close_times count as hits and misses.
+
+        Returns:
+            Array of predictions (NaN where missing) and boolean mask of the close_times that were found
+        """
+        close_times = np.asarray(close_times, dtype=np.int64)
+        found = np.zeros(len(close_times), dtype=bool)
+        with self._lock:
+            self._use_version(key)
+            cached_close_times = self._close_times.get(key)
+            if cached_close_times is None or len(cached_close_times) == 0:
+                self.misses += len(close_times)
+                return np.full(len(close_times), np.nan), found
+            # Same dtype as the model's predictions, e.g. float32 for XGBoost
+            predictions = np.full(len(close_times), np.nan, dtype=self._predictions[key].dtype)
+            positions = np.searchsorted(cached_close_times, close_times)
+            in_range = positions < len(cached_close_times)
+            found[in_range] = cached_close_times[positions[in_range]] == close_times[in_range]
+            predictions[found] = self._predictions[key][positions[found]]
+            n_found = int(found.sum())
+            self.hits += n_found
+            self.misses += len(close_times) - n_found
+        return predictions, found
+
+    def put(self, key: PredictionKey, close_times: np.ndarray, predictions: np.ndarray) -> None:
+        """
+        Store predictions for close_times. Existing predictions of the same close_times are replaced.
+        """
+        close_times = np.asarray(close_times, dtype=np.int64)
+        predictions = np.asarray(predictions)
+        if len(close_times) == 0:
+            return
+        with self._lock:
+            self._use_version(key)
+            cached_close_times = self._close_times.get(key, np.empty(0, dtype=np.int64))
+            cached_predictions = self._predictions.get(key, np.empty(0, dtype=predictions.dtype))
+            if len(cached_close_times) == 0 or (close_times[0] > cached_close_times[-1] and np.all(np.diff(close_times) > 0)):
+                # New bars after every cached one, the case of each refresh
+                merged_close_times = np.concatenate([cached_close_times, close_times])
+                merged_predictions = np.concatenate([cached_predictions, predictions])
+            else:
+                # The last occurrence of a close_time wins, so new predictions replace cached ones
+                all_close_times = np.concatenate([cached_close_times, close_times])[::-1]
+                all_predictions = np.concatenate([cached_predictions, predictions])[::-1]
+                merged_close_times, first = np.unique(all_close_times, return_index=True)
+                merged_predictions = all_predictions[first]
+            self._close_times[key] = merged_close_times[-self.max_rows_per_key:]
+            self._predictions[key] = merged_predictions[-self.max_rows_per_key:]
+
+    def get_predictions(self,
+                        predict_fn,
+                        X,
+                        close_times: np.ndarray,
+                        model_id: str,
+                        model_version,
+                        symbol: str,
+                        interval: str,
+                        cacheable_until: int = None,
+                       ) -> np.ndarray:
+        """
+        Predictions for every row of X, running predict_fn only on the rows that are not cached
+
+        Args:
+            predict_fn: Function from feature rows to predictions, e.g. model.predict or InferenceClient.predict
+            X: Feature rows, as returned by get_model_inputs
+            close_times: close_time of the bar of every row
+            model_id: Name of the model, e.g. 'XGBoost Baseline'
+            model_version: Version of the model, e.g. its registry version. Predictions of other versions are dropped.
+            symbol: Ticker symbol, e.g. 'BTCUSDT'
+            interval: Kline interval, e.g. '1m'
+            cacheable_until: Only rows with close_time <= this are stored, e.g. the current time, so that the row of
+                the bar that has not closed yet is predicted on every call instead of cached
+        """
+        key = PredictionKey(model_id, model_version, symbol, interval)
+        close_times = np.asarray(close_times, dtype=np.int64)
+        predictions, found = self.get(key, close_times)
+        missing = np.flatnonzero(~found)
+        if len(missing) == 0:
+            return predictions
+
+        new_predictions = np.asarray(predict_fn(_take_rows(X, missing)))
+        predictions = predictions.astype(new_predictions.dtype)
+        predictions[missing] = new_predictions
+        cacheable = np.ones(len(missing), dtype=bool) if cacheable_until is None else close_times[missing] <= cacheable_until
+        self.put(key, close_times[missing[cacheable]], new_predictions[cacheable])
+        return predictions
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = sum(len(close_times) for close_times in self._close_times.values())
+            keys = len(self._close_times)
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / lookups if lookups > 0 else float('nan'), 'keys': keys, 'rows': rows}
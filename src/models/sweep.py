@@ -0,0 +1,231 @@
+"""
+  Hyperparameter sweeps over XGBoost models.
+  Every grid point is trained once at its largest tree count and scored at every smaller tree count with staged
+  predictions (predict with iteration_range), instead of retraining from scratch per tree count. Feature
+  configurations (moving-average windows and lags) are column subsets of one feature matrix, which is written
+  once as .npy files that the worker processes memory-map. Grid points run in a process pool with a fixed thread
+  budget per worker, and every scored tree count is one row of a SQLite results table.
+"""
+import itertools
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+from pathlib import Path
+from typing import List
+
+DEFAULT_TREE_COUNTS = [200, 400, 600, 800, 1000, 1200, 1400, 1600, 1800, 2000]
+RESULTS_TABLE = 'sweep_results'
+# Grid keys that select feature columns rather than being passed to XGBRegressor
+FEATURE_GRID_KEYS = ['ma_windows', 'lag_max_offset_period']
+LAG_COLUMN_PATTERN = re.compile(r'^(close|volume)_t_minus_(\d+)$')
+THREAD_ENV_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def expand_grid(param_grid: dict) -> List[dict]:
+    """
+    Every combination of a grid of parameter lists, e.g. {'max_depth': [4, 5], 'learning_rate': [0.1, 0.3]}
+    """
+    keys = list(param_grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(param_grid[key] for key in keys))]
+
+def staged_predictions(model, X, tree_counts: list) -> dict:
+    """
+    Predictions of the first n trees of a fitted model for every n in tree_counts, equal to the predictions of a
+    model trained with n_estimators=n when training is deterministic (no row or column subsampling)
+    """
+    return {n: model.predict(X, iteration_range=(0, n)) for n in tree_counts}
+
+def get_feature_subset(feature_columns: list, ma_columns: list, ma_windows: list = None, lag_max_offset_period: int = None) -> np.ndarray:
+    """
+    Positions of the feature columns of one feature configuration
+
+    Args:
+        feature_columns: Columns of the full feature matrix
+        ma_columns: Which of them are moving averages
+        ma_windows: Moving-average columns to keep. Defaults to all.
+        lag_max_offset_period: Lags to keep, t-1 to t-lag_max_offset_period. Defaults to all.
+    """
+    keep = []
+    for position, column in enumerate(feature_columns):
+        if ma_windows is not None and column in ma_columns and column not in ma_windows:
+            continue
+        match = LAG_COLUMN_PATTERN.match(column)
+        if lag_max_offset_period is not None and match is not None and int(match.group(2)) > lag_max_offset_period:
+            continue
+        keep.append(position)
+    return np.array(keep, dtype=np.int64)
+
+def write_sweep_dataset(train_df: pd.DataFrame, val_df: pd.DataFrame, dataset_dir, ma_columns: list = None) -> Path:
+    """
+    Write the train and validation sets of processed dataframes (close_time, features..., close, as returned by
+    feature_pipeline_v1) as .npy files for the sweep workers to memory-map. Features are stored as float32, the
+    precision XGBoost trains on, which halves the pages the workers share.
+
+    Args:
+        train_df: Processed training rows
+        val_df: Processed validation rows
+        dataset_dir: Directory to write to
+        ma_columns: Moving-average columns, selectable with 'ma_windows' in the grid. Defaults to columns ending in '_ma'.
+    """
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    feature_columns = list(train_df.columns[1:-1])
+    if ma_columns is None:
+        ma_columns = [column for column in feature_columns if column.endswith('_ma')]
+    for split, df in [('train', train_df), ('val', val_df)]:
+        np.save(dataset_dir / f"X_{split}.npy", df.iloc[:, 1:-1].to_numpy(dtype=np.float32))
+        np.save(dataset_dir / f"y_{split}.npy", df.iloc[:, -1].to_numpy(dtype=np.float64))
+    with open(dataset_dir / 'meta.json', 'w') as f:
+        json.dump({'feature_columns': feature_columns, 'ma_columns': ma_columns}, f)
+    return dataset_dir
+
+def limit_worker_threads(threads_per_worker: int) -> None:
+    """
+    Process pool initializer capping the threads of native libraries in a worker. Their thread pools size
+    themselves from these variables on first use, so workers sharing a machine do not oversubscribe its cores.
+    """
+    for variable in THREAD_ENV_VARIABLES:
+        os.environ[variable] = str(threads_per_worker)
+
+def _run_point(dataset_dir, point: dict, tree_counts: list, threads_per_worker: int, random_state: int) -> List[dict]:
+    from xgboost import XGBRegressor
+    from .metrics import get_metrics
+
+    dataset_dir = Path(dataset_dir)
+    with open(dataset_dir / 'meta.json') as f:
+        meta = json.load(f)
+    columns = get_feature_subset(meta['feature_columns'], meta['ma_columns'], point.get('ma_windows'), point.get('lag_max_offset_period'))
+    # Memory-mapped, so workers share the pages of the full matrices. Only a column subset is copied.
+    X_train = np.load(dataset_dir / 'X_train.npy', mmap_mode='r')
+    X_val = np.load(dataset_dir / 'X_val.npy', mmap_mode='r')
+    if len(columns) < X_train.shape[1]:
+        X_train, X_val = X_train[:, columns], X_val[:, columns]
+    y_train = np.load(dataset_dir / 'y_train.npy')
+    y_val = np.load(dataset_dir / 'y_val.npy')
+
+    model_params = {'tree_method': 'hist', 'random_state': random_state,
+                    **{key: value for key, value in point.items() if key not in FEATURE_GRID_KEYS}}
+    model = XGBRegressor(n_estimators=max(tree_counts), n_jobs=threads_per_worker, **model_params)
+    start = time.time()
+    model.fit(X_train, y_train)
+    fit_seconds = time.time() - start
+
+    rows = []
+    start = time.time()
+    for n_estimators, predictions in staged_predictions(model, X_val, tree_counts).items():
+        metrics = get_metrics(y_val, predictions, print_metrics=False)
+        rows.append({'n_estimators': n_estimators, 'n_features': len(columns), **metrics})
+    predict_seconds = time.time() - start
+    for row in rows:
+        row.update({'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds})
+    return rows
+
+def _connect(db_path) -> sqlite3.Connection:
+    connection = sqlite3.connect(str(db_path))
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {RESULTS_TABLE} (
+            sweep_id TEXT NOT NULL,
+            point TEXT NOT NULL,
+            max_depth INTEGER,
+            learning_rate REAL,
+            lag_max_offset_period INTEGER,
+            ma_windows TEXT,
+            n_estimators INTEGER NOT NULL,
+            n_features INTEGER,
+            mean_squared_error REAL,
+            mean_absolute_error REAL,
+            mean_absolute_percentage_error REAL,
+            fit_seconds REAL,
+            predict_seconds REAL,
+            created REAL,
+            PRIMARY KEY (sweep_id, point, n_estimators)
+        )""")
+    return connection
+
+def load_sweep_results(db_path, sweep_id: str = None) -> pd.DataFrame:
+    """
+    Results of one sweep, or of every sweep in the database, one row per grid point and tree count.
+    The grid point's full parameters are in the JSON 'point' column, the common ones also have their own columns.
+    """
+    with closing(_connect(db_path)) as connection:
+        query = f"SELECT * FROM {RESULTS_TABLE}" + ("" if sweep_id is None else " WHERE sweep_id = ?")
+        return pd.read_sql_query(query, connection, params=() if sweep_id is None else (sweep_id,))
+
+def run_sweep(train_df: pd.DataFrame,
+              val_df: pd.DataFrame,
+              param_grid: dict,
+              db_path,
+              sweep_id: str,
+              tree_counts: list = DEFAULT_TREE_COUNTS,
+              ma_columns: list = None,
+              max_workers: int = None,
+              threads_per_worker: int = None,
+              dataset_dir=None,
+              random_state: int = 420,
+             ) -> pd.DataFrame:
+    """
+    Train and score every point of a parameter grid, in parallel, and record the results in a SQLite table.
+    Points already recorded for sweep_id are skipped, so an interrupted sweep resumes where it stopped.
+
+    Args:
+        train_df: Processed training rows, e.g. from feature_pipeline_v1 with every window and lag to be swept
+        val_df: Processed validation rows
+        param_grid: Lists of values per parameter. XGBRegressor parameters such as 'max_depth' and 'learning_rate',
+            plus 'ma_windows' (lists of moving-average columns to use) and 'lag_max_offset_period' (lags to use)
+        db_path: SQLite database file of the results table
+        sweep_id: Name of the sweep in the results table
+        tree_counts: Tree counts to score each point at. Each point is trained once with max(tree_counts) trees.
+        ma_columns: Moving-average columns, see write_sweep_dataset
+        max_workers: Worker processes. Defaults to os.cpu_count().
+        threads_per_worker: XGBoost threads per worker. Defaults to an even share of the cores.
+        dataset_dir: Directory for the memory-mapped train and validation sets. Defaults to a temporary directory.
+        random_state: Seed of every model
+
+    Returns:
+        Results of the sweep, see load_sweep_results
+    """
+    max_workers = max_workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // max_workers)
+    tree_counts = sorted(tree_counts)
+
+    with closing(_connect(db_path)) as connection:
+        done = {row[0] for row in connection.execute(f"SELECT DISTINCT point FROM {RESULTS_TABLE} WHERE sweep_id = ?", (sweep_id,))}
+    points = [point for point in expand_grid(param_grid) if json.dumps(point, sort_keys=True) not in done]
+    print(f"Sweep {sweep_id}: {len(points)} grid points to run, {len(done)} already recorded")
+    if len(points) == 0:
+        return load_sweep_results(db_path, sweep_id)
+
+    start = time.time()
+    with tempfile.TemporaryDirectory(prefix='sweep-') as tmp_dir:
+        dataset_dir = write_sweep_dataset(train_df, val_df, dataset_dir or tmp_dir, ma_columns=ma_columns)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_worker_threads, initargs=(threads_per_worker,)) as executor:
+            futures = {executor.submit(_run_point, dataset_dir, point, tree_counts, threads_per_worker, random_state): point for point in points}
+            for i, future in enumerate(as_completed(futures)):
+                point = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f"Grid point {point} failed: {e}")
+                    continue
+                point_key = json.dumps(point, sort_keys=True)
+                ma_windows = point.get('ma_windows')
+                # A sqlite3 connection's own context manager only commits, closing() also closes it
+                with closing(_connect(db_path)) as connection:
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO {RESULTS_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(sweep_id, point_key, point.get('max_depth'), point.get('learning_rate'), point.get('lag_max_offset_period'),
+                          None if ma_windows is None else json.dumps(list(ma_windows)), row['n_estimators'], row['n_features'],
+                          row['mean_squared_error'], row['mean_absolute_error'], row['mean_absolute_percentage_error'],
+                          row['fit_seconds'], row['predict_seconds'], time.time()) for row in rows])
+                    connection.commit()
+                print(f"[{i + 1}/{len(points)}] {point}: fit {rows[0]['fit_seconds']:.1f}s, best MAE {min(row['mean_absolute_error'] for row in rows):.4f}")
+
+    print(f"Sweep {sweep_id} finished in {time.time() - start:.1f} seconds")
+    return load_sweep_results(db_path, sweep_id)
@@ -0,0 +1,223 @@
+"""
+  Walk-forward training and evaluation over the stored history.
+  Rolling time folds (train on a window, test on the days right after it, step forward) are cut as row ranges of
+  one feature matrix built once for the whole history, so a fold's inputs are contiguous slices of shared arrays
+  instead of re-read and re-processed CSVs. Folds are trained independently in a process pool that memory-maps
+  the arrays, or sequentially, each fold continuing to boost the previous fold's model (warm start).
+  Every fold is scored with get_metrics and the P&L of the trading strategies on its test days.
+"""
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List
+
+from ..trading.strategies import generate_price_df, strategy_1, strategy_2, strategy_3, strategy_4
+from .sweep import limit_worker_threads
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+STRATEGIES = {'strategy_1': strategy_1, 'strategy_2': strategy_2, 'strategy_3': strategy_3, 'strategy_4': strategy_4}
+DEFAULT_MODEL_PARAMS = {'n_estimators': 1000, 'max_depth': 5, 'tree_method': 'hist', 'random_state': 420}
+
+# Rows [train_start, train_stop) are trained on and rows [test_start, test_stop) tested on
+Fold = namedtuple('Fold', ['fold_id', 'train_start', 'train_stop', 'test_start', 'test_stop'])
+
+
+def get_walk_forward_folds(close_times: np.ndarray,
+                           train_days: float,
+                           test_days: float = 1,
+                           step_days: float = None,
+                           expanding: bool = False,
+                          ) -> List[Fold]:
+    """
+    Rolling time folds over rows sorted by close_time. The first fold trains on the first train_days of the
+    history, and every fold tests on the test_days after its training window.
+
+    Args:
+        close_times: close_time of every row, sorted
+        train_days: Days of the training window
+        test_days: Days of the test window
+        step_days: Days between the test windows of consecutive folds. Defaults to test_days.
+        expanding: Train every fold on all rows before its test window instead of on the last train_days
+    """
+    close_times = np.asarray(close_times)
+    step_days = test_days if step_days is None else step_days
+    folds = []
+    if len(close_times) == 0:
+        return folds
+    test_start_time = int(close_times[0]) + int(train_days * MS_PER_DAY)
+    while test_start_time <= close_times[-1]:
+        test_stop_time = test_start_time + int(test_days * MS_PER_DAY)
+        train_start_time = test_start_time - int(train_days * MS_PER_DAY)
+        train_start = 0 if expanding else int(np.searchsorted(close_times, train_start_time, side='left'))
+        test_start, test_stop = np.searchsorted(close_times, [test_start_time, test_stop_time], side='left')
+        if test_stop > test_start and test_start > train_start:
+            folds.append(Fold(len(folds), train_start, int(test_start), int(test_start), int(test_stop)))
+        test_start_time += int(step_days * MS_PER_DAY)
+    return folds
+
+def get_strategy_profits(actual: np.ndarray, predicted: np.ndarray) -> dict:
+    """
+    P&L of every trading strategy on a series of actual and predicted prices
+    """
+    price_df = generate_price_df(actual, predicted)
+    return {name: strategy(price_df) for name, strategy in STRATEGIES.items()}
+
+def _fit(X, y, model_params: dict, n_jobs: int, base_model=None):
+    from xgboost import XGBRegressor
+
+    # The thread budget of the fold replaces any n_jobs of model_params
+    model = XGBRegressor(**{**model_params, 'n_jobs': n_jobs})
+    start = time.time()
+    # With a base model, n_estimators trees are added to its trees
+    model.fit(X, y, xgb_model=None if base_model is None else base_model.get_booster())
+    return model, time.time() - start
+
+def _evaluate_fold(model, fold: Fold, close_times: np.ndarray, X_test, y_test, fit_seconds: float) -> dict:
+    from .metrics import get_metrics
+
+    predictions = model.predict(X_test)
+    return {
+        'fold_id': fold.fold_id,
+        'train_start_time': int(close_times[fold.train_start]),
+        'train_end_time': int(close_times[fold.train_stop - 1]),
+        'test_start_time': int(close_times[fold.test_start]),
+        'test_end_time': int(close_times[fold.test_stop - 1]),
+        'n_train': fold.train_stop - fold.train_start,
+        'n_test': fold.test_stop - fold.test_start,
+        'n_trees': model.get_booster().num_boosted_rounds(),
+        **get_metrics(y_test, predictions, print_metrics=False),
+        **get_strategy_profits(y_test, predictions),
+        'fit_seconds': fit_seconds,
+    }
+
+def _failed_fold_row(fold: Fold, close_times: np.ndarray, error: Exception) -> dict:
+    # Row of a fold whose training or evaluation raised, in place of its metrics
+    return {
+        'fold_id': fold.fold_id,
+        'train_start_time': int(close_times[fold.train_start]),
+        'train_end_time': int(close_times[fold.train_stop - 1]),
+        'test_start_time': int(close_times[fold.test_start]),
+        'test_end_time': int(close_times[fold.test_stop - 1]),
+        'n_train': fold.train_stop - fold.train_start,
+        'n_test': fold.test_stop - fold.test_start,
+        'error': f"{type(error).__name__}: {error}",
+    }
+
+def _run_fold(dataset_dir, fold: Fold, model_params: dict, threads_per_worker: int) -> dict:
+    dataset_dir = Path(dataset_dir)
+    # Memory-mapped, and a fold's rows are contiguous, so its slices are views of pages shared by all workers
+    X = np.load(dataset_dir / 'X.npy', mmap_mode='r')
+    y = np.load(dataset_dir / 'y.npy', mmap_mode='r')
+    close_times = np.load(dataset_dir / 'close_times.npy', mmap_mode='r')
+    model, fit_seconds = _fit(X[fold.train_start:fold.train_stop], y[fold.train_start:fold.train_stop], model_params, threads_per_worker)
+    return _evaluate_fold(model, fold, close_times, X[fold.test_start:fold.test_stop], y[fold.test_start:fold.test_stop], fit_seconds)
+
+def write_walk_forward_dataset(processed_df: pd.DataFrame, dataset_dir) -> Path:
+    """
+    Write the model inputs of a processed dataframe (close_time, features..., close, as returned by
+    feature_pipeline_v1 or load_feature_parts with the 'dense' encoding) as .npy files for the fold workers to
+    memory-map. Features are stored as float32, the precision XGBoost trains on.
+    """
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    np.save(dataset_dir / 'X.npy', processed_df.iloc[:, 1:-1].to_numpy(dtype=np.float32))
+    np.save(dataset_dir / 'y.npy', processed_df.iloc[:, -1].to_numpy(dtype=np.float64))
+    np.save(dataset_dir / 'close_times.npy', processed_df['close_time'].to_numpy(dtype=np.int64))
+    with open(dataset_dir / 'meta.json', 'w') as f:
+        json.dump({'feature_columns': [str(column) for column in processed_df.columns[1:-1]]}, f)
+    return dataset_dir
+
+def run_walk_forward(processed_df: pd.DataFrame,
+                     train_days: float,
+                     test_days: float = 1,
+                     step_days: float = None,
+                     expanding: bool = False,
+                     model_params: dict = DEFAULT_MODEL_PARAMS,
+                     mode: str = 'parallel',
+                     warm_start_rounds: int = 100,
+                     max_workers: int = None,
+                     threads_per_worker: int = None,
+                     dataset_dir=None,
+                    ) -> pd.DataFrame:
+    """
+    Train and evaluate a model on every walk-forward fold of a processed history
+
+    Args:
+        processed_df: Features of the whole history, e.g. from feature_pipeline_v1 or load_feature_parts with the
+            'dense' encoding. The features of a row only look back, so slicing it by time does not leak test rows.
+        train_days, test_days, step_days, expanding: Fold layout, see get_walk_forward_folds
+        model_params: XGBRegressor parameters of every fold's model
+        mode: 'parallel' to train every fold from scratch in a process pool, 'warm_start' to train the folds in
+            order, each one adding warm_start_rounds trees to the previous fold's model. The first fold is always
+            trained with model_params['n_estimators'] trees.
+        warm_start_rounds: Trees added per fold in 'warm_start' mode
+        max_workers: Worker processes in 'parallel' mode. Defaults to os.cpu_count().
+        threads_per_worker: XGBoost threads per worker. Defaults to an even share of the cores.
+        dataset_dir: Directory for the memory-mapped arrays in 'parallel' mode. Defaults to a temporary directory.
+
+    Returns:
+        One row per fold with its time range, row counts, get_metrics, strategy P&L and fit time. In 'parallel' mode
+        a fold that raised has its exception in an 'error' column instead, which is NaN for the other folds.
+    """
+    if mode not in ['parallel', 'warm_start']:
+        raise ValueError(f"Unknown mode {mode}, expected 'parallel' or 'warm_start'")
+
+    start = time.time()
+    close_times = processed_df['close_time'].to_numpy(dtype=np.int64)
+    folds = get_walk_forward_folds(close_times, train_days, test_days=test_days, step_days=step_days, expanding=expanding)
+    print(f"Walk-forward over {len(folds)} folds of {train_days} train days and {test_days} test days ({mode})")
+
+    results = []
+    if mode == 'parallel':
+        max_workers = max_workers or os.cpu_count()
+        threads_per_worker = threads_per_worker or max(1, os.cpu_count() // max_workers)
+        with tempfile.TemporaryDirectory(prefix='walk-forward-') as tmp_dir:
+            dataset_dir = write_walk_forward_dataset(processed_df, dataset_dir or tmp_dir)
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_worker_threads, initargs=(threads_per_worker,)) as executor:
+                futures = {executor.submit(_run_fold, dataset_dir, fold, model_params, threads_per_worker): fold for fold in folds}
+                for future in as_completed(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        print(f"Walk-forward fold {futures[future].fold_id} failed: {e}")
+                        results.append(_failed_fold_row(futures[future], close_times, e))
+    else:
+        X = processed_df.iloc[:, 1:-1].to_numpy(dtype=np.float32)
+        y = processed_df.iloc[:, -1].to_numpy(dtype=np.float64)
+        model = None
+        for fold in folds:
+            params = model_params if model is None else {**model_params, 'n_estimators': warm_start_rounds}
+            model, fit_seconds = _fit(X[fold.train_start:fold.train_stop], y[fold.train_start:fold.train_stop], params, threads_per_worker or os.cpu_count(), base_model=model)
+            results.append(_evaluate_fold(model, fold, close_times, X[fold.test_start:fold.test_stop], y[fold.test_start:fold.test_stop], fit_seconds))
+
+    print(f"Walk-forward finished in {time.time() - start:.1f} seconds")
+    if len(results) == 0:
+        return pd.DataFrame()
+    return pd.DataFrame(results).sort_values('fold_id').reset_index(drop=True)
+
+def summarize_walk_forward(results_df: pd.DataFrame) -> pd.Series:
+    """
+    Aggregate of the folds of run_walk_forward: mean and worst fold metrics, and total and mean strategy P&L.
+    Failed folds are counted in 'failed_folds' and left out of the aggregates.
+    """
+    failed = results_df['error'].notna() if 'error' in results_df.columns else pd.Series(False, index=results_df.index)
+    if failed.any():
+        print(f"Leaving {int(failed.sum())} failed fold(s) out of the walk-forward summary: {results_df.loc[failed, 'fold_id'].tolist()}")
+    metrics = ['mean_squared_error', 'mean_absolute_error', 'mean_absolute_percentage_error']
+    # Without any successful fold there are no metric columns to aggregate
+    results_df = results_df[~failed].reindex(columns=metrics + list(STRATEGIES), fill_value=np.nan)
+    summary = {'folds': len(results_df), 'failed_folds': int(failed.sum())}
+    for metric in metrics:
+        summary[f"{metric}_mean"] = results_df[metric].mean()
+        summary[f"{metric}_max"] = results_df[metric].max()
+    for name in STRATEGIES:
+        summary[f"{name}_total"] = results_df[name].sum()
+        summary[f"{name}_mean"] = results_df[name].mean()
+        summary[f"{name}_positive_folds"] = int((results_df[name] > 0).sum())
+    return pd.Series(summary)
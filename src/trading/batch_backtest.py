@@ -0,0 +1,240 @@
+"""
+  Batch backtests of many strategy variants at once.
+  A variant is one of the trading strategies with an entry threshold, a fee and a slippage, fed by one of several
+  prediction series. Variants are evaluated as (variants x time) matrices, chunked by variant to bound memory:
+  strategies 1 and 3 as masked profit matrices, strategy 4 by alternating its signal matrix into buys and sells,
+  and strategy 2, whose buy price depends on its earlier trades, by jumping from trade to trade once per
+  prediction series and threshold, as its fees and slippage do not change when it trades. With zero threshold,
+  fee and slippage a variant's P&L is exactly the one of its strategy function on
+  generate_price_df(actual_Y, pred_Y), before rounding.
+"""
+import itertools
+import numpy as np
+import pandas as pd
+
+STRATEGY_IDS = [1, 2, 3, 4]
+DEFAULT_MAX_MEMORY_MB = 256
+# float64 (variants x time) arrays alive at once while a chunk is evaluated
+CHUNK_ARRAYS = 10
+
+
+def get_variant_grid(strategies: list = STRATEGY_IDS,
+                     thresholds: list = [0.0],
+                     fees: list = [0.0],
+                     slippages: list = [0.0],
+                     models: list = [0],
+                    ) -> pd.DataFrame:
+    """
+    Every combination of strategy variant parameters, one row per variant
+
+    Args:
+        strategies: Strategy numbers, see strategies.py
+        thresholds: Relative margin the prediction must clear to enter, e.g. 0.0005 to buy only if predicted > prev_actual * 1.0005
+        fees: Fee per side, relative to the traded price, e.g. 0.001 for 0.1%
+        slippages: Relative slippage per side. Buys fill at price * (1 + slippage), sells at price * (1 - slippage).
+        models: Keys of the prediction series to use, see batch_backtest
+    """
+    return pd.DataFrame(list(itertools.product(strategies, thresholds, fees, slippages, models)),
+                        columns=['strategy', 'threshold', 'fee', 'slippage', 'model'])
+
+def _net_profits(entry: np.ndarray, exit: np.ndarray, fee: np.ndarray, slippage: np.ndarray) -> np.ndarray:
+    # Profit of round trips after slippage and fees, exactly exit - entry when both are zero
+    return exit * (1 - slippage) - entry * (1 + slippage) - fee * (entry + exit)
+
+def _max_drawdowns(equity: np.ndarray) -> np.ndarray:
+    # Largest drop of each row of cumulative P&L from its running peak, starting from zero equity
+    peaks = np.maximum.accumulate(np.maximum(equity, 0), axis=1)
+    return (peaks - equity).max(axis=1, initial=0)
+
+def backtest_signal_matrix(actual: np.ndarray,
+                           prev_actual: np.ndarray,
+                           signals: np.ndarray,
+                           kind: str = 'close',
+                           fee: np.ndarray = 0.0,
+                           slippage: np.ndarray = 0.0,
+                          ) -> dict:
+    """
+    Backtest a (variants x time) matrix of boolean entry signals
+
+    Args:
+        actual: Close price of every step
+        prev_actual: Close price of the step before, the entry price
+        signals: Entry signal per variant and step
+        kind: 'close' to buy at prev_actual on every signal and sell at actual on the same step (strategies 1 and 3),
+            'alternate' to buy at prev_actual on every other signal and sell at actual on the next one (strategy 4)
+        fee, slippage: Per variant, see get_variant_grid
+
+    Returns:
+        Dictionary of per-variant 'pnl', 'trades' (completed round trips) and 'max_drawdown' arrays
+    """
+    fee = np.broadcast_to(np.asarray(fee, dtype=np.float64), (len(signals),))[:, None]
+    slippage = np.broadcast_to(np.asarray(slippage, dtype=np.float64), (len(signals),))[:, None]
+    if kind == 'close':
+        sells = signals
+        entry = prev_actual[None, :]
+    elif kind == 'alternate':
+        # The 1st, 3rd, ... signals of a variant are buys and the 2nd, 4th, ... sells. Every sell's entry price is
+        # the prev_actual of the last buy before it.
+        n_signals = np.cumsum(signals, axis=1)
+        buys = signals & (n_signals % 2 == 1)
+        sells = signals & ~buys
+        del n_signals
+        buy_steps = np.where(buys, np.arange(signals.shape[1]), 0)
+        del buys
+        np.maximum.accumulate(buy_steps, axis=1, out=buy_steps)
+        entry = prev_actual[buy_steps]
+        del buy_steps
+    else:
+        raise ValueError(f"Unknown signal kind {kind}, expected 'close' or 'alternate'")
+
+    # Summed in time order, so a variant's P&L is exactly its strategy function's total
+    equity = np.where(sells, _net_profits(entry, actual[None, :], fee, slippage), 0.0)
+    np.cumsum(equity, axis=1, out=equity)
+    return {'pnl': equity[:, -1] if equity.shape[1] > 0 else np.zeros(len(signals)),
+            'trades': sells.sum(axis=1),
+            'max_drawdown': _max_drawdowns(equity)}
+
+def _first_above(values: np.ndarray, level: float, start: int) -> int:
+    # First position >= start where values > level, or -1. Scanned in doubling blocks, as it is usually close.
+    block = 64
+    while start < len(values):
+        hits = np.flatnonzero(values[start:start + block] > level)
+        if len(hits) > 0:
+            return start + int(hits[0])
+        start += block
+        block *= 2
+    return -1
+
+def get_hold_until_target_trades(actual: np.ndarray, prev_actual: np.ndarray, predicted: np.ndarray, threshold: float = 0.0):
+    """
+    Steps of the trades of strategy 2 on one prediction series: buy at actual when flat and predicted >
+    prev_actual * (1 + threshold), sell at actual when holding and predicted > the buy price. The buy price
+    depends on the earlier trades, so trades are found one after the other, jumping from each buy to the next step
+    that reaches its price and from each sell to the next buy signal.
+
+    Returns:
+        Arrays of the buy steps and the sell steps of the completed trades
+    """
+    entries = np.flatnonzero(predicted > prev_actual * (1 + threshold))
+    buy_steps, sell_steps = [], []
+    step = 0
+    while True:
+        k = np.searchsorted(entries, step)
+        if k == len(entries):
+            break
+        buy_step = int(entries[k])
+        buy_price = actual[buy_step]
+        if buy_price <= 0:
+            # As in strategy_2, a buy price of 0 leaves the position flat. A negative one never sells.
+            if buy_price < 0:
+                break
+            step = buy_step + 1
+            continue
+        sell_step = _first_above(predicted, buy_price, buy_step + 1)
+        if sell_step < 0:
+            break
+        buy_steps.append(buy_step)
+        sell_steps.append(sell_step)
+        step = sell_step + 1
+    return np.array(buy_steps, dtype=np.int64), np.array(sell_steps, dtype=np.int64)
+
+def backtest_hold_until_target(actual: np.ndarray,
+                               prev_actual: np.ndarray,
+                               predicted: np.ndarray,
+                               threshold: float = 0.0,
+                               fee: np.ndarray = 0.0,
+                               slippage: np.ndarray = 0.0,
+                              ) -> dict:
+    """
+    Backtest strategy 2 on one prediction series for any number of fee and slippage levels, which do not change
+    when it trades, see get_hold_until_target_trades
+
+    Returns:
+        Dictionary of per-level 'pnl', 'trades' and 'max_drawdown' arrays, see backtest_signal_matrix
+    """
+    fee = np.atleast_1d(np.asarray(fee, dtype=np.float64))
+    slippage = np.atleast_1d(np.asarray(slippage, dtype=np.float64))
+    n_levels = max(len(fee), len(slippage))
+    buy_steps, sell_steps = get_hold_until_target_trades(actual, prev_actual, predicted, threshold)
+    # Strategy 2 buys at the close of its buy step
+    equity = _net_profits(actual[buy_steps][None, :], actual[sell_steps][None, :], np.broadcast_to(fee, (n_levels,))[:, None], np.broadcast_to(slippage, (n_levels,))[:, None])
+    np.cumsum(equity, axis=1, out=equity)
+    return {'pnl': equity[:, -1] if len(sell_steps) > 0 else np.zeros(n_levels),
+            'trades': np.full(n_levels, len(sell_steps)),
+            'max_drawdown': _max_drawdowns(equity)}
+
+def _get_prices(actual_Y, pred_Y):
+    # Price arrays of generate_price_df: the steps from the second on, without the ones where any price is NaN
+    actual = np.asarray(actual_Y, dtype=np.float64)
+    if isinstance(pred_Y, dict):
+        keys = list(pred_Y.keys())
+        predictions = np.vstack([np.asarray(pred_Y[key], dtype=np.float64) for key in keys])
+    else:
+        predictions = np.asarray(pred_Y, dtype=np.float64)
+        if predictions.ndim == 1:
+            predictions = predictions[None, :]
+        keys = list(range(len(predictions)))
+    if predictions.shape[1] != len(actual):
+        raise ValueError(f"Predictions cover {predictions.shape[1]} steps, actual prices {len(actual)}")
+
+    keep = np.isfinite(actual[1:]) & np.isfinite(actual[:-1]) & np.isfinite(predictions[:, 1:]).all(axis=0) & np.isfinite(predictions[:, :-1]).all(axis=0)
+    return keys, actual[1:][keep], actual[:-1][keep], predictions[:, 1:][:, keep], predictions[:, :-1][:, keep]
+
+def batch_backtest(actual_Y,
+                   pred_Y,
+                   variants: pd.DataFrame = None,
+                   max_memory_mb: float = DEFAULT_MAX_MEMORY_MB,
+                  ) -> pd.DataFrame:
+    """
+    Backtest many strategy variants on one series of actual prices
+
+    Args:
+        actual_Y: Actual prices, as passed to generate_price_df
+        pred_Y: Predicted prices, as passed to generate_price_df, or a (models x time) array or a dictionary of model
+            name to predictions to compare the signals of several models. Steps where any of them is NaN are dropped
+            for all of them.
+        variants: Variants to evaluate, with the columns of get_variant_grid. Defaults to every strategy without
+            threshold, fees or slippage on the first predictions.
+        max_memory_mb: Memory the (variants x time) matrices of a chunk of variants may use
+
+    Returns:
+        variants with the 'pnl', 'trades' (completed round trips) and 'max_drawdown' (of realized P&L) of each
+    """
+    keys, actual, prev_actual, predicted, prev_predicted = _get_prices(actual_Y, pred_Y)
+    if variants is None:
+        variants = get_variant_grid(models=keys[:1])
+    variants = variants.reset_index(drop=True)
+    unknown_models = set(variants['model']) - set(keys)
+    if len(unknown_models) > 0:
+        raise ValueError(f"Variants use predictions {sorted(unknown_models, key=str)} that are not in pred_Y")
+    unknown_strategies = set(variants['strategy']) - set(STRATEGY_IDS)
+    if len(unknown_strategies) > 0:
+        raise ValueError(f"Unknown strategies {sorted(unknown_strategies)}, expected some of {STRATEGY_IDS}")
+
+    model_rows = variants['model'].map({key: i for i, key in enumerate(keys)}).to_numpy()
+    threshold = variants['threshold'].to_numpy(dtype=np.float64)
+    fee = variants['fee'].to_numpy(dtype=np.float64)
+    slippage = variants['slippage'].to_numpy(dtype=np.float64)
+    chunk_size = max(1, int(max_memory_mb * 1e6 // (CHUNK_ARRAYS * 8 * max(len(actual), 1))))
+
+    results = {'pnl': np.zeros(len(variants)), 'trades': np.zeros(len(variants), dtype=np.int64), 'max_drawdown': np.zeros(len(variants))}
+    # Strategy 2 trades the same way at every fee and slippage, so it is backtested once per prediction series and threshold
+    strategy_2_variants = variants[variants['strategy'] == 2]
+    for (model_row, variant_threshold), group in strategy_2_variants.groupby([model_rows[strategy_2_variants.index], 'threshold']):
+        rows = group.index.to_numpy()
+        group_results = backtest_hold_until_target(actual, prev_actual, predicted[model_row], variant_threshold, fee[rows], slippage[rows])
+        for column, values in group_results.items():
+            results[column][rows] = values
+
+    for strategy in [1, 3, 4]:
+        strategy_rows = np.flatnonzero(variants['strategy'].to_numpy() == strategy)
+        for chunk_start in range(0, len(strategy_rows), chunk_size):
+            rows = strategy_rows[chunk_start:chunk_start + chunk_size]
+            # Strategy 1 enters when the prediction clears the last close, 3 and 4 when it clears the last prediction
+            reference = prev_actual[None, :] if strategy == 1 else prev_predicted[model_rows[rows]]
+            signals = predicted[model_rows[rows]] > reference * (1 + threshold[rows])[:, None]
+            del reference
+            chunk_results = backtest_signal_matrix(actual, prev_actual, signals, kind='alternate' if strategy == 4 else 'close', fee=fee[rows], slippage=slippage[rows])
+            for column, values in chunk_results.items():
+                results[column][rows] = values
+    return variants.assign(**results)
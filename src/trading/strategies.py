@@ -1,3 +1,12 @@
+"""
+  Trading strategies evaluated on a series of actual and predicted prices.
+  Stateless strategies (1 and 3) are NumPy masks over the price arrays. Stateful ones (2 and 4) are state machines
+  over the arrays: strategy 4's trades alternate on its signal so its trades are picked by index, and strategy 2
+  runs a tight loop over plain floats. Profits are summed in row order, as the original row loops did, so the
+  totals are identical to theirs. The strategy_<n>_step functions are the same rules for one row at a time, as
+  used by strategy_2 and by the live trackers of strategy_trackers.
+"""
+import numpy as np
 import pandas as pd
 
 def generate_price_df(actual_Y, pred_Y):
@@ -7,60 +16,86 @@ def generate_price_df(actual_Y, pred_Y):
     price_df = price_df.dropna()
     return price_df
 
+def _total_profit(profits: np.ndarray):
+    # Summed in order like `total_profit += profit` (np.sum would sum pairwise and can differ in the last bits),
+    # and 0 without any trade
+    if len(profits) == 0:
+        return 0
+    return np.cumsum(profits)[-1]
+
+def _columns(price_df) -> dict:
+    # float64 like the rows of iterrows, where float32 predictions are upcast
+    return {column: price_df[column].to_numpy(dtype=np.float64) for column in ['actual', 'predicted', 'prev_actual', 'prev_predicted']}
+
+def strategy_1_step(buy_price, actual, predicted, prev_actual, prev_predicted):
+    # Row form of strategy_1. Like every step function, returns the buy price after the row (0 when flat) and the
+    # profit realized on it (None without a sale).
+    if predicted > prev_actual:
+        return buy_price, actual - prev_actual
+    return buy_price, None
+
+def strategy_2_step(buy_price, actual, predicted, prev_actual, prev_predicted):
+    # Row form of strategy_2
+    if buy_price == 0 and predicted > prev_actual:
+        return actual, None
+    elif buy_price > 0 and predicted > buy_price:
+        return 0, actual - buy_price
+    return buy_price, None
+
+def strategy_3_step(buy_price, actual, predicted, prev_actual, prev_predicted):
+    # Row form of strategy_3
+    if predicted > prev_predicted:
+        return buy_price, actual - prev_actual
+    return buy_price, None
+
+def strategy_4_step(buy_price, actual, predicted, prev_actual, prev_predicted):
+    # Row form of strategy_4
+    if buy_price == 0 and predicted > prev_predicted:
+        return prev_actual, None
+    elif buy_price > 0 and predicted > prev_predicted:
+        return 0, actual - buy_price
+    return buy_price, None
+
 def strategy_1(price_df):
     # Strategy 1: Buy if predicted > prev_actual. Sell on close. Profit = Actual - prev_actual
-    total_profit = 0
-
-    for idx, row in price_df.iterrows():
-        # Buy (assume entry price is prev_actual) and sell on close
-        if row['predicted'] > row['prev_actual']:
-            profit = row['actual'] - row['prev_actual']
-            total_profit += profit
-    
+    prices = _columns(price_df)
+    # Buy (assume entry price is prev_actual) and sell on close
+    buy = prices['predicted'] > prices['prev_actual']
+    total_profit = _total_profit(prices['actual'][buy] - prices['prev_actual'][buy])
     return round(total_profit, 2)
 
 def strategy_2(price_df):
     # Strategy 2: Buy if predicted > prev_actual. Sell when predicted < buy_price. Profit = sell_price - buy_price
+    prices = _columns(price_df)
     total_profit = 0
     buy_price = 0
-    
-    for idx, row in price_df.iterrows():
-        # Buy (assume entry price is prev_actual)
-        if buy_price == 0 and row['predicted'] > row['prev_actual']:
-            buy_price = row['actual']
-        # Sell (if previously bought and price is predicted to be higher than buy_price)
-        elif buy_price > 0 and row['predicted'] > buy_price:
-            profit = row['actual'] - buy_price
-            # Reset buy_price
-            buy_price = 0
+
+    # The buy price depends on the previous trades, so this is a loop. Over plain floats it compares and adds
+    # exactly like the float64 rows did.
+    for actual, predicted, prev_actual in zip(prices['actual'].tolist(), prices['predicted'].tolist(), prices['prev_actual'].tolist()):
+        buy_price, profit = strategy_2_step(buy_price, actual, predicted, prev_actual, None)
+        if profit is not None:
             total_profit += profit
 
-    return round(total_profit, 2)
+    return round(np.float64(total_profit), 2)
 
 def strategy_3(price_df):
     # Strategy 3: Buy if predicted > prev_predicted. Sell on close.
-    total_profit = 0
-
-    for idx, row in price_df.iterrows():
-        # Buy (assume entry price is prev_actual) and sell on close
-        if row['predicted'] > row['prev_predicted']:
-            profit = row['actual'] - row['prev_actual']
-            total_profit += profit
-    
+    prices = _columns(price_df)
+    # Buy (assume entry price is prev_actual) and sell on close
+    buy = prices['predicted'] > prices['prev_predicted']
+    total_profit = _total_profit(prices['actual'][buy] - prices['prev_actual'][buy])
     return round(total_profit, 2)
 
 def strategy_4(price_df):
     # Strategy 4: Buy if predicted > prev_predicted. Sell if predicted > prev_predicted.
-    total_profit = 0
-    buy_price = 0
-    for idx, row in price_df.iterrows():
-        # Buy (assume entry price is prev_actual)
-        if buy_price == 0 and row['predicted'] > row['prev_predicted']:
-            buy_price = row['prev_actual']
-        elif buy_price > 0 and row['predicted'] > row['prev_predicted']:
-            profit = row['actual'] - buy_price
-            # Reset buy_price
-            buy_price = 0
-            total_profit += profit
-    
-    return round(total_profit, 2)
\ No newline at end of file
+    prices = _columns(price_df)
+    # Buying and selling have the same signal, so the trades alternate between buys and sells on the rows where it is
+    # set: the 1st, 3rd, ... are buys (assume entry price is prev_actual) and the 2nd, 4th, ... sells. A last buy
+    # without a sell is still open and has no profit.
+    signal_rows = np.flatnonzero(prices['predicted'] > prices['prev_predicted'])
+    buy_rows, sell_rows = signal_rows[0::2], signal_rows[1::2]
+    total_profit = _total_profit(prices['actual'][sell_rows] - prices['prev_actual'][buy_rows[:len(sell_rows)]])
+    return round(total_profit, 2)
+
+STRATEGY_STEPS = {1: strategy_1_step, 2: strategy_2_step, 3: strategy_3_step, 4: strategy_4_step}
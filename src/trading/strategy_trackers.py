@@ -0,0 +1,188 @@
+"""
+  Live trackers of the trading strategies, updated one bar at a time.
+  A tracker keeps the state its strategy carries from bar to bar (previous prices, position and buy price, total
+  profit), so a new bar costs O(1) instead of rerunning the strategy over the whole day. Bars go through the same
+  strategy_<n>_step rules as the batch strategy functions and are summed in the same order, so after the same bars
+  a tracker's profit equals strategy_<n>(generate_price_df(actual_Y, pred_Y)). The state is plain JSON, so trackers
+  saved to disk resume mid-day after a restart.
+"""
+import json
+import math
+import os
+import numpy as np
+from pathlib import Path
+
+from .strategies import STRATEGY_STEPS
+
+TRACKER_STATE_VERSION = 1
+
+
+class StrategyTracker:
+    """
+    Running state of one strategy
+
+    Args:
+        strategy: Strategy number, see strategies.py
+
+    Attributes:
+        buy_price: Price of the open position, 0 when flat
+        total_profit: Realized profit so far, unrounded
+        trades: Completed sales
+        last_close_time: close_time of the last bar, if updates pass it
+    """
+    def __init__(self, strategy: int):
+        if strategy not in STRATEGY_STEPS:
+            raise ValueError(f"Unknown strategy {strategy}, expected one of {list(STRATEGY_STEPS)}")
+        self.strategy = strategy
+        self.prev_actual = None
+        self.prev_predicted = None
+        self.buy_price = 0
+        # An int until the first sale, like the totals of the strategy functions
+        self.total_profit = 0
+        self.trades = 0
+        self.last_close_time = None
+
+    @property
+    def profit(self):
+        """
+        Realized profit rounded like the strategy functions' results
+        """
+        return round(np.float64(self.total_profit), 2)
+
+    def update(self, actual: float, predicted: float, close_time: int = None):
+        """
+        Add the next bar
+
+        Args:
+            actual: Actual price of the bar
+            predicted: Predicted price of the bar
+            close_time: close_time of the bar. If given, bars at or before the last one are ignored, so that
+                feeding a window again after a restart does not count its bars twice.
+
+        Returns:
+            Profit realized on the bar, None without a sale
+        """
+        if close_time is not None:
+            if self.last_close_time is not None and close_time <= self.last_close_time:
+                return None
+            self.last_close_time = int(close_time)
+        actual, predicted = float(actual), float(predicted)
+        prev_actual, prev_predicted = self.prev_actual, self.prev_predicted
+        self.prev_actual, self.prev_predicted = actual, predicted
+        # generate_price_df drops the first bar and bars with any NaN price, while their prices remain the previous ones of the next bar
+        if prev_actual is None or any(math.isnan(price) for price in [actual, predicted, prev_actual, prev_predicted]):
+            return None
+
+        self.buy_price, profit = STRATEGY_STEPS[self.strategy](self.buy_price, actual, predicted, prev_actual, prev_predicted)
+        if profit is not None:
+            self.total_profit += profit
+            self.trades += 1
+        return profit
+
+    def to_dict(self) -> dict:
+        return {
+            'strategy': self.strategy,
+            'prev_actual': self.prev_actual,
+            'prev_predicted': self.prev_predicted,
+            'buy_price': self.buy_price,
+            'total_profit': self.total_profit,
+            'trades': self.trades,
+            'last_close_time': self.last_close_time,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'StrategyTracker':
+        tracker = cls(state['strategy'])
+        for key in ['prev_actual', 'prev_predicted', 'buy_price', 'total_profit', 'trades', 'last_close_time']:
+            setattr(tracker, key, state[key])
+        return tracker
+
+class StrategyTrackers:
+    """
+    Trackers of every strategy on one prediction series, e.g. of a model on the current day
+
+    Args:
+        key: Identifies the series, e.g. (model, version, day). Trackers loaded for another key are not resumed.
+        strategies: Strategy numbers to track
+    """
+    def __init__(self, key=None, strategies: list = list(STRATEGY_STEPS)):
+        self.key = key
+        self.trackers = {strategy: StrategyTracker(strategy) for strategy in strategies}
+
+    @property
+    def last_close_time(self):
+        return next(iter(self.trackers.values())).last_close_time if len(self.trackers) > 0 else None
+
+    def update(self, actual_Y, pred_Y, close_times) -> None:
+        """
+        Add bars, skipping the ones at or before the last close_time seen. Only the new bars of a window have to be
+        passed, but passing the whole window again costs one binary search.
+
+        Args:
+            actual_Y: Actual prices, as passed to generate_price_df
+            pred_Y: Predicted prices
+            close_times: close_time of every bar, increasing
+        """
+        close_times = np.asarray(close_times, dtype=np.int64)
+        start = 0 if self.last_close_time is None else int(np.searchsorted(close_times, self.last_close_time, side='right'))
+        # Plain floats, as the step rules compare and add them exactly like float64 rows
+        actual_Y = np.asarray(actual_Y, dtype=np.float64)[start:].tolist()
+        pred_Y = np.asarray(pred_Y, dtype=np.float64)[start:].tolist()
+        for actual, predicted, close_time in zip(actual_Y, pred_Y, close_times[start:].tolist()):
+            for tracker in self.trackers.values():
+                tracker.update(actual, predicted, close_time)
+
+    def preview_profits(self, actual_Y, pred_Y, close_times) -> dict:
+        """
+        Rounded profit per strategy number if the bars were added, without adding them. E.g. for the bar that has not
+        closed yet, whose prices can still change.
+        """
+        trackers = StrategyTrackers.from_dict(self.to_dict())
+        trackers.update(actual_Y, pred_Y, close_times)
+        return trackers.profits()
+
+    def profits(self) -> dict:
+        """
+        Rounded profit per strategy number
+        """
+        return {strategy: tracker.profit for strategy, tracker in self.trackers.items()}
+
+    def to_dict(self) -> dict:
+        return {'version': TRACKER_STATE_VERSION, 'key': self.key, 'trackers': [tracker.to_dict() for tracker in self.trackers.values()]}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'StrategyTrackers':
+        if state.get('version') != TRACKER_STATE_VERSION:
+            raise ValueError(f"Unsupported strategy tracker state version {state.get('version')}")
+        trackers = cls(key=state['key'], strategies=[])
+        for tracker_state in state['trackers']:
+            trackers.trackers[tracker_state['strategy']] = StrategyTracker.from_dict(tracker_state)
+        return trackers
+
+    def save(self, path) -> None:
+        """
+        Write the state to a JSON file, atomically so a crash mid-write leaves the previous state
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, key=None, strategies: list = list(STRATEGY_STEPS)) -> 'StrategyTrackers':
+        """
+        Trackers saved at path, or new ones if there are none or they were saved for another key.
+        Keys are compared after a JSON round trip, so tuples and lists are the same key.
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('key') == json.loads(json.dumps(key)):
+                return cls.from_dict(state)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Could not resume strategy trackers from {path}: {e}")
+        return cls(key=key, strategies=strategies)
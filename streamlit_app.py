@@ -1,31 +1,40 @@
 import streamlit as st
+import os
 import pickle
+import threading
+import time
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from src.data.kline_history import MaterializedKlineHistory
+from src.data.realtime_tail import RealtimeKlineTail
+from src.features.feature_cache import FeatureCache
+from src.models.inference_server import InferenceClient
+from src.models.model_registry import ModelRegistry, build_ohe_encoder
+from src.models.prediction_cache import PredictionCache
 from src.features.feature_generator import (
     generate_inference_df,
+    get_model_inputs,
 )
 
-from src.trading.strategies import (
-    generate_price_df,
-    strategy_1,
-    strategy_2,
-    strategy_3,
-    strategy_4,
-)
+from src.trading.strategy_trackers import StrategyTrackers
 
 DATA_DIR = Path.cwd() / 'data'
 RAW_DATA_DIR = DATA_DIR / 'raw'
 PROCESSED_DATA_DIR = DATA_DIR / 'processed'
 
 MODEL_DIR = Path.cwd() / 'models'
+MODEL_REGISTRY_DIR = MODEL_DIR / 'registry'
 
 BINANCE_HISTORICAL_DATA_DIR = RAW_DATA_DIR / 'binance_historical'
 BINANCE_HISTORICAL_FILES_DIR = BINANCE_HISTORICAL_DATA_DIR / 'data/spot/daily/klines/BTCUSDT/1m'
 BINANCE_HISTORICAL_DF_PATH = PROCESSED_DATA_DIR / 'binance_historical_df.csv'
+KLINE_STORE_DIR = PROCESSED_DATA_DIR / 'kline_store'
+FEATURE_CACHE_DIR = PROCESSED_DATA_DIR / 'feature_cache'
+STRATEGY_TRACKERS_DIR = PROCESSED_DATA_DIR / 'strategy_trackers'
 BINANCE_PROCESSED_DF_PATH = PROCESSED_DATA_DIR / 'binance_processed_df.csv'
 TRAIN_DF_PATH = PROCESSED_DATA_DIR / 'binance_train_df.csv'
 VAL_DF_PATH = PROCESSED_DATA_DIR / 'binance_val_df.csv'
@@ -57,27 +66,95 @@ MA_WINDOW_SIZES_DICT = {
 MODEL_REGISTRY_DICT = {
     "XGBoost Baseline": str(MODEL_DIR / 'xgb_baseline.pkl')
 }
+# Predictions are requested from a running inference server (python -m src.models.inference_server) when set,
+# e.g. http://127.0.0.1:8765, instead of running the model in every session
+INFERENCE_SERVER_URL = os.environ.get('INFERENCE_SERVER_URL')
 
 
 # Functions
 @st.cache(allow_output_mutation=True)
 def load_model(model_type='XGBoost Baseline'):
-    if model_type == 'XGBoost Baseline':
+    if INFERENCE_SERVER_URL:
+        # The model runs in the inference server, so only the encoder and version of the model it serves are needed here
+        model_info = get_inference_client().models().get(model_type)
+        if model_info is None:
+            raise ValueError(f"Model {model_type} is not served by {INFERENCE_SERVER_URL}")
+        encoder = None
+        if model_info['ohe_categories'] is not None:
+            encoder = build_ohe_encoder(model_info['ohe_columns'], model_info['ohe_categories'], handle_unknown=model_info['ohe_handle_unknown'])
+        return {'model': None, 'encoder': encoder, 'version': model_info['version']}
+
+    registry = ModelRegistry(MODEL_REGISTRY_DIR)
+    if model_type in registry.list_models():
+        # Latest registered version, loaded from XGBoost's native format instead of a pickle
+        model_package = registry.load(model_type)
+        encoder = model_package['ohe_encoder']
+        model = model_package['model']
+        version = model_package['manifest']['version']
+
+    elif model_type == 'XGBoost Baseline':
         model_path = str(MODEL_DIR / 'xgb_baseline.pkl')
         with open(model_path, 'rb') as f:
             model_package = pickle.load(f)
             
         encoder = model_package['ohe_encoder']
         model = model_package['model']
+        # Changes whenever the pickle is replaced by a retrained model
+        version = os.stat(model_path).st_mtime_ns
 
     else:
         raise ValueError(f"Unknown model being requested: {model_type}")
 
-    return {'model': model, 'encoder': encoder}
+    return {'model': model, 'encoder': encoder, 'version': version}
+
+@st.experimental_singleton
+def get_kline_history():
+    # Shared across reruns and sessions so each refresh only reads newly published days
+    return MaterializedKlineHistory()
+
+@st.experimental_singleton
+def get_realtime_tail():
+    return RealtimeKlineTail(ticker=TICKER_SYMBOL, interval=INTERVAL)
+
+@st.experimental_singleton
+def get_feature_cache():
+    return FeatureCache(FEATURE_CACHE_DIR)
+
+@st.experimental_singleton
+def get_prediction_cache():
+    # Predictions of bars scored on a previous refresh, shared by all sessions
+    return PredictionCache()
+
+@st.experimental_singleton
+def get_inference_client():
+    return InferenceClient(INFERENCE_SERVER_URL)
+
+@st.experimental_singleton
+def get_strategy_trackers():
+    # Live strategy trackers per model, shared by all sessions, and the lock sessions update them under
+    return {}, threading.Lock()
+
+def get_strategy_profits(model_type, model_version, close_times, actual_Y, pred_Y):
+    # Only the bars closed since the last refresh are added to the trackers, and their state is saved so that a
+    # restart resumes the day. A new window (the next day) or model version starts new trackers.
+    trackers_dict, lock = get_strategy_trackers()
+    key = [model_type, str(model_version), int(close_times[0])]
+    path = STRATEGY_TRACKERS_DIR / f"{model_type}.json"
+    # The bar that is still forming is previewed instead of added, as its prices can still change
+    closed_rows = int(np.searchsorted(close_times, int(time.time() * 1000), side='right'))
+    with lock:
+        trackers = trackers_dict.get(model_type)
+        if trackers is None or trackers.key != key:
+            trackers = StrategyTrackers.load(path, key=key)
+            trackers_dict[model_type] = trackers
+        trackers.update(actual_Y[:closed_rows], pred_Y[:closed_rows], close_times[:closed_rows])
+        trackers.save(path)
+        profits = trackers.preview_profits(actual_Y[closed_rows:], pred_Y[closed_rows:], close_times[closed_rows:])
+    return [profits[strategy] for strategy in [1, 2, 3, 4]]
 
 def generate_data():
-    # Load state
-    if st.session_state['model'] is None:
+    # Load state. Without a local model the predictions come from the inference server.
+    if st.session_state['encoder'] is None:
         return
 
     start_date = (datetime.utcnow() - timedelta(days=30) ).strftime('%Y-%m-%d')
@@ -95,16 +172,32 @@ def generate_data():
         RAW_DF_HEADERS,
         st.session_state['encoder'],
         MA_WINDOW_SIZES_DICT,
+        kline_store_dir=KLINE_STORE_DIR,
+        kline_history=get_kline_history(),
+        realtime_tail=get_realtime_tail(),
+        feature_cache=get_feature_cache(),
     )
     
-    inference_X = processed_df.values[:, 1:-1]
-    inference_Y = processed_df.values[:, -1]
-    pred_inference_Y = st.session_state['model'].predict(inference_X)
+    inference_X, inference_Y = get_model_inputs(processed_df)
+    if INFERENCE_SERVER_URL:
+        predict_fn = lambda X: get_inference_client().predict(X, model=st.session_state['model_type'])
+    else:
+        predict_fn = st.session_state['model'].predict
+    # Only the minutes that were not scored on a previous refresh are predicted
+    pred_inference_Y = get_prediction_cache().get_predictions(
+        predict_fn,
+        inference_X,
+        processed_df['close_time'].to_numpy(),
+        model_id=st.session_state['model_type'],
+        model_version=st.session_state['model_version'],
+        symbol=TICKER_SYMBOL,
+        interval=INTERVAL,
+        cacheable_until=int(time.time() * 1000),
+    )
     chart_df = pd.DataFrame({"Actual Price": inference_Y, "Predicted Price": pred_inference_Y})
 
-    # Calculate trading profits
-    price_df = generate_price_df(inference_Y, pred_inference_Y)
-    strategy_profits = [strategy_1(price_df), strategy_2(price_df), strategy_3(price_df), strategy_4(price_df)]
+    # Calculate trading profits, the same as the strategies of src.trading.strategies over the whole window
+    strategy_profits = get_strategy_profits(st.session_state['model_type'], st.session_state['model_version'], processed_df['close_time'].to_numpy(), inference_Y, pred_inference_Y)
     return chart_df, strategy_profits
     # plot_actual_and_predicted_price(inference_Y, pred_inference_Y, title="Actual and Predicted BTCUSDT Price for XGB Baseline")
 
@@ -117,14 +210,21 @@ st.markdown("Time-series prediction for BTCUSDT using data scraped from Binance
 st.session_state['model_type'] = "-"
 st.session_state['encoder'] = None
 st.session_state['model'] = None
+st.session_state['model_version'] = None
 
 with st.sidebar:
-    model_type = st.selectbox("Select a model", MODEL_REGISTRY_DICT.keys())
+    if INFERENCE_SERVER_URL:
+        model_names = list(get_inference_client().models())
+    else:
+        registered_models = [name for name in ModelRegistry(MODEL_REGISTRY_DIR).list_models() if name not in MODEL_REGISTRY_DICT]
+        model_names = list(MODEL_REGISTRY_DICT.keys()) + registered_models
+    model_type = st.selectbox("Select a model", model_names)
     model_package = load_model(str(model_type))
     # Set state
     st.session_state['model_type'] = model_type
     st.session_state['model'] = model_package['model']
     st.session_state['encoder'] = model_package['encoder']
+    st.session_state['model_version'] = model_package['version']
 
 with st.container():
     st.subheader(f"Actual vs Predicted Price of BTCUSDT using {st.session_state['model_type']}")
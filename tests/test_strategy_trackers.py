@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from src.trading.strategies import generate_price_df, strategy_1, strategy_2, strategy_3, strategy_4
+from src.trading.strategy_trackers import StrategyTrackers
+
+STRATEGIES = {1: strategy_1, 2: strategy_2, 3: strategy_3, 4: strategy_4}
+MS_PER_MINUTE = 60 * 1000
+
+
+def _prices(n_bars: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # Random walk of 8-decimal prices, like Binance closes, and noisy float32 predictions of them
+    actual = np.round(40000 + np.cumsum(rng.normal(0, 20, n_bars)), 8)
+    predicted = (np.r_[actual[:1], actual[:-1]] + rng.normal(0, 20, n_bars)).astype(np.float32)
+    close_times = 1617235199999 + MS_PER_MINUTE * np.arange(n_bars, dtype=np.int64)
+    return actual, predicted, close_times
+
+def _batch_profits(actual, predicted) -> dict:
+    price_df = generate_price_df(actual, predicted)
+    return {strategy: function(price_df) for strategy, function in STRATEGIES.items()}
+
+def _track_in_steps(actual, predicted, close_times, seed: int = 0, max_step: int = 3000) -> StrategyTrackers:
+    # Feeds the growing window in random steps, resuming from serialized state before every step
+    rng = np.random.default_rng(seed)
+    trackers = StrategyTrackers(key=['model', 1, int(close_times[0]) if len(close_times) > 0 else None])
+    stop = 0
+    while True:
+        trackers = StrategyTrackers.from_dict(trackers.to_dict())
+        trackers.update(actual[:stop], predicted[:stop], close_times[:stop])
+        if stop == len(actual):
+            return trackers
+        stop = min(len(actual), stop + int(rng.integers(0, max_step + 1)))
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_trackers_match_batch_strategies(seed):
+    actual, predicted, close_times = _prices(20000, seed=seed)
+    trackers = _track_in_steps(actual, predicted, close_times, seed=seed)
+    assert trackers.profits() == _batch_profits(actual, predicted)
+
+def test_trackers_match_batch_strategies_with_nan_predictions():
+    actual, predicted, close_times = _prices(5000, seed=3)
+    predicted[[0, 5, 600, 601, 4999]] = np.nan
+    trackers = _track_in_steps(actual, predicted, close_times, seed=3, max_step=500)
+    assert trackers.profits() == _batch_profits(actual, predicted)
+
+@pytest.mark.parametrize('n_bars', [0, 1, 2])
+def test_trackers_match_batch_strategies_on_tiny_windows(n_bars):
+    actual, predicted, close_times = _prices(n_bars, seed=4)
+    trackers = _track_in_steps(actual, predicted, close_times, max_step=1)
+    assert trackers.profits() == _batch_profits(actual, predicted)
+
+def test_preview_does_not_change_state():
+    actual, predicted, close_times = _prices(3000, seed=5)
+    trackers = StrategyTrackers()
+    trackers.update(actual[:-1], predicted[:-1], close_times[:-1])
+    state = trackers.to_dict()
+    assert trackers.preview_profits(actual[-1:], predicted[-1:], close_times[-1:]) == _batch_profits(actual, predicted)
+    assert trackers.to_dict() == state
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.features.feature_generator import feature_pipeline_v1
+from src.features.streaming_features import StreamingFeatureEngine
+
+MA_WINDOW_SIZES = {'close_5m_ma': 5, 'close_30m_ma': 30, 'close_1h_ma': 60}
+LAG_MAX_OFFSET_PERIOD = 10
+MS_PER_MINUTE = 60 * 1000
+
+
+def _klines(n_bars: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # Random walk of 8-decimal closes and volumes, like Binance klines
+    close = np.round(40000 + np.cumsum(rng.normal(0, 20, n_bars)), 8)
+    volume = np.round(rng.uniform(0, 50, n_bars), 8)
+    close_time = 1617235199999 + MS_PER_MINUTE * np.arange(n_bars, dtype=np.int64)
+    return pd.DataFrame({
+        'open_time': close_time - MS_PER_MINUTE + 1,
+        'open': close, 'high': close, 'low': close, 'close': close,
+        'volume': volume,
+        'close_time': close_time,
+        'quote_asset_volume': volume * close,
+        'num_trades': 1,
+        'taker_buy_base_asset_volume': volume,
+        'taker_buy_quote_asset_volume': volume * close,
+        'ignore': 0,
+    })
+
+def _batch_features(raw_df: pd.DataFrame):
+    return feature_pipeline_v1(raw_df, MA_WINDOW_SIZES, LAG_MAX_OFFSET_PERIOD)
+
+def test_stream_matches_feature_pipeline():
+    raw_df = _klines(3000)
+    expected_df, ohe_encoder = _batch_features(raw_df)
+    engine = StreamingFeatureEngine(MA_WINDOW_SIZES, ohe_encoder, lag_max_offset_period=LAG_MAX_OFFSET_PERIOD)
+    pd.testing.assert_frame_equal(engine.transform(raw_df), expected_df, check_exact=True)
+
+def test_stream_resumes_from_checkpoint(tmp_path):
+    raw_df = _klines(3000, seed=1)
+    expected_df, ohe_encoder = _batch_features(raw_df)
+    engine = StreamingFeatureEngine(MA_WINDOW_SIZES, ohe_encoder, lag_max_offset_period=LAG_MAX_OFFSET_PERIOD)
+    first_df = engine.transform(raw_df.iloc[:1234])
+    engine.save_checkpoint(tmp_path / 'engine.pkl')
+
+    restored = StreamingFeatureEngine.load_checkpoint(tmp_path / 'engine.pkl', MA_WINDOW_SIZES, ohe_encoder, lag_max_offset_period=LAG_MAX_OFFSET_PERIOD)
+    # Bars already seen before the checkpoint are skipped
+    second_df = restored.transform(raw_df.iloc[1000:])
+    pd.testing.assert_frame_equal(pd.concat([first_df, second_df], ignore_index=True), expected_df, check_exact=True)
+
+def test_warm_up_matches_feature_pipeline():
+    raw_df = _klines(3000, seed=2)
+    expected_df, ohe_encoder = _batch_features(raw_df)
+    engine = StreamingFeatureEngine(MA_WINDOW_SIZES, ohe_encoder, lag_max_offset_period=LAG_MAX_OFFSET_PERIOD)
+    engine.warm_up(raw_df.iloc[:2000])
+    tail_df = engine.transform(raw_df.iloc[2000:])
+    pd.testing.assert_frame_equal(tail_df, expected_df.iloc[-1000:].reset_index(drop=True), check_exact=True)
+
+def test_rejects_closes_off_the_price_grid():
+    raw_df = _klines(100, seed=3)
+    _, ohe_encoder = _batch_features(raw_df)
+    engine = StreamingFeatureEngine(MA_WINDOW_SIZES, ohe_encoder, lag_max_offset_period=LAG_MAX_OFFSET_PERIOD)
+    with pytest.raises(ValueError):
+        engine.update(int(raw_df['close_time'].iloc[0]), 40000.123456789, 1.0)
+    raw_df.loc[50, 'close'] = 40000.123456789
+    with pytest.raises(ValueError):
+        engine.warm_up(raw_df)